@@ -0,0 +1,260 @@
+"""
+Micro-benchmarks measuring the costs of the partitioning machinery.
+"""
+import hashlib
+import timeit
+from collections import Counter
+
+from django.db import models, transaction
+from django.utils import timezone
+
+from . import partitions
+from .hashing import HASHING_STRATEGIES
+
+
+def best_time_per_call(func, number, repeat=3):
+    """
+    Returns the best seconds-per-call of func over several repeats of `number` calls.
+    """
+    return min(
+        timeit.repeat(func, number=1, repeat=repeat)
+    ) / number
+
+
+def bench_hashing(partition_counts=(5, 64, 1024), number_of_keys=100000, strategies=HASHING_STRATEGIES):
+    """
+    Compares the hashing strategies in setup cost, per-key routing cost and distribution uniformity.
+    Returns the list of result dicts, one per strategy and partition count.
+
+    Uniformity is reported as the ratio of the fullest partition to the ideal (mean) load
+    and as the coefficient of variation of the partition loads.
+    """
+    keys = [str(k) for k in xrange(number_of_keys)]
+    results = []
+
+    for number_of_partitions in partition_counts:
+        for strategy in strategies:
+            started = timeit.default_timer()
+            select_bucket = strategy(xrange(number_of_partitions)).select_bucket
+            setup_seconds = timeit.default_timer() - started
+
+            def route_all():
+                for key in keys:
+                    select_bucket(key)
+
+            per_key_seconds = best_time_per_call(route_all, number=number_of_keys)
+
+            loads = Counter(select_bucket(key) for key in keys)
+            counts = [loads.get(part_index, 0) for part_index in xrange(number_of_partitions)]
+            mean = float(number_of_keys) / number_of_partitions
+            variance = sum((c - mean) ** 2 for c in counts) / number_of_partitions
+
+            results.append({
+                'strategy': strategy.__name__,
+                'partitions': number_of_partitions,
+                'setup_ms': setup_seconds * 1e3,
+                'per_key_us': per_key_seconds * 1e6,
+                'max_load_ratio': max(counts) / mean,
+                'load_cv': variance ** 0.5 / mean,
+            })
+
+    return results
+
+
+def bench_startup(history_years=(1, 5, 10, 20)):
+    """
+    Measures what a monthly partitioned model costs at import time, depending on the length of its history.
+    Returns the list of result dicts with the time of the decoration itself (all a worker pays on boot
+    with the lazy partitions) and the time to materialize all the partitions (what was paid eagerly).
+
+    Throwaway models are registered into the datastore app of this process.
+    """
+    now = timezone.now()
+    results = []
+
+    for years in history_years:
+        module_globals = {'__name__': 'dmdp.apps.datastore.models'}
+        model_name = 'StartupBench%dY%d' % (years, id(module_globals))
+
+        class Meta:
+            abstract = True
+            app_label = 'datastore'
+
+        base_model = type(model_name, (models.Model,), {
+            '__module__': module_globals['__name__'],
+            'Meta': Meta,
+            'value': models.IntegerField(default=0),
+        })
+
+        started = timeit.default_timer()
+        partitions.make_model_monthly_partitioned(module_globals, start_ym=(now.year - years, now.month))(base_model)
+        decorate_seconds = timeit.default_timer() - started
+
+        started = timeit.default_timer()
+        materialized = len(list(base_model.iter_YMs(base_model.partitions_start_ym, base_model.partitions_end_ym)))
+        materialize_seconds = timeit.default_timer() - started
+
+        partitions.partitioned_models.remove(base_model)
+
+        results.append({
+            'history_years': years,
+            'partitions': materialized,
+            'decorate_ms': decorate_seconds * 1e3,
+            'materialize_all_ms': materialize_seconds * 1e3,
+        })
+
+    return results
+
+
+def legacy_goccache_key(model, params):
+    """
+    The cache key built the way GocPkCacheMixin.get_goccache_key used to, the baseline for bench_goccache_key.
+    """
+    params_string = ' '.join(
+        '%s=%s' % (k, params[k]) for k in sorted(params)
+    )
+
+    return 'gocpkcache-%s-%s' % (
+        model._meta.object_name,
+        hashlib.sha256(params_string.encode('UTF-8')).hexdigest(),
+    )
+
+
+def bench_goccache_key(model, number=100000):
+    """
+    Measures the per-call cost of building the GocPk cache key of the model,
+    for a short value put into the key as it is, for a long value hashed
+    and for two fields, compared to the former SHA-256 based key building.
+    Returns the list of result dicts.
+    """
+    cases = (
+        ('short raw', {'ua': 'Wget/1.17.1'}),
+        ('long hashed', {'ua': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)'}),
+        ('two fields', {'ua': 'curl/7.47.0', 'some_value': 42}),
+    )
+    results = []
+
+    for case, params in cases:
+        for variant, build in (
+            ('legacy', lambda: legacy_goccache_key(model, params)),
+            ('compiled', lambda: model.get_goccache_key(params)),
+        ):
+            def build_all():
+                for _ in xrange(number):
+                    build()
+
+            results.append({
+                'case': case,
+                'variant': variant,
+                'per_call_us': best_time_per_call(build_all, number=number) * 1e6,
+                'key': build(),
+            })
+
+    return results
+
+
+def bench_suite(number=10000, db_number=1000):
+    """
+    Runs the benchmark suite of the partitioning machinery, returning the list of result dicts
+    with the name of the operation and its best per-operation cost in microseconds.
+    CPU-bound operations are repeated number times, the ones hitting the database db_number times.
+
+    All the rows written are rolled back. The tables of the recent partitions are created if missing
+    and the cache keys of the partitions involved are invalidated afterwards.
+    Meant for a throwaway database, an in-memory SQLite one needs no server, see dmdp.settings_bench.
+    """
+    from .models import Action, Browser, Event, Session
+
+    now = timezone.now()
+    months = (-2, -1, 0)
+    browser_models = [Browser.ensure_partition(ym) for ym in months]
+    event_models = [Event.ensure_partition(ym) for ym in months]
+    browser_model, event_model = browser_models[-1], event_models[-1]
+    session_model = Session.partition(1)
+
+    for part_index in xrange(Action.number_of_partitions):
+        partitions.ensure_table(Session.partition_indexed(part_index))
+        partitions.ensure_table(Action.partition_indexed(part_index))
+
+    results = []
+
+    def measure(name, func, times):
+        results.append({
+            'name': name,
+            'number': times,
+            'per_op_us': best_time_per_call(func, number=times) * 1e6,
+        })
+
+    def repeat(func, times):
+        def run():
+            for i in xrange(times):
+                func(i)
+        return run
+
+    # Pure CPU, no database involved.
+
+    measure('resolve_month', repeat(lambda i: partitions.resolve_month((2016, 12)), number), number)
+    measure('iter_months of a year', repeat(lambda i: list(partitions.iter_months((2016, 1), (2016, 12))), number), number)
+    measure('YM', repeat(lambda i: Event.YM(now.year, now.month), number), number)
+    measure('partition_for_timestamp', repeat(lambda i: Event.partition_for_timestamp(now), number), number)
+    measure('partition', repeat(lambda i: Session.partition(i % 100), number), number)
+    measure('partition_many per key', lambda: Session.partition_many(xrange(number)), number)
+    measure('get_goccache_key', repeat(lambda i: browser_model.get_goccache_key({'ua': 'Wget/1.17.1'}), number), number)
+
+    with transaction.atomic():
+        # Cached lookups, the misses create rows.
+
+        browser_id = browser_model.get_or_create_cached_pk_for(ua='Wget/1.17.1')
+        session_model.get_or_create_cached_pk_for(website_id=1)
+
+        measure(
+            'get_or_create_cached_pk_for hit, local cache',
+            repeat(lambda i: browser_model.get_or_create_cached_pk_for(ua='Wget/1.17.1'), number),
+            number,
+        )
+        measure(
+            'get_or_create_cached_pk_for hit, shared cache',
+            repeat(lambda i: session_model.get_or_create_cached_pk_for(website_id=1), number),
+            number,
+        )
+
+        misses = iter(xrange(10 ** 9))
+        measure(
+            'get_or_create_cached_pk_for miss',
+            repeat(lambda i: browser_model.get_or_create_cached_pk_for(ua='bench-%d' % next(misses)), db_number),
+            db_number,
+        )
+
+        # Inserts into one partition.
+
+        measure(
+            'insert one by one per row',
+            repeat(lambda i: event_model.objects.create(timestamp=now, browser_id=browser_id), db_number),
+            db_number,
+        )
+        measure(
+            'insert bulk_create per row',
+            lambda: event_model.objects.bulk_create([
+                event_model(timestamp=now, browser_id=browser_id) for i in xrange(db_number)
+            ]),
+            db_number,
+        )
+
+        # Counts across partitions, each holding some rows.
+
+        for month_browser_model, month_event_model in zip(browser_models, event_models)[:-1]:
+            month_browser_id = month_browser_model.get_or_create_cached_pk_for(ua='Wget/1.17.1')
+            month_event_model.objects.bulk_create([
+                month_event_model(timestamp=now, browser_id=month_browser_id) for i in xrange(db_number)
+            ])
+
+        measure('across 3 months count', lambda: Event.across(months[0], months[-1]).count(), 1)
+        measure('across all partitions count', lambda: Action.across().count(), 1)
+
+        transaction.set_rollback(True)
+
+    # The cached primary keys of the rolled back rows.
+    for model in browser_models + [session_model]:
+        model.bump_gocpk_generation()
+
+    return results
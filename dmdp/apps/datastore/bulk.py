@@ -0,0 +1,310 @@
+import datetime
+import io
+import sys
+import time
+from collections import defaultdict, namedtuple
+from itertools import islice
+
+from django.core.management.color import no_style
+from django.db import connections, models, router
+from django.db.transaction import atomic
+from django.utils import six
+
+# Rows loaded into one partition and seconds spent doing so.
+LoadResult = namedtuple('LoadResult', 'rows seconds')
+
+
+def get_partition_router(base_model, route_by=None):
+    """
+    Returns the function returning the partition model for the routing key
+    of the monthly or range partitioned base model, along with the default route_by field name.
+    """
+    if hasattr(base_model, 'partition_for_timestamp'):
+        return base_model.partition_for_timestamp, route_by or 'timestamp'
+
+    if hasattr(base_model, 'partition'):
+        if route_by is None:
+            raise RuntimeError(
+                "Range partitioned model %s needs route_by to know its key." % base_model._meta.object_name
+            )
+        return base_model.partition, route_by
+
+    raise RuntimeError("Model %s is not partitioned." % base_model._meta.object_name)
+
+
+def estimate_size(values):
+    """
+    A rough estimate of the memory taken by the row values.
+    """
+    return sum(sys.getsizeof(value) for value in values)
+
+
+class PartitionedBulkWriter(object):
+    """
+    Buffers rows of any monthly or range partitioned model per partition
+    and writes them using bulk_create, each flush in one transaction.
+
+    The rows are either dicts of field values or model instances. Each is routed
+    by its route_by field (a timestamp for monthly partitioned models, the hashed key
+    for range partitioned ones) unless the routing key is passed to add() explicitly.
+    Instances of the partition models themselves stay in their partition.
+
+    A partition is flushed when it buffers batch_size rows. All partitions are flushed
+    when the buffered rows are estimated to take more than max_bytes,
+    or when the oldest buffered row waits longer than max_age seconds.
+
+        with PartitionedBulkWriter(Event) as writer:
+            for day in days:
+                writer.add({'timestamp': day, 'browser_id': browser_id})
+
+        with PartitionedBulkWriter(Action, route_by='website_id') as writer:
+            writer.add({'session_id': session_id}, key=website_id)
+    """
+    def __init__(self, base_model, route_by=None, batch_size=1000, max_bytes=32 * 1024 * 1024, max_age=None):
+        self.base_model = base_model
+        self.select_partition, self.route_by = get_partition_router(base_model, route_by)
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self.buffers = defaultdict(list)
+        self.buffered_sizes = defaultdict(int)
+        self.buffered_bytes = 0
+        self.oldest_buffered_at = None
+
+        self.rows_written = 0
+        self.flushes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Nothing is written when the block failed, just as atomic() would not commit it.
+        if exc_type is None:
+            self.flush()
+
+    def add(self, row, key=None):
+        """
+        Buffers the row, flushing when any of the limits is reached.
+        """
+        if isinstance(row, models.Model):
+            if isinstance(row, self.base_model) and key is None:
+                model = type(row)
+            else:
+                model = self.select_partition(getattr(row, self.route_by) if key is None else key)
+
+                if not isinstance(row, model):
+                    raise RuntimeError("Cannot write %r to partition %s." % (row, model._meta.object_name))
+
+            instance = row
+            size = estimate_size(row.__dict__.values())
+        else:
+            model = self.select_partition(row[self.route_by] if key is None else key)
+            instance = model(**row)
+            size = estimate_size(row.values())
+
+        buf = self.buffers[model]
+        buf.append(instance)
+
+        if self.oldest_buffered_at is None:
+            self.oldest_buffered_at = time.time()
+        self.buffered_sizes[model] += size
+        self.buffered_bytes += size
+
+        if self.buffered_bytes >= self.max_bytes or (
+            self.max_age is not None and time.time() - self.oldest_buffered_at >= self.max_age
+        ):
+            self.flush()
+        elif len(buf) >= self.batch_size:
+            self.flush(model)
+
+    def add_many(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def flush(self, model=None):
+        """
+        Writes the rows buffered for the partition model, or for all partitions by default.
+        Every database gets one transaction. Buffers are emptied only when the write succeeds.
+        """
+        partition_models = [
+            partition_model for partition_model in (self.buffers.keys() if model is None else [model])
+            if self.buffers.get(partition_model)
+        ]
+
+        by_db = defaultdict(list)
+        for partition_model in partition_models:
+            by_db[router.db_for_write(partition_model)].append(partition_model)
+
+        for db, db_models in by_db.items():
+            with atomic(using=db):
+                for partition_model in db_models:
+                    partition_model.objects.using(db).bulk_create(
+                        self.buffers[partition_model],
+                        batch_size=self.batch_size,
+                    )
+
+            for partition_model in db_models:
+                self.rows_written += len(self.buffers.pop(partition_model))
+                self.buffered_bytes -= self.buffered_sizes.pop(partition_model)
+
+            self.flushes += 1
+
+        if not self.buffers:
+            # Otherwise the age of the oldest row is kept, flushing the rest a bit earlier at worst.
+            self.oldest_buffered_at = None
+
+
+def get_load_fields(model, with_pk=False):
+    """
+    Returns the concrete fields to be loaded, without the auto-incremented primary key by default.
+    """
+    return [
+        field for field in model._meta.concrete_fields
+        if with_pk or not isinstance(field, models.AutoField)
+    ]
+
+
+def get_row_values(fields, row):
+    """
+    Returns the list of values of the dict or model instance row, ordered as fields.
+    Missing dict values get the field default. Foreign keys accept either the instance or its pk.
+    """
+    if isinstance(row, models.Model):
+        return [getattr(row, field.attname) for field in fields]
+
+    values = []
+
+    for field in fields:
+        if field.attname in row:
+            value = row[field.attname]
+        elif field.name in row:
+            value = row[field.name]
+
+            if isinstance(value, models.Model):
+                value = value.pk
+        else:
+            value = field.get_default()
+
+        values.append(value)
+
+    return values
+
+
+def copy_text(value):
+    """
+    Formats the value prepared for database for PostgreSQL COPY text format.
+    """
+    if value is None:
+        return u'\\N'
+    if value is True:
+        return u't'
+    if value is False:
+        return u'f'
+    if isinstance(value, datetime.datetime):
+        return six.text_type(value.isoformat(' '))
+    if isinstance(value, datetime.date):
+        return six.text_type(value.isoformat())
+
+    return six.text_type(value).replace(
+        u'\\', u'\\\\',
+    ).replace(
+        u'\t', u'\\t',
+    ).replace(
+        u'\n', u'\\n',
+    ).replace(
+        u'\r', u'\\r',
+    )
+
+
+def copy_rows(model, rows, using=None, with_pk=False):
+    """
+    Loads the dicts or instances into the table of the (partition) model as fast as the database allows:
+    via COPY FROM STDIN on PostgreSQL, via a single executemany INSERT elsewhere.
+    Neither signals nor save() are involved. Returns the number of rows loaded.
+
+    With with_pk=True the primary keys are loaded too and the PostgreSQL sequence is reset afterwards.
+    """
+    db = using or router.db_for_write(model)
+    connection = connections[db]
+    qn = connection.ops.quote_name
+
+    fields = get_load_fields(model, with_pk)
+    values = [
+        [
+            field.get_db_prep_save(value, connection)
+            for field, value in zip(fields, get_row_values(fields, row))
+        ]
+        for row in rows
+    ]
+
+    if not values:
+        return 0
+
+    table_and_columns = '%s (%s)' % (
+        qn(model._meta.db_table),
+        ', '.join(qn(field.column) for field in fields),
+    )
+
+    with atomic(using=db), connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            stream = io.BytesIO()
+
+            for row_values in values:
+                stream.write(
+                    (u'\t'.join(copy_text(value) for value in row_values) + u'\n').encode('UTF-8')
+                )
+
+            stream.seek(0)
+            cursor.copy_expert('COPY %s FROM STDIN' % table_and_columns, stream)
+        else:
+            cursor.executemany(
+                'INSERT INTO %s VALUES (%s)' % (
+                    table_and_columns,
+                    ', '.join(['%s'] * len(fields)),
+                ),
+                values,
+            )
+
+        if with_pk:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [model]):
+                cursor.execute(sql)
+
+    return len(values)
+
+
+def copy_load(base_model, rows, route_by=None, chunk_size=10000, with_pk=False):
+    """
+    Streams the dicts or instances into the partitions of the monthly or range partitioned base model
+    using copy_rows(), routing them by their route_by value like PartitionedBulkWriter does.
+    The rows are consumed in chunks of chunk_size, so any iterable of any length can be loaded.
+
+    Returns a dict mapping the partition model to its LoadResult(rows, seconds).
+
+    >>> copy_load(Event, ({'timestamp': ts, 'browser_id': 1} for ts in timestamps))
+    {<class '...Event_2016_11'>: LoadResult(rows=41760, seconds=0.31), ...}
+    """
+    select_partition, route_by = get_partition_router(base_model, route_by)
+    rows = iter(rows)
+    results = {}
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        by_partition = defaultdict(list)
+        for row in chunk:
+            by_partition[
+                select_partition(getattr(row, route_by) if isinstance(row, models.Model) else row[route_by])
+            ].append(row)
+
+        for model, partition_rows in by_partition.items():
+            started = time.time()
+            loaded = copy_rows(model, partition_rows, with_pk=with_pk)
+            seconds = time.time() - started
+
+            previous = results.get(model, LoadResult(0, 0.0))
+            results[model] = LoadResult(previous.rows + loaded, previous.seconds + seconds)
+
+    return results
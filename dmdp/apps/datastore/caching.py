@@ -1,33 +1,305 @@
 import hashlib
+import operator
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
 
 from django.core.cache import cache
 from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import IntegrityError, models, router
+from django.db.models import Q
+from django.db.transaction import atomic
+from django.utils import six
+from django.utils.encoding import force_text
+
+# How many kwargs combinations get_or_create_cached_pk_for_many() looks up in a single query,
+# keeping within the SQLite limit of 999 query parameters for lookups by up to three fields.
+GOCPK_LOOKUP_CHUNK_SIZE = 300
+
+# Values matching this are put into cache keys as they are, unless the keys get longer than that.
+# Memcached accepts keys of up to 250 characters without whitespace and control characters.
+GOCPK_RAW_VALUE_RE = re.compile(r'^[A-Za-z0-9_.:/@+-]*\Z')
+GOCPK_RAW_KEY_MAX_LENGTH = 160
+
+# How many times get_or_create is tried when the unique constraint fails on a concurrent creation.
+GOCPK_CREATE_ATTEMPTS = 3
+
+# Prepended to the cache key of the row to get the one of its single-flight lock.
+GOCPK_LOCK_PREFIX = 'gocpklock-'
+
+# The first delay (in seconds) between the polls of a key being resolved by another worker, doubling each time.
+GOCPK_SINGLE_FLIGHT_POLL_DELAY = 0.005
+
+
+if hasattr(hashlib, 'blake2b'):
+    def gocpk_digest(data):
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+else:
+    def gocpk_digest(data):
+        # Not used for anything secret, MD5 is the fastest 128-bit digest there.
+        return hashlib.md5(data).hexdigest()
+
+
+# Maps the model class to its cache key generation and the time to read it from the cache again.
+gocpk_generations = {}
+
+
+def new_gocpk_generation():
+    """
+    A generation number never used before, even if the stored one got evicted from the cache.
+    In microseconds, so it stays ahead of the generations bumped by one in the same millisecond.
+    """
+    return int(time.time() * 1000000)
+
+
+# Maps the model class configuring the local cache to its LocalLRUCache, see GocPkCacheMixin.
+local_caches = {}
+local_caches_lock = threading.Lock()
+
+
+class LocalLRUCache(object):
+    """
+    A bounded in-process cache, evicting the least recently used entries beyond max_size.
+    Entries older than ttl seconds (if given) are treated as missing.
+    Values must not be None, which is returned for misses. Thread-safe.
+
+    >>> lru = LocalLRUCache(2)
+    >>> lru.set('a', 1); lru.set('b', 2); lru.get('a')
+    1
+    >>> lru.set('c', 3)
+    >>> lru.get('b'), lru.get('a'), lru.stats()
+    (None, 1, {'size': 2, 'max_size': 2, 'hits': 2, 'misses': 1, 'evictions': 1, 'expirations': 0})
+    """
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value, expires_at = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if expires_at is not None and expires_at <= time.time():
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            # Reinserted as the most recently used one.
+            self.entries[key] = value, expires_at
+            self.hits += 1
+
+            return value
+
+    def set(self, key, value):
+        expires_at = None if self.ttl is None else time.time() + self.ttl
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value, expires_at
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
 
 
 class GocPkCacheMixin(object):
+    """
+    Adds get_or_create_cached_pk_for, caching primary keys of the rows in the Django cache.
+
+    Set gocpk_local_cache_size on the model to put a LocalLRUCache of that many entries in front of it,
+    with entries expiring after gocpk_local_cache_ttl seconds (never by default). Partitions of the model
+    share the one local cache, their keys differ anyway. Hot keys are then served from the process memory
+    and the shared cache only sees the misses.
+
+    Every cache key contains the generation number of the model (the partition), so all its cached keys
+    are invalidated at once by bump_gocpk_generation. Each process rereads the generation from the cache
+    after gocpk_generation_ttl seconds.
+
+    Set gocpk_lookup_fields to the fields the rows are looked up by to let rollover.prewarm_partition
+    copy the most used rows into the next month's partition.
+
+    Set gocpk_single_flight to let only one worker at a time create the row for a missing key,
+    see get_or_create_pk_single_flight.
+    """
+    gocpk_local_cache_size = 0
+    gocpk_local_cache_ttl = None
+    gocpk_raw_keys = True
+    gocpk_lookup_fields = None
+    gocpk_generation_ttl = 5.0
+    gocpk_single_flight = False
+    gocpk_single_flight_wait = 1.0
+    gocpk_single_flight_lock_timeout = 10
+
     @classmethod
-    def get_goccache_key(cls, params):
+    def get_gocpk_local_cache(cls):
+        """
+        Returns the LocalLRUCache of the model, or None if it has none configured.
+        Resolved on the first call, then kept in the gocpk_resolved_local_cache class attribute.
+        """
+        try:
+            return cls.__dict__['gocpk_resolved_local_cache']
+        except KeyError:
+            pass
+
+        local_cache = None
+
+        if cls.gocpk_local_cache_size:
+            # The class setting the size owns the cache, so it is shared by all its partitions.
+            owner = next(klass for klass in cls.__mro__ if 'gocpk_local_cache_size' in klass.__dict__)
+
+            with local_caches_lock:
+                if owner not in local_caches:
+                    local_caches[owner] = LocalLRUCache(cls.gocpk_local_cache_size, cls.gocpk_local_cache_ttl)
+
+                local_cache = local_caches[owner]
+
+        # Set on every class itself, one inheriting it would miss its own gocpk_local_cache_size.
+        cls.gocpk_resolved_local_cache = local_cache
+
+        return local_cache
+
+    @classmethod
+    def get_gocpk_generation_key(cls):
+        return 'gocpkgen-%s' % cls._meta.object_name
+
+    @classmethod
+    def get_gocpk_generation(cls):
+        """
+        Returns the current cache key generation number of the model,
+        remembered in the process for gocpk_generation_ttl seconds.
+        """
+        try:
+            generation, expires_at = gocpk_generations[cls]
+            if expires_at > time.time():
+                return generation
+        except KeyError:
+            pass
+
+        key = cls.get_gocpk_generation_key()
+        generation = cache.get(key)
+
+        if generation is None:
+            # The first process to add it wins.
+            cache.add(key, new_gocpk_generation(), timeout=None)
+            generation = cache.get(key) or 0
+
+        gocpk_generations[cls] = generation, time.time() + cls.gocpk_generation_ttl
+
+        return generation
+
+    @classmethod
+    def bump_gocpk_generation(cls):
+        """
+        Invalidates all the cached keys of the model (the partition) at once, with a single cache write.
+        Other processes stop using them within gocpk_generation_ttl seconds.
+        Call it whenever the rows change their primary keys, e.g. when the table is dropped or rebuilt.
+
+        >>> Browser.YM(2016, 10).bump_gocpk_generation()
+        1476612345678902
         """
-        Create cache key from the object values.
-        The dict is converted to a hash string first.
+        key = cls.get_gocpk_generation_key()
+
+        try:
+            generation = cache.incr(key)
+        except ValueError:
+            generation = new_gocpk_generation()
+            cache.set(key, generation, timeout=None)
+
+        gocpk_generations[cls] = generation, time.time() + cls.gocpk_generation_ttl
+
+        return generation
+
+    @classmethod
+    def compile_goccache_key_builder(cls, params):
+        """
+        Returns the function building the cache key for the dicts with the same keys as params.
+        The field order and the format strings are resolved here once, not for every key.
         """
-        params_string = ' '.join(
-            '%s=%s' % (k, params[k]) for k in sorted(params)
-        )
+        names = tuple(sorted(params))
+        # a model name like 'Browser_2016_12'
+        prefix = 'gocpkcache-%s-%%s-' % cls._meta.object_name
+        get_generation = cls.get_gocpk_generation
+        get_memo = gocpk_generations.get
+        hashed_format = ' '.join('%s=%%s' % name for name in names)
+        raw_format = '&'.join('%s=%%s' % name for name in names)
+        raw_keys = cls.gocpk_raw_keys
+        match_raw_value = GOCPK_RAW_VALUE_RE.match
+
+        def build(params):
+            values = tuple(['%s' % params[name] for name in names])
+
+            # The memo is checked right here, this is called for every looked up row.
+            memo = get_memo(cls)
+            generation_prefix = prefix % (
+                memo[0] if memo is not None and memo[1] > time.time() else get_generation()
+            )
 
-        params_hash = hashlib.sha256(
-            params_string.encode('UTF-8')
-        ).hexdigest()
+            # Short keys of safe characters are accepted by any cache backend as they are.
+            if raw_keys and all(map(match_raw_value, values)):
+                raw = raw_format % values
 
-        key = 'gocpkcache-%s-%s' % (
-            # a model name like 'Browser'
-            cls._meta.object_name,
-            # a hash of params, because the remote cache server may not support
+                if len(raw) <= GOCPK_RAW_KEY_MAX_LENGTH:
+                    return generation_prefix + raw
+
+            # a hash of params otherwise, because the remote cache server may not support
             # all characters in raw string as key
-            params_hash,
-        )
+            return generation_prefix + gocpk_digest((hashed_format % values).encode('UTF-8'))
+
+        builders = cls.__dict__.get('gocpk_key_builders')
+        if builders is None:
+            builders = cls.gocpk_key_builders = {}
+
+        builders[tuple(params)] = build
+
+        return build
+
+    @classmethod
+    def get_goccache_key(cls, params):
+        """
+        Create cache key from the object values and the cache key generation of the model.
+        Short values of safe characters are used as they are, the others are hashed.
 
-        return key
+        >>> Browser.YM(2016, 12).get_goccache_key({'ua': 'Wget'})
+        'gocpkcache-Browser_2016_12-1476612345678901-ua=Wget'
+        >>> Browser.YM(2016, 12).get_goccache_key({'ua': 'Mozilla/5.0 (X11; Linux x86_64)'})
+        'gocpkcache-Browser_2016_12-1476612345678901-414468ec99ba05e723e546a6fcb61da4'
+        """
+        try:
+            build = cls.__dict__['gocpk_key_builders'][tuple(params)]
+        except KeyError:
+            build = cls.compile_goccache_key_builder(params)
+
+        return build(params)
 
     @classmethod
     def get_or_create_cached_pk_for(cls, gocpk_cache_timeout=DEFAULT_TIMEOUT, **kwargs):
@@ -35,10 +307,200 @@ class GocPkCacheMixin(object):
         Returns the cached primary key for given object values combination.
         """
         key = cls.get_goccache_key(kwargs)
+        local_cache = cls.get_gocpk_local_cache()
+
+        if local_cache is not None:
+            pk = local_cache.get(key)
+            if pk is not None:
+                return pk
+
         pk = cache.get(key)
 
         if pk is None:
-            pk = cls.objects.get_or_create(**kwargs)[0].pk
+            pk = cls.get_or_create_pk_single_flight(key, kwargs, gocpk_cache_timeout)
+
+        if local_cache is not None:
+            local_cache.set(key, pk)
+
+        return pk
+
+    @classmethod
+    def get_or_create_pk(cls, kwargs):
+        """
+        Returns the primary key of the row with the values, creating it if missing.
+        Concurrent creation of the same row makes the unique constraint fail for all but one of the writers,
+        the others get the row created by the winner.
+        """
+        for attempt in xrange(GOCPK_CREATE_ATTEMPTS):
+            try:
+                return cls.objects.get_or_create(**kwargs)[0].pk
+            except IntegrityError:
+                if attempt + 1 == GOCPK_CREATE_ATTEMPTS:
+                    raise
+
+    @classmethod
+    def get_or_create_pk_single_flight(cls, key, kwargs, gocpk_cache_timeout=DEFAULT_TIMEOUT):
+        """
+        Resolves the cache miss of the key, caching the primary key of the row with the values.
+
+        With gocpk_single_flight set on the model, only the worker which manages to cache.add() the lock
+        of the key goes to the database, the others poll the cache for its result
+        for at most gocpk_single_flight_wait seconds, then go to the database anyway.
+        So a new value seen by many workers at once costs one write, not one per worker.
+        The lock holds a token unique to the worker, which deletes it only while it still holds its token,
+        not the lock another worker took after it expired.
+        """
+        lock_key = None
+
+        if cls.gocpk_single_flight:
+            token = uuid.uuid4().hex
+
+            # Locks have their own prefix, a raw key of some value may end with anything a suffix could add.
+            if cache.add(GOCPK_LOCK_PREFIX + key, token, timeout=cls.gocpk_single_flight_lock_timeout):
+                lock_key = GOCPK_LOCK_PREFIX + key
+            else:
+                deadline = time.time() + cls.gocpk_single_flight_wait
+                delay = GOCPK_SINGLE_FLIGHT_POLL_DELAY
+
+                while time.time() < deadline:
+                    time.sleep(delay)
+                    delay = min(delay * 2, GOCPK_SINGLE_FLIGHT_POLL_DELAY * 16)
+
+                    pk = cache.get(key)
+                    if pk is not None:
+                        return pk
+
+        try:
+            pk = cls.get_or_create_pk(kwargs)
             cache.set(key, pk, timeout=gocpk_cache_timeout)
+        finally:
+            # The cache API has no compare-and-delete, this leaves the lock alone unless it is just expiring.
+            if lock_key is not None and cache.get(lock_key) == token:
+                cache.delete(lock_key)
 
         return pk
+
+    @classmethod
+    def get_gocpk_lookup_values(cls, names, values):
+        """
+        Returns the tuple of the values of the fields, given by a dict of kwargs or by a sequence
+        of the values read back from the database, normalized so both compare equal:
+        converted by the fields to Python and prepared for the database the same way as when saved
+        (e.g. naive datetimes made aware), strings to text, model instances replaced by their primary keys.
+        """
+        if isinstance(values, dict):
+            values = [values[name] for name in names]
+
+        result = []
+
+        for name, value in zip(names, values):
+            if isinstance(value, models.Model):
+                value = value.pk
+
+            if value is not None:
+                field = cls._meta.get_field(name)
+                value = field.get_prep_value(field.to_python(value))
+
+                if isinstance(value, (six.binary_type, six.text_type)):
+                    value = force_text(value)
+
+            result.append(value)
+
+        return tuple(result)
+
+    @classmethod
+    def select_gocpk_pks(cls, names, list_of_kwargs):
+        """
+        Returns the dict mapping the lookup values of the existing rows (see get_gocpk_lookup_values)
+        to their primary keys, querying all the kwargs combinations at once (in chunks, to keep the query size bounded).
+        """
+        pks = {}
+
+        for start in xrange(0, len(list_of_kwargs), GOCPK_LOOKUP_CHUNK_SIZE):
+            chunk = list_of_kwargs[start:start + GOCPK_LOOKUP_CHUNK_SIZE]
+
+            if len(names) == 1:
+                condition = Q(**{'%s__in' % names[0]: [kwargs[names[0]] for kwargs in chunk]})
+            else:
+                condition = reduce(operator.or_, (Q(**kwargs) for kwargs in chunk))
+
+            for row in cls.objects.filter(condition).values_list('pk', *names):
+                pks[cls.get_gocpk_lookup_values(names, row[1:])] = row[0]
+
+        return pks
+
+    @classmethod
+    def get_or_create_cached_pk_for_many(cls, list_of_kwargs, gocpk_cache_timeout=DEFAULT_TIMEOUT):
+        """
+        Returns the list of primary keys for the given list of object values combinations,
+        the same as get_or_create_cached_pk_for() would return one by one, but in about four round-trips
+        per batch: one cache get_many, one SELECT of the misses, one bulk_create of the really new rows
+        with one more SELECT of their primary keys, and one cache set_many.
+        All the dicts must have the same keys.
+
+        >>> Browser.YM().get_or_create_cached_pk_for_many([{'ua': 'Wget'}, {'ua': 'Curl'}, {'ua': 'Wget'}])
+        [1, 2, 1]
+        """
+        if not list_of_kwargs:
+            return []
+
+        keys = [cls.get_goccache_key(kwargs) for kwargs in list_of_kwargs]
+        kwargs_by_key = dict(zip(keys, list_of_kwargs))
+        pks = {}
+
+        local_cache = cls.get_gocpk_local_cache()
+        if local_cache is not None:
+            for key in kwargs_by_key:
+                pk = local_cache.get(key)
+                if pk is not None:
+                    pks[key] = pk
+
+        locally_cached = set(pks)
+        missing = [key for key in kwargs_by_key if key not in pks]
+
+        if missing:
+            pks.update(cache.get_many(missing))
+            missing = [key for key in missing if pks.get(key) is None]
+
+        if missing:
+            names = sorted(list_of_kwargs[0])
+            lookup_values = dict(
+                (key, cls.get_gocpk_lookup_values(names, kwargs_by_key[key]))
+                for key in missing
+            )
+
+            existing = cls.select_gocpk_pks(names, [kwargs_by_key[key] for key in missing])
+            new = [key for key in missing if lookup_values[key] not in existing]
+
+            if new:
+                try:
+                    with atomic(using=router.db_for_write(cls)):
+                        cls.objects.bulk_create([cls(**kwargs_by_key[key]) for key in new])
+                except IntegrityError:
+                    # Some of them were created meanwhile by someone else, the rest is created one by one.
+                    for key in new:
+                        existing[lookup_values[key]] = cls.get_or_create_pk(kwargs_by_key[key])
+                else:
+                    existing.update(cls.select_gocpk_pks(names, [kwargs_by_key[key] for key in new]))
+
+            found = {}
+
+            for key in missing:
+                try:
+                    found[key] = existing[lookup_values[key]]
+                except KeyError:
+                    raise RuntimeError(
+                        "%s row with %r was neither found nor created, the database stores other values "
+                        "(e.g. truncated or differently cased)." % (cls._meta.object_name, kwargs_by_key[key])
+                    )
+
+            cache.set_many(found, timeout=gocpk_cache_timeout)
+            pks.update(found)
+
+        if local_cache is not None:
+            # Setting the keys served locally again would keep the hot ones from ever expiring.
+            for key, pk in pks.items():
+                if key not in locally_cached:
+                    local_cache.set(key, pk)
+
+        return [pks[key] for key in keys]
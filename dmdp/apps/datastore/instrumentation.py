@@ -0,0 +1,221 @@
+"""
+Opt-in per-partition query statistics.
+
+Once enable()d, every query executed through Django cursors is timed and attributed to the partition
+models whose tables it mentions, per operation (SELECT, INSERT, UPDATE, DELETE, ...).
+It works with DEBUG off, unlike connection.queries. Statistics are kept per process.
+
+>>> instrumentation.enable()
+>>> Event.across(-2, 0).count()
+>>> instrumentation.get_partition_stats()
+[{'partition': 'Event_2016_10', 'operation': 'SELECT', 'queries': 1, 'rows': 1, 'total_ms': 0.4, ...}, ...]
+"""
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.backends.utils import CursorDebugWrapper, CursorWrapper
+
+from . import partitions
+from .utils import percentile
+
+# Latencies kept per partition and operation for the percentiles, sampled uniformly beyond that.
+LATENCY_SAMPLE_SIZE = 1024
+
+# Any word looking like a table name, quoted or not; the partition tables are picked out of them.
+TABLE_NAME_RE = re.compile(r'[\w$]+')
+
+
+class QueryStats(object):
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.latencies = []
+
+    def add(self, seconds, rows):
+        self.queries += 1
+        self.seconds += seconds
+
+        if rows > 0:
+            self.rows += rows
+
+        if len(self.latencies) < LATENCY_SAMPLE_SIZE:
+            self.latencies.append(seconds)
+        else:
+            # Reservoir sampling, every latency has the same chance to be kept.
+            position = random.randrange(self.queries)
+            if position < LATENCY_SAMPLE_SIZE:
+                self.latencies[position] = seconds
+
+
+# Maps (partition model name, operation) to its QueryStats.
+stats = defaultdict(QueryStats)
+stats_lock = threading.Lock()
+
+# Maps the partition table names seen to the partition model names, so only as many as there are partitions.
+partition_tables = {}
+
+# Matches the names of the partition tables of all the partitioned models, built on the first use
+# along with the map of the table names of the partitioned base models to their names.
+partition_table_re = None
+base_model_names = {}
+
+# The original BaseDatabaseWrapper methods, put back by disable().
+original_make_cursor = BaseDatabaseWrapper.make_cursor
+original_make_debug_cursor = BaseDatabaseWrapper.make_debug_cursor
+
+enabled = False
+
+
+def get_partition_table_re():
+    """
+    Returns the regular expression matching the partition table names, capturing the table name
+    of the partitioned base model and the partition suffix, e.g. 'datastore_event' and '2016_10'.
+    """
+    global partition_table_re
+
+    if partition_table_re is None:
+        for base_model in partitions.partitioned_models:
+            base_model_names[base_model._meta.db_table] = base_model._meta.object_name
+
+        partition_table_re = re.compile(r'^(%s)_(\d{4}_\d{2}|p\d+)$' % '|'.join(
+            re.escape(table) for table in base_model_names
+        ))
+
+    return partition_table_re
+
+
+def get_partition_names(sql):
+    """
+    Returns the names of the partition models whose tables the SQL mentions.
+    """
+    names = []
+
+    for word in set(TABLE_NAME_RE.findall(sql)):
+        name = partition_tables.get(word)
+
+        if name is None:
+            match = get_partition_table_re().match(word)
+            if match is None:
+                continue
+
+            # Partition models never override the default table name.
+            name = partition_tables[word] = '%s_%s' % (base_model_names[match.group(1)], match.group(2))
+
+        names.append(name)
+
+    return names
+
+
+def record(sql, seconds, rows):
+    names = get_partition_names(sql)
+
+    if names:
+        operation = sql.lstrip().split(None, 1)[0].upper()
+
+        with stats_lock:
+            for name in names:
+                stats[name, operation].add(seconds, rows)
+
+
+class InstrumentedCursorMixin(object):
+    def execute(self, sql, params=None):
+        started = time.time()
+
+        try:
+            return super(InstrumentedCursorMixin, self).execute(sql, params)
+        finally:
+            record(sql, time.time() - started, self.cursor.rowcount)
+
+    def executemany(self, sql, param_list):
+        started = time.time()
+
+        try:
+            return super(InstrumentedCursorMixin, self).executemany(sql, param_list)
+        finally:
+            record(sql, time.time() - started, self.cursor.rowcount)
+
+
+class InstrumentedCursorWrapper(InstrumentedCursorMixin, CursorWrapper):
+    pass
+
+
+class InstrumentedCursorDebugWrapper(InstrumentedCursorMixin, CursorDebugWrapper):
+    pass
+
+
+def make_cursor(self, cursor):
+    return InstrumentedCursorWrapper(cursor, self)
+
+
+def make_debug_cursor(self, cursor):
+    return InstrumentedCursorDebugWrapper(cursor, self)
+
+
+def enable():
+    """
+    Starts collecting the statistics, on all the connections of all the threads, from their next cursor.
+    """
+    global enabled
+
+    BaseDatabaseWrapper.make_cursor = make_cursor
+    BaseDatabaseWrapper.make_debug_cursor = make_debug_cursor
+
+    enabled = True
+
+
+def disable():
+    """
+    Stops collecting the statistics, which are kept until reset.
+    """
+    global enabled
+
+    BaseDatabaseWrapper.make_cursor = original_make_cursor
+    BaseDatabaseWrapper.make_debug_cursor = original_make_debug_cursor
+
+    enabled = False
+
+
+def reset_partition_stats():
+    with stats_lock:
+        stats.clear()
+
+
+def get_partition_stats():
+    """
+    Returns the list of dicts with the statistics of every partition and operation:
+    the numbers of queries and of rows affected (where the database tells them),
+    the total and the mean time and the 50th, 95th and 99th percentiles of the query time, in milliseconds.
+    Sorted by the total time, the most loaded partitions first.
+    """
+    with stats_lock:
+        items = [
+            (name, operation, query_stats.queries, query_stats.rows, query_stats.seconds,
+             sorted(query_stats.latencies))
+            for (name, operation), query_stats in stats.items()
+        ]
+
+    results = []
+
+    for name, operation, queries, rows, seconds, latencies in items:
+        result = {
+            'partition': name,
+            'operation': operation,
+            'queries': queries,
+            'rows': rows,
+            'total_ms': seconds * 1e3,
+            'mean_ms': seconds * 1e3 / queries,
+        }
+
+        for percent in (50, 95, 99):
+            result['p%d_ms' % percent] = percentile(latencies, percent) * 1e3
+
+        results.append(result)
+
+    results.sort(key=lambda result: result['total_ms'], reverse=True)
+
+    return results
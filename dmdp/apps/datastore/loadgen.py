@@ -0,0 +1,178 @@
+"""
+A load generator writing events the way the ingestion does: the browser of every event is resolved
+by get_or_create_cached_pk_for, then the event is inserted, one by one or in bulk.
+"""
+import bisect
+import multiprocessing
+import random
+import time
+from datetime import timedelta
+
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .utils import percentile
+from .bulk import PartitionedBulkWriter
+from .models import Browser, Event
+
+COMMIT_MODES = ('rollback', 'batch', 'autocommit')
+
+
+class ZipfSampler(object):
+    """
+    Draws integers from 0 to number_of_keys - 1, the k-th one with probability proportional to 1 / (k + 1) ** skew.
+    Skew 0 draws all of them uniformly, skew around 1 is typical for the popularity of user agents.
+    """
+    def __init__(self, number_of_keys, skew=0.0, rng=random):
+        self.rng = rng
+        self.cumulative = []
+        total = 0.0
+
+        for k in xrange(number_of_keys):
+            total += 1.0 / (k + 1) ** skew
+            self.cumulative.append(total)
+
+    def __call__(self):
+        return bisect.bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1])
+
+
+class NoTransaction(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def get_first_moment(now, months):
+    """
+    Returns the beginning of the month months - 1 before the month of now.
+    """
+    first = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    for _ in xrange(months - 1):
+        first = (first - timedelta(days=1)).replace(day=1)
+
+    return first
+
+
+def generate_load(worker_index, rows, keys=1000, skew=0.0, months=1, bulk_size=1, commit='rollback', seed=0):
+    """
+    Writes the rows events spread over the recent months, each referencing one of keys browsers
+    chosen by ZipfSampler. Events are inserted one by one with bulk_size 1, otherwise in bulks of
+    bulk_size rows by PartitionedBulkWriter.
+
+    With commit 'rollback' all is done in one transaction rolled back in the end, with 'batch'
+    every bulk (or row) is committed in its own transaction, with 'autocommit' every query is.
+
+    Returns the dict of the rows written, the seconds spent and the lists of the lookup latencies
+    and of the insert latencies (of every bulk), in seconds.
+    """
+    rng = random.Random(seed * 1000 + worker_index)
+    sample_key = ZipfSampler(keys, skew, rng)
+    now = timezone.now()
+    spread_seconds = (now - get_first_moment(now, months)).total_seconds()
+
+    lookups, inserts = [], []
+    started = time.time()
+
+    with transaction.atomic() if commit == 'rollback' else NoTransaction():
+        for start in xrange(0, rows, bulk_size):
+            batch = []
+
+            for i in xrange(start, min(start + bulk_size, rows)):
+                timestamp = now - timedelta(seconds=rng.random() * spread_seconds)
+
+                lookup_started = time.time()
+                browser_id = Browser.partition_for_timestamp(timestamp).get_or_create_cached_pk_for(
+                    ua='loadgen-%d' % sample_key(),
+                )
+                lookups.append(time.time() - lookup_started)
+
+                batch.append({'timestamp': timestamp, 'browser_id': browser_id})
+
+            insert_started = time.time()
+
+            with transaction.atomic() if commit == 'batch' else NoTransaction():
+                if bulk_size == 1:
+                    Event.partition_for_timestamp(batch[0]['timestamp']).objects.create(**batch[0])
+                else:
+                    with PartitionedBulkWriter(Event, batch_size=bulk_size) as writer:
+                        writer.add_many(batch)
+
+            inserts.append(time.time() - insert_started)
+
+        if commit == 'rollback':
+            transaction.set_rollback(True)
+
+    return {
+        'rows': rows,
+        'seconds': time.time() - started,
+        'lookups': lookups,
+        'inserts': inserts,
+    }
+
+
+def run_worker(args):
+    # The connections inherited from the parent process must not be shared.
+    connections.close_all()
+
+    try:
+        return generate_load(*args[:2], **args[2])
+    finally:
+        connections.close_all()
+
+
+def run_load(rows, workers=1, **options):
+    """
+    Runs generate_load() in the number of worker processes, splitting the rows among them,
+    and returns the report dict with the throughput and the latency percentiles in milliseconds.
+    A single worker runs in this process, which is what an in-memory SQLite database needs.
+
+    >>> run_load(100000, workers=4, keys=10000, skew=1.1, months=3, bulk_size=500, commit='batch')
+    {'rows': 100000, 'seconds': 21.4, 'rows_per_second': 4672.9, 'lookup_ms': {'p50': 0.01, ...}, ...}
+    """
+    if options.get('commit', 'rollback') not in COMMIT_MODES:
+        raise RuntimeError("Unsupported commit mode %r" % options['commit'])
+
+    # Partitions are created up front, not by the workers racing each other.
+    for months_ago in xrange(options.get('months', 1)):
+        Event.ensure_partition(-months_ago)
+
+    shares = [rows // workers + (1 if i < rows % workers else 0) for i in xrange(workers)]
+    started = time.time()
+
+    if workers == 1:
+        results = [generate_load(0, rows, **options)]
+    else:
+        connections.close_all()
+        pool = multiprocessing.Pool(workers)
+
+        try:
+            results = pool.map(run_worker, [(i, share, options) for i, share in enumerate(shares)])
+        finally:
+            pool.close()
+            pool.join()
+
+    seconds = time.time() - started
+
+    if options.get('commit', 'rollback') == 'rollback':
+        # The cached primary keys of the rolled back browsers.
+        for months_ago in xrange(options.get('months', 1)):
+            Browser.ensure_partition(-months_ago).bump_gocpk_generation()
+
+    report = {
+        'rows': sum(result['rows'] for result in results),
+        'workers': workers,
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds else None,
+    }
+
+    for name in ('lookups', 'inserts'):
+        latencies = sorted(latency for result in results for latency in result[name])
+        report[name[:-1] + '_ms'] = dict(
+            ('p%d' % percent, percentile(latencies, percent) * 1e3 if latencies else None)
+            for percent in (50, 95, 99)
+        )
+
+    return report
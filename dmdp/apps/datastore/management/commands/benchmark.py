@@ -0,0 +1,100 @@
+import json
+import os
+import platform
+import subprocess
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from dmdp.apps.datastore.benchmarks import bench_suite
+
+
+def get_revision():
+    """
+    Returns the git commit of the source tree, if it is a git checkout.
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w'),
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the benchmark suite of the partitioning machinery and prints the results as JSON. "
+        "Use --settings=dmdp.settings_bench to run it against an in-memory SQLite database; "
+        "it refuses any other one unless --allow-live-db is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--number', type=int, default=10000,
+            help="Repetitions of the CPU-bound operations.",
+        )
+        parser.add_argument(
+            '--db-number', type=int, default=1000,
+            help="Repetitions of the operations hitting the database.",
+        )
+        parser.add_argument(
+            '--output',
+            help="File to write the JSON results to, instead of the standard output.",
+        )
+        parser.add_argument(
+            '--baseline',
+            help="JSON results of an earlier run to compare with, the comparison goes to the standard error.",
+        )
+        parser.add_argument(
+            '--allow-live-db', action='store_true',
+            help="Run against databases without BENCHMARK_THROWAWAY_DATABASE in the settings. "
+                 "The recent partition tables get created and their cached keys invalidated.",
+        )
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'BENCHMARK_THROWAWAY_DATABASE', False) and not options['allow_live_db']:
+            raise CommandError(
+                "The benchmarks create partition tables and invalidate the cached keys of the partitions. "
+                "Use --settings=dmdp.settings_bench, or --allow-live-db to run against %s anyway." % (
+                    connection.settings_dict['NAME'],
+                )
+            )
+
+        baseline = None
+        if options['baseline']:
+            try:
+                with open(options['baseline']) as f:
+                    baseline = dict((result['name'], result) for result in json.load(f)['results'])
+            except (IOError, ValueError, KeyError) as e:
+                raise CommandError("Cannot read baseline %s: %s" % (options['baseline'], e))
+
+        report = {
+            'revision': get_revision(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'results': bench_suite(options['number'], options['db_number']),
+        }
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        if baseline is not None:
+            for result in report['results']:
+                before = baseline.get(result['name'])
+
+                if before is None:
+                    change = 'new'
+                else:
+                    change = '%+.1f%%' % (100.0 * (result['per_op_us'] - before['per_op_us']) / before['per_op_us'])
+
+                self.stderr.write('%-46s %12.2f us %10s' % (result['name'], result['per_op_us'], change))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from dmdp.apps.datastore.benchmarks import bench_goccache_key
+from dmdp.apps.datastore.models import Browser
+
+
+class Command(BaseCommand):
+    help = "Shows the per-call cost of building the GocPk cache keys."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--number', type=int, default=100000,
+            help="Keys built per measurement.",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('%-12s %-9s %11s  %s' % ('case', 'variant', 'per call us', 'key'))
+
+        for result in bench_goccache_key(Browser.YM(), options['number']):
+            self.stdout.write('%(case)-12s %(variant)-9s %(per_call_us)11.2f  %(key)s' % result)
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from dmdp.apps.datastore.benchmarks import bench_hashing
+
+
+class Command(BaseCommand):
+    help = "Compares per-key routing cost and distribution uniformity of the hashing strategies."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--partitions', type=int, nargs='+', default=[5, 64, 1024],
+            help="Partition counts to measure.",
+        )
+        parser.add_argument(
+            '--keys', type=int, default=100000,
+            help="Number of distinct keys to route.",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            '%-20s %10s %10s %12s %14s %8s' % (
+                'strategy', 'partitions', 'setup ms', 'per key us', 'max load ratio', 'load cv',
+            )
+        )
+
+        for result in bench_hashing(options['partitions'], options['keys']):
+            self.stdout.write(
+                '%(strategy)-20s %(partitions)10d %(setup_ms)10.1f %(per_key_us)12.2f '
+                '%(max_load_ratio)14.3f %(load_cv)8.3f' % result
+            )
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from dmdp.apps.datastore.benchmarks import bench_startup
+
+
+class Command(BaseCommand):
+    help = "Shows the import time cost of a monthly partitioned model as its history grows."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--years', type=int, nargs='+', default=[1, 5, 10, 20],
+            help="History lengths to measure.",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            '%13s %10s %12s %19s' % ('history years', 'partitions', 'decorate ms', 'materialize all ms')
+        )
+
+        for result in bench_startup(options['years']):
+            self.stdout.write(
+                '%(history_years)13d %(partitions)10d %(decorate_ms)12.2f %(materialize_all_ms)19.1f' % result
+            )
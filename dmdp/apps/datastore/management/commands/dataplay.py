@@ -1,24 +1,106 @@
-from collections import defaultdict
 from datetime import timedelta
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.db.transaction import atomic
 from django.utils import timezone
 
+from dmdp.apps.datastore.bulk import PartitionedBulkWriter
+from dmdp.apps.datastore.loadgen import COMMIT_MODES, run_load
 from dmdp.apps.datastore.models import Event, Browser, Session, Action
+from dmdp.apps.datastore.partitions import table_exists
+
+
+def format_value(format, value):
+    """
+    Formats the measured value, None when there were no samples.
+    """
+    return 'n/a' if value is None else format % value
 
 
 class Command(BaseCommand):
-    help = "Plays with partitions a bit."
+    help = (
+        "Plays with partitions a bit. "
+        "With --rows, generates the load of that many events instead and reports throughput and latencies."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows', type=int,
+            help="Number of events to write by the load generator.",
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help="Number of worker processes writing the events.",
+        )
+        parser.add_argument(
+            '--keys', type=int, default=1000,
+            help="Number of distinct browsers the events reference.",
+        )
+        parser.add_argument(
+            '--skew', type=float, default=0.0,
+            help="Zipf exponent of the browser popularity, 0 for uniform.",
+        )
+        parser.add_argument(
+            '--months', type=int, default=1,
+            help="Number of recent months the events are spread over.",
+        )
+        parser.add_argument(
+            '--bulk-size', type=int, default=1,
+            help="Events inserted at once, 1 to insert them one by one.",
+        )
+        parser.add_argument(
+            '--commit', choices=COMMIT_MODES, default='rollback',
+            help="Roll everything back in the end, commit every bulk, or let every query autocommit.",
+        )
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help="Seed of the random choices, so the same load can be reproduced.",
+        )
 
     def out(self, msg=None):
         self.stdout.write(
             self.style.SUCCESS(msg) if msg else self.style.NOTICE('------------------------')
         )
 
-    @atomic
     def handle(self, *args, **options):
+        if options['rows'] is None:
+            self.play()
+        else:
+            self.play_load(options)
+
+    def play_load(self, options):
+        if min(options['rows'], options['workers'], options['bulk_size'], options['keys'], options['months']) < 1:
+            raise CommandError("Rows, workers, bulk size, keys and months must all be positive.")
+
+        report = run_load(
+            options['rows'],
+            workers=options['workers'],
+            keys=options['keys'],
+            skew=options['skew'],
+            months=options['months'],
+            bulk_size=options['bulk_size'],
+            commit=options['commit'],
+            seed=options['seed'],
+        )
+
+        self.out("%d events by %d workers in %.2f s: %s rows/s" % (
+            report['rows'], report['workers'], report['seconds'], format_value('%.0f', report['rows_per_second']),
+        ))
+
+        for name, latencies in (
+            ('lookup', report['lookup_ms']),
+            ('insert of %d rows' % options['bulk_size'], report['insert_ms']),
+        ):
+            self.out("%s latency: p50 %s, p95 %s, p99 %s" % (
+                name,
+                format_value('%.3f ms', latencies['p50']),
+                format_value('%.3f ms', latencies['p95']),
+                format_value('%.3f ms', latencies['p99']),
+            ))
+
+    @atomic
+    def play(self):
         # So SQL commands gets logged to console.
         settings.DEBUG = True
 
@@ -81,28 +163,26 @@ class Command(BaseCommand):
 
         # In bulk
 
-        bulks = defaultdict(list)
-
-        for day in self.iter_last_days(50):
-            browser_id = Browser.YM(day).get_or_create_cached_pk_for(ua='Curl')
-
-            EventYM = Event.YM(day)
-            bulks[EventYM].append(
-                EventYM(
-                    timestamp=day,
-                    browser_id=browser_id,
-                )
-            )
-
-        for model, items in bulks.items():
-            model.objects.bulk_create(items)
+        with PartitionedBulkWriter(Event) as writer:
+            for day in self.iter_last_days(50):
+                writer.add({
+                    'timestamp': day,
+                    'browser_id': Browser.YM(day).get_or_create_cached_pk_for(ua='Curl'),
+                })
 
         self.out()
 
         for BrowserYM, EventYM in zip(Browser.iter_YMs(), Event.iter_YMs()):
+            if not table_exists(EventYM):
+                # Aged out by the partition_retention management command.
+                continue
+
             self.out('%s - %s items' % (BrowserYM._meta.object_name, BrowserYM.objects.count()))
             self.out('%s - %s items' % (EventYM._meta.object_name, EventYM.objects.count()))
 
+        self.out('Browser - %s items in total' % Browser.across().count())
+        self.out('Event - %s items in total' % Event.across().count())
+
         self.out()
 
     def play_range_many(self):
@@ -121,22 +201,15 @@ class Command(BaseCommand):
 
         # In bulk
 
-        bulks = defaultdict(list)
-
-        for website_id in xrange(15):
-            session_id = Session.partition(website_id).get_or_create_cached_pk_for(
-                website_id=website_id,
-            )
-
-            ActionP = Action.partition(website_id)
-            bulks[ActionP].append(
+        for ActionP, website_ids in Action.partition_many(xrange(15)).items():
+            ActionP.objects.bulk_create([
                 ActionP(
-                    session_id=session_id,
+                    session_id=Session.partition(website_id).get_or_create_cached_pk_for(
+                        website_id=website_id,
+                    ),
                 )
-            )
-
-        for model, items in bulks.items():
-            model.objects.bulk_create(items)
+                for website_id in website_ids
+            ])
 
         self.out()
 
@@ -144,4 +217,7 @@ class Command(BaseCommand):
             self.out('%s - %s items' % (SessionP._meta.object_name, SessionP.objects.count()))
             self.out('%s - %s items' % (ActionP._meta.object_name, ActionP.objects.count()))
 
+        self.out('Session - %s items in total' % Session.across().count())
+        self.out('Action - %s items in total' % Action.across().count())
+
         self.out()
@@ -0,0 +1,7 @@
+from django.core.management.commands import flush
+
+from dmdp.apps.datastore.partitions import MaterializePartitionsMixin
+
+
+class Command(MaterializePartitionsMixin, flush.Command):
+    runtime_partitions = True
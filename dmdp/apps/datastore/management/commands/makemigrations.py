@@ -0,0 +1,28 @@
+from django.core.management.commands import makemigrations
+
+from dmdp.apps.datastore.operations import CreatePartitionSet, collapse_partition_sets
+from dmdp.apps.datastore.partitions import MaterializePartitionsMixin
+
+
+class Command(MaterializePartitionsMixin, makemigrations.Command):
+    """
+    The partitions of every partitioned model are written as a single CreatePartitionSet operation.
+    """
+    def handle(self, *args, **options):
+        self.migration_name = options.get('name')
+        return super(Command, self).handle(*args, **options)
+
+    def write_migration_files(self, changes):
+        for app_migrations in changes.values():
+            for migration in app_migrations:
+                migration.operations = collapse_partition_sets(migration.operations)
+
+                if not self.migration_name and all(
+                    isinstance(operation, CreatePartitionSet) for operation in migration.operations
+                ):
+                    migration.name = '%s_%s_partitions' % (
+                        migration.name.split('_', 1)[0],
+                        '_'.join(sorted(operation.name.lower() for operation in migration.operations)),
+                    )
+
+        return super(Command, self).write_migration_files(changes)
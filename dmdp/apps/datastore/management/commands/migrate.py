@@ -0,0 +1,7 @@
+from django.core.management.commands import migrate
+
+from dmdp.apps.datastore.partitions import MaterializePartitionsMixin
+
+
+class Command(MaterializePartitionsMixin, migrate.Command):
+    pass
@@ -0,0 +1,86 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dmdp.apps.datastore import models
+from dmdp.apps.datastore.retention import (
+    ARCHIVE_FORMATS, archive_partition, get_expired_partitions, get_monthly_partitioned_models,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Archives the monthly partitions older than the retention window to compressed files "
+        "and drops their tables."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'keep_months', type=int,
+            help="Number of the most recent months kept, the current month included.",
+        )
+        parser.add_argument(
+            '--models', nargs='+', metavar='MODEL',
+            help="Monthly partitioned models to age out, all of them by default.",
+        )
+        parser.add_argument(
+            '--directory', default='.',
+            help="Directory the archives are written to.",
+        )
+        parser.add_argument(
+            '--format', choices=ARCHIVE_FORMATS, default='ndjson',
+            help="Archive format, gzipped in any case.",
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=10000,
+            help="Rows read from the database at once.",
+        )
+        parser.add_argument(
+            '--keep-tables', action='store_true',
+            help="Only write the archives, do not drop anything.",
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Only list the expired partitions.",
+        )
+
+    def handle(self, *args, **options):
+        if options['models']:
+            try:
+                base_models = [getattr(models, name) for name in options['models']]
+            except AttributeError as e:
+                raise CommandError(e)
+        else:
+            base_models = get_monthly_partitioned_models()
+
+        if not os.path.isdir(options['directory']):
+            raise CommandError("Directory %s does not exist." % options['directory'])
+
+        try:
+            expired = get_expired_partitions(base_models, options['keep_months'])
+        except RuntimeError as e:
+            raise CommandError(e)
+
+        if not expired:
+            self.stdout.write("No partitions expired.")
+
+        for model in expired:
+            if options['dry_run']:
+                self.stdout.write("%s would be archived." % model._meta.db_table)
+                continue
+
+            result = archive_partition(
+                model,
+                options['directory'],
+                format=options['format'],
+                chunk_size=options['chunk_size'],
+                drop=not options['keep_tables'],
+            )
+            self.stdout.write(self.style.SUCCESS(
+                "%s: %d rows archived to %s%s." % (
+                    model._meta.db_table,
+                    result.rows,
+                    result.path,
+                    '' if options['keep_tables'] else ', table dropped',
+                )
+            ))
@@ -0,0 +1,62 @@
+import argparse
+import json
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from dmdp.apps.datastore import instrumentation
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs another management command with the per-partition query statistics enabled "
+        "and prints them afterwards, e.g.: partition_stats dataplay --rows 10000"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--json', action='store_true',
+            help="Print the statistics as JSON.",
+        )
+        parser.add_argument(
+            'command_name',
+            help="The management command to run.",
+        )
+        parser.add_argument(
+            'command_args', nargs=argparse.REMAINDER,
+            help="Its arguments and options.",
+        )
+
+    def handle(self, *args, **options):
+        instrumentation.reset_partition_stats()
+        instrumentation.enable()
+
+        exit = None
+
+        try:
+            call_command(options['command_name'], *options['command_args'])
+        except SystemExit as e:
+            # Like the dataplay demo rolling back the database; the statistics are printed anyway.
+            exit = e
+        finally:
+            instrumentation.disable()
+
+        self.print_stats(instrumentation.get_partition_stats(), options['json'])
+
+        if exit is not None and exit.code:
+            raise exit
+
+    def print_stats(self, results, as_json=False):
+        if as_json:
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+            return
+
+        self.stdout.write('%-24s %-9s %9s %9s %11s %9s %9s %9s %9s' % (
+            'partition', 'operation', 'queries', 'rows', 'total ms', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms',
+        ))
+
+        for result in results:
+            self.stdout.write(
+                '%(partition)-24s %(operation)-9s %(queries)9d %(rows)9d %(total_ms)11.2f '
+                '%(mean_ms)9.3f %(p50_ms)9.3f %(p95_ms)9.3f %(p99_ms)9.3f' % result
+            )
@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dmdp.apps.datastore import models
+from dmdp.apps.datastore.rollover import (
+    ROLLOVER_CACHE_MARGIN, ensure_partitions, get_prewarmable_models, get_prime_timeout, is_cache_shared,
+    prewarm_partition,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates the next month's partitions of all the monthly partitioned models, copies the most referenced "
+        "rows of the lookup models into them and primes the cache with them. Run it some time before the month starts. "
+        "Needs a cache backend shared by all the processes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--models', nargs='+', metavar='MODEL',
+            help="Lookup models to prewarm, all declaring gocpk_lookup_fields by default.",
+        )
+        parser.add_argument(
+            '--top', type=int, default=10000,
+            help="Number of the most referenced rows copied.",
+        )
+        parser.add_argument(
+            '--months-ahead', type=int, default=1,
+            help="The month to prewarm, relative to the current one the rows are taken from.",
+        )
+        parser.add_argument(
+            '--cache-timeout', type=int,
+            help="Seconds the primed keys stay cached, by default until %d seconds "
+                 "after the prewarmed month starts." % ROLLOVER_CACHE_MARGIN,
+        )
+
+    def handle(self, *args, **options):
+        if not is_cache_shared():
+            raise CommandError(
+                "The default cache is local to this process, the primed keys would reach no other one. "
+                "Configure a shared cache backend, e.g. memcached, in CACHES."
+            )
+
+        if options['models']:
+            try:
+                base_models = [getattr(models, name) for name in options['models']]
+            except AttributeError as e:
+                raise CommandError(e)
+        else:
+            base_models = get_prewarmable_models()
+
+        cache_timeout = options['cache_timeout']
+        if cache_timeout is None:
+            cache_timeout = get_prime_timeout(options['months_ahead'])
+
+        for model in ensure_partitions(options['months_ahead']):
+            self.stdout.write("%s: table ready." % model._meta.db_table)
+
+        for base_model in base_models:
+            try:
+                result = prewarm_partition(
+                    base_model,
+                    top=options['top'],
+                    target_ym=options['months_ahead'],
+                    cache_timeout=cache_timeout,
+                )
+            except RuntimeError as e:
+                raise CommandError(e)
+
+            self.stdout.write(self.style.SUCCESS(
+                "%s: %d rows copied, %d keys cached for %d s." % (
+                    result.model._meta.object_name,
+                    result.copied,
+                    result.cached,
+                    cache_timeout,
+                )
+            ))
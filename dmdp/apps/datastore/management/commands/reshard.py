@@ -0,0 +1,74 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dmdp.apps.datastore import models
+from dmdp.apps.datastore.resharding import plan_reshard, reshard
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the rows of a range partitioned model (and of the models referencing it) "
+        "into the partitions its grown number of partitions places them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'model',
+            help="The range partitioned model, already declared with the new number of partitions.",
+        )
+        parser.add_argument(
+            'key_field',
+            help="The field holding the key the rows are partitioned by.",
+        )
+        parser.add_argument(
+            '--from', dest='old_number_of_partitions', type=int, required=True,
+            help="The number of partitions before.",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help="Keys moved in one transaction.",
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Only show how many keys would move between which partitions.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            base_model = getattr(models, options['model'])
+        except AttributeError as e:
+            raise CommandError(e)
+
+        try:
+            if options['dry_run']:
+                moves = plan_reshard(base_model, options['old_number_of_partitions'], options['key_field'])
+            else:
+                result = reshard(
+                    base_model,
+                    options['old_number_of_partitions'],
+                    options['key_field'],
+                    batch_size=options['batch_size'],
+                    progress=self.progress,
+                )
+        except RuntimeError as e:
+            raise CommandError(e)
+
+        if options['dry_run']:
+            for (old_index, new_index), keys in sorted(Counter(
+                (move.old_index, move.new_index) for move in moves
+            ).items()):
+                self.stdout.write("p%d -> p%d: %d keys" % (old_index, new_index, keys))
+
+            self.stdout.write("%d keys would move." % len(moves))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                "%d keys moved, %d rows in total." % (result.keys, result.rows)
+            ))
+
+    def progress(self, moved_keys, total_keys, moved_rows):
+        self.stdout.write(
+            "%d/%d keys (%.1f%%), %d rows moved" % (
+                moved_keys, total_keys, 100.0 * moved_keys / total_keys, moved_rows,
+            )
+        )
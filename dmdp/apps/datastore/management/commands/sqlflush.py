@@ -0,0 +1,7 @@
+from django.core.management.commands import sqlflush
+
+from dmdp.apps.datastore.partitions import MaterializePartitionsMixin
+
+
+class Command(MaterializePartitionsMixin, sqlflush.Command):
+    runtime_partitions = True
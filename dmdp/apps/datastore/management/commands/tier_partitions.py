@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dmdp.apps.datastore import models
+from dmdp.apps.datastore.tiering import TIERING_CHUNK_SIZE, get_cold_months, get_tiers, move_partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the monthly partitions no longer hot from the hot database to the archive one, "
+        "by settings.PARTITION_TIERING. Run it e.g. daily from cron; the months moved must no longer be written to. "
+        "An interrupted run is resumed by running it again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--models', nargs='+', metavar='MODEL',
+            help="Tiered models to move the partitions of, all of them by default.",
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=TIERING_CHUNK_SIZE,
+            help="Rows copied at once.",
+        )
+        parser.add_argument(
+            '--wait', type=float,
+            help="Seconds between the copy and the drop of the hot tables, "
+                 "for the other processes to notice the move; TIERING_LOCATION_TTL by default.",
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Only list the months to be moved.",
+        )
+
+    def handle(self, *args, **options):
+        tiers = get_tiers()
+
+        if options['models']:
+            try:
+                base_models = [getattr(models, name) for name in options['models']]
+            except AttributeError as e:
+                raise CommandError(e)
+
+            for base_model in base_models:
+                if base_model not in tiers:
+                    raise CommandError("%s is not in PARTITION_TIERING." % base_model._meta.object_name)
+        else:
+            base_models = list(tiers)
+
+        for base_model in base_models:
+            tier = tiers[base_model]
+            cold_months = get_cold_months(base_model)
+
+            if not cold_months:
+                self.stdout.write("%s: no months to move." % base_model._meta.object_name)
+
+            for year, month in cold_months:
+                if options['dry_run']:
+                    self.stdout.write("%s %04d-%02d would be moved from %s to %s." % (
+                        base_model._meta.object_name, year, month, tier.hot, tier.archive,
+                    ))
+                    continue
+
+                try:
+                    results = move_partitions(
+                        base_model, year, month,
+                        chunk_size=options['chunk_size'],
+                        wait=options['wait'],
+                    )
+                except RuntimeError as e:
+                    raise CommandError(e)
+
+                for result in results:
+                    self.stdout.write(self.style.SUCCESS(
+                        "%s: %d rows moved from %s to %s in %.2f s." % (
+                            result.model._meta.db_table, result.rows, tier.hot, tier.archive, result.seconds,
+                        )
+                    ))
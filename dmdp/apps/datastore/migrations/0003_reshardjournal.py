@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datastore', '0002_auto_20170123_1618'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReshardJournal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table', models.CharField(max_length=100)),
+                ('old_index', models.IntegerField()),
+                ('new_index', models.IntegerField()),
+                ('copies', models.TextField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='reshardjournal',
+            unique_together=set([('table', 'old_index', 'new_index')]),
+        ),
+    ]
@@ -13,6 +13,13 @@ class Browser(models.Model, caching.GocPkCacheMixin):
     ua = models.CharField(max_length=100, unique=True)
     some_value = models.IntegerField(default=0)
 
+    gocpk_lookup_fields = ('ua',)
+    # The few hottest user agents appear in most of the events.
+    gocpk_local_cache_size = 10000
+    gocpk_local_cache_ttl = 300
+    # A new user agent is seen by all the workers at once.
+    gocpk_single_flight = True
+
     class Meta:
         abstract = True
 
@@ -49,3 +56,18 @@ class Action(models.Model):
 
     class Meta:
         abstract = True
+
+
+class ReshardJournal(models.Model):
+    """
+    The rows a reshard() batch copied into a partition in another database, the originals of which
+    are not deleted yet. Stored in the database of the copies, committed along with them.
+    """
+    table = models.CharField(max_length=100)
+    old_index = models.IntegerField()
+    new_index = models.IntegerField()
+    # JSON list of [base model label, old primary keys, new primary keys].
+    copies = models.TextField()
+
+    class Meta:
+        unique_together = ('table', 'old_index', 'new_index')
@@ -0,0 +1,209 @@
+import re
+
+from django.db import migrations, models
+from django.db.migrations.operations.base import Operation
+from django.utils import six
+
+from . import partitions
+
+# The placeholder in ForeignKey targets replaced by the partition name suffix, like 2016_10 or p3.
+PARTITION_PLACEHOLDER = '%(partition)s'
+
+MONTHLY_PARTITION_RE = re.compile(r'^(?P<base>\w+)_(?P<year>\d{4})_(?P<month>\d{2})$')
+RANGE_PARTITION_RE = re.compile(r'^(?P<base>\w+)_p(?P<index>\d+)$')
+
+
+class CreatePartitionSet(Operation):
+    """
+    Creates a whole set of partition models of a partitioned model at once,
+    the same way as separate CreateModel operations would do.
+    Monthly partitions are given by months, range partitions by indexes.
+    ForeignKey targets may contain the '%(partition)s' placeholder to point to the same partition.
+
+        CreatePartitionSet(
+            name='Event',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('browser', models.ForeignKey(to='datastore.Browser_%(partition)s', related_name='event_set')),
+            ],
+            months=[(2016, 10), (2016, 11), (2016, 12)],
+        )
+    """
+    reduces_to_sql = True
+    reversible = True
+
+    serialization_expand_args = ['fields', 'months', 'indexes', 'options']
+
+    def __init__(self, name, fields, months=None, indexes=None, options=None, bases=None, managers=None):
+        self.name = name
+        self.fields = fields
+        self.months = months or []
+        self.indexes = indexes or []
+        self.options = options or {}
+        self.bases = bases
+        self.managers = managers
+        self._create_models = None
+
+    def iter_partitions(self):
+        """
+        Yields (name suffix, verbose name) of every partition, as the partitioning decorators make them.
+        """
+        for year, month in self.months:
+            yield '%04d_%02d' % (year, month), '%s (%04d/%02d)' % (self.name, year, month)
+
+        for part_index in self.indexes:
+            yield 'p%d' % part_index, '%s (part %d)' % (self.name, part_index)
+
+    @property
+    def create_models(self):
+        """
+        The CreateModel operation of every partition.
+        """
+        if self._create_models is None:
+            self._create_models = [
+                migrations.CreateModel(
+                    name='%s_%s' % (self.name, suffix),
+                    fields=[
+                        (field_name, make_partition_field(field, suffix))
+                        for field_name, field in self.fields
+                    ],
+                    options=dict(self.options, verbose_name=verbose_name, verbose_name_plural=verbose_name),
+                    bases=self.bases,
+                    managers=self.managers,
+                )
+                for suffix, verbose_name in self.iter_partitions()
+            ]
+
+        return self._create_models
+
+    def state_forwards(self, app_label, state):
+        for operation in self.create_models:
+            operation.state_forwards(app_label, state)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        for operation in self.create_models:
+            operation.database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        for operation in reversed(self.create_models):
+            operation.database_backwards(app_label, schema_editor, from_state, to_state)
+
+    def describe(self):
+        return "Create %d partitions of model %s" % (len(self.create_models), self.name)
+
+    def references_model(self, name, app_label=None):
+        return any(
+            operation.references_model(name, app_label)
+            for operation in self.create_models
+        )
+
+
+def make_partition_field(field, suffix):
+    """
+    Returns the copy of the field, with the placeholder in its ForeignKey target replaced by the suffix.
+    """
+    name, path, args, kwargs = field.deconstruct()
+    target = kwargs.get('to')
+
+    if isinstance(target, six.string_types) and PARTITION_PLACEHOLDER in target:
+        kwargs['to'] = target.replace(PARTITION_PLACEHOLDER, suffix)
+
+    return field.__class__(*args, **kwargs)
+
+
+def get_partition_template(operation, suffix):
+    """
+    Returns the fields of the CreateModel operation of the partition,
+    with the ForeignKey targets to the same partition turned into the placeholder,
+    and its deconstructed form used to compare partitions to each other.
+    """
+    fields, comparable = [], []
+
+    for field_name, field in operation.fields:
+        name, path, args, kwargs = field.deconstruct()
+        target = kwargs.get('to')
+
+        if isinstance(target, six.string_types) and target.lower().endswith('_' + suffix):
+            kwargs['to'] = target[:-len(suffix)] + PARTITION_PLACEHOLDER
+
+        fields.append((field_name, field.__class__(*args, **kwargs)))
+        comparable.append((field_name, path, args, sorted(kwargs.items())))
+
+    options = dict(operation.options)
+    options.pop('verbose_name', None)
+    options.pop('verbose_name_plural', None)
+
+    return fields, (comparable, sorted(options.items()), operation.bases, operation.managers)
+
+
+def collapse_partition_sets(operations):
+    """
+    Replaces the CreateModel operations of the partitions of every partitioned model
+    with a single CreatePartitionSet, placed where the last of them was.
+    Partitions that do not share the same definition are left alone.
+    """
+    partitioned_names = set(base_model._meta.object_name for base_model in partitions.partitioned_models)
+    groups = {}
+
+    for position, operation in enumerate(operations):
+        if not isinstance(operation, migrations.CreateModel):
+            continue
+
+        match = MONTHLY_PARTITION_RE.match(operation.name) or RANGE_PARTITION_RE.match(operation.name)
+        if match is None or match.group('base') not in partitioned_names:
+            continue
+
+        groups.setdefault(match.group('base'), []).append((position, match, operation))
+
+    replaced = {}
+
+    for base, members in groups.items():
+        if len(members) < 2:
+            continue
+
+        months, indexes, templates = [], [], []
+
+        for position, match, operation in members:
+            if 'index' in match.groupdict():
+                indexes.append(int(match.group('index')))
+                suffix = 'p%s' % match.group('index')
+            else:
+                months.append((int(match.group('year')), int(match.group('month'))))
+                suffix = '%s_%s' % (match.group('year'), match.group('month'))
+
+            templates.append(get_partition_template(operation, suffix))
+
+        if months and indexes or any(comparable != templates[0][1] for fields, comparable in templates):
+            continue
+
+        first = members[0][2]
+        kwargs = {
+            'name': base,
+            'fields': templates[0][0],
+            'months': sorted(months),
+            'indexes': sorted(indexes),
+            'options': dict(templates[0][1][1]),
+            'bases': first.bases if first.bases != (models.Model,) else None,
+            'managers': first.managers,
+        }
+        # Only the arguments that matter get written into the migration.
+        partition_set = CreatePartitionSet(**dict((k, v) for k, v in kwargs.items() if v))
+
+        if any(
+            (expected.name, expected.options) != (operation.name, operation.options)
+            for expected, operation in zip(
+                sorted(partition_set.create_models, key=lambda o: o.name),
+                sorted((operation for position, match, operation in members), key=lambda o: o.name),
+            )
+        ):
+            continue
+
+        for position, match, operation in members:
+            replaced[position] = None
+        replaced[members[-1][0]] = partition_set
+
+    return [
+        replaced.get(position, operation)
+        for position, operation in enumerate(operations)
+        if replaced.get(position, operation) is not None
+    ]
@@ -1,9 +1,32 @@
 import datetime
+import threading
+from collections import defaultdict
 
 from django.conf import settings
-from django.db.models import ForeignKey
+from django.db import DatabaseError, connections, router
+from django.db.models import DateTimeField, ForeignKey
+from django.db.transaction import atomic, on_commit
 from django.utils import timezone
-from useful.consistent_hash import ConsistentHashRing
+
+from .hashing import ConsistentHashRing
+from .query import CrossPartitionQuerySet
+
+# How many routed keys a range partitioned model remembers in its recent lookup table;
+# when it is full, it replaces the older one, so only the keys not used since are forgotten.
+PARTITION_LOOKUP_TABLE_SIZE = 100000
+
+# (database alias, table name) pairs known to exist, see ensure_table().
+known_tables = set()
+
+# All the base models decorated to be partitioned, in order of their declaration.
+partitioned_models = []
+
+# Maps the target partitioned base model to the functions materializing the same partition
+# of the models referencing it via ForeignKeyToPartition, so reverse relations always exist.
+partition_dependents = defaultdict(list)
+
+# Partition models are materialized one at a time.
+materialize_lock = threading.RLock()
 
 
 class ForeignKeyToPartition(object):
@@ -41,7 +64,7 @@ def resolve_month(ym):
     if isinstance(ym, (tuple, list)):
         y, m = ym
     elif isinstance(ym, (datetime.datetime, datetime.date)):
-        y, m = ym.year, ym.month-1
+        y, m = ym.year, ym.month
     elif isinstance(ym, int) or ym is None:
         today = timezone.now()
         y, m = today.year, today.month + (ym or 0)
@@ -51,6 +74,175 @@ def resolve_month(ym):
     return y*12 + m
 
 
+def iter_referencing_fields(base_model):
+    """
+    Yields (referencing base model, field name) of every ForeignKeyToPartition targeting the partitioned base model.
+
+    >>> list(iter_referencing_fields(Session))
+    [(<class '...Action'>, 'session')]
+    """
+    for referencing_model in partitioned_models:
+        for field_name, proxy in referencing_model.__dict__.items():
+            if isinstance(proxy, ForeignKeyToPartition) and proxy.target_partitioned_model is base_model:
+                yield referencing_model, field_name
+
+
+def get_partitioned_model(app_label, name):
+    """
+    Returns the partitioned base model of the app by its case insensitive name, None if there is none.
+    """
+    for base_model in partitioned_models:
+        if base_model._meta.app_label == app_label and base_model._meta.object_name.lower() == name.lower():
+            return base_model
+
+
+def get_target_models(base_model):
+    """
+    Returns the set of the partitioned base models not referencing any other,
+    whose partitions the ones of base_model are tied to via ForeignKeyToPartition (itself if none).
+
+    >>> get_target_models(Event)
+    set([<class '...Browser'>])
+    """
+    targets = set()
+
+    for proxy in base_model.__dict__.values():
+        if isinstance(proxy, ForeignKeyToPartition):
+            targets.update(get_target_models(proxy.target_partitioned_model))
+
+    return targets or set([base_model])
+
+
+def parse_partition_table_month(base_model, table_name):
+    """
+    Returns the (year, month) tuple of the partition of the monthly partitioned base model
+    the table name belongs to, None if it is no such table.
+
+    >>> parse_partition_table_month(Event, 'datastore_event_2016_10')
+    (2016, 10)
+    """
+    prefix = base_model._meta.db_table + '_'
+
+    if table_name.startswith(prefix):
+        year, _, month = table_name[len(prefix):].partition('_')
+
+        if len(year) == 4 and len(month) == 2 and (year + month).isdigit():
+            return int(year), int(month)
+
+
+def materialize_all_partitions(using=None):
+    """
+    Materializes the partition models of all the partitioned models in their whole declared ranges.
+    Partition models are otherwise only created on their first use, so this is needed by anything
+    inspecting all of them at once, e.g. the makemigrations and migrate management commands.
+    When the database alias is given, the monthly partitions whose tables exist there are materialized too,
+    e.g. those created by ensure_partition() beyond the declared ranges, for the flush management command.
+    """
+    table_names = set(connections[using].introspection.table_names()) if using else set()
+
+    for base_model in partitioned_models:
+        if hasattr(base_model, 'iter_YMs'):
+            list(base_model.iter_YMs(base_model.partitions_start_ym, base_model.partitions_end_ym))
+
+            for table_name in table_names:
+                ym = parse_partition_table_month(base_model, table_name)
+                if ym is not None:
+                    base_model.materialize_partition(*ym)
+        else:
+            list(base_model.iter_partitions())
+
+
+class MaterializePartitionsMixin(object):
+    """
+    For the management commands inspecting all the models: as partition models are created lazily,
+    all of them are materialized by materialize_all_partitions() before the command runs.
+    With runtime_partitions true, also the monthly partitions whose tables exist in the database of the command
+    (its database option), such as those created at runtime beyond the declared ranges.
+    Migrations only ever cover the declared ranges.
+    """
+    runtime_partitions = False
+
+    def handle(self, *args, **options):
+        materialize_all_partitions(using=options['database'] if self.runtime_partitions else None)
+        return super(MaterializePartitionsMixin, self).handle(*args, **options)
+
+
+def is_table_known(model, using=None):
+    """
+    Tells whether the table of the model is known to exist, without querying the database.
+    """
+    return (using or router.db_for_write(model), model._meta.db_table) in known_tables
+
+
+def ensure_table(model, using=None):
+    """
+    Creates the table of the model, unless it exists already.
+    All the tables seen in the database are remembered, so only the first call per database queries it
+    (the first one after the transaction commits, within one).
+    The database is the one the model is routed to, unless using is given.
+    """
+    if is_table_known(model, using):
+        return
+
+    db = using or router.db_for_write(model)
+    connection = connections[db]
+    table = model._meta.db_table
+    table_names = connection.introspection.table_names()
+
+    if table not in table_names:
+        try:
+            with atomic(using=db), connection.schema_editor() as editor:
+                editor.create_model(model)
+        except DatabaseError:
+            # Some other process could have created it meanwhile.
+            if table not in connection.introspection.table_names():
+                raise
+
+    remember_tables(db, set(table_names) | {table})
+
+
+def remember_tables(db, table_names):
+    """
+    Adds the tables to known_tables, once the current transaction of the database commits if there is one,
+    as a rollback would undo their creation (e.g. with ATOMIC_REQUESTS).
+    """
+    def remember():
+        known_tables.update((db, t) for t in table_names)
+
+    if connections[db].in_atomic_block:
+        on_commit(remember, using=db)
+    else:
+        remember()
+
+
+def table_exists(model, using=None):
+    """
+    Tells whether the table of the model exists, querying the database only when it is not known to.
+    """
+    if is_table_known(model, using):
+        return True
+
+    db = using or router.db_for_write(model)
+    table_names = connections[db].introspection.table_names()
+    remember_tables(db, table_names)
+
+    return model._meta.db_table in table_names
+
+
+def drop_table(model, using=None):
+    """
+    Drops the table of the model, the reverse of ensure_table().
+    Tables of the models referencing it have to be dropped first.
+    The partition model itself stays, ensure_table() or ensure_partition() create its table again.
+    """
+    db = using or router.db_for_write(model)
+
+    with atomic(using=db), connections[db].schema_editor() as editor:
+        editor.delete_model(model)
+
+    known_tables.discard((db, model._meta.db_table))
+
+
 def iter_months(start_ym=None, end_ym=None):
     """
     Returns the iterator of the (year, month) tuples in range from start_ym (default taken from settings).
@@ -77,7 +269,7 @@ def iter_months(start_ym=None, end_ym=None):
         )
 
 
-def make_model_monthly_partitioned(module_globals, start_ym=None, end_ym=+6):
+def make_model_monthly_partitioned(module_globals, start_ym=None, end_ym=None):
     """
     A model-class decorator. Example:
 
@@ -87,14 +279,26 @@ def make_model_monthly_partitioned(module_globals, start_ym=None, end_ym=+6):
             class Meta:
                 abstract = True
 
-    This will dynamically create models for monthly partitions in the same module.
+    This will dynamically create models for monthly partitions in the same module,
+    from start_ym to end_ym (the current month by default), each lazily on its first use
+    (see also materialize_all_partitions).
     Then it adds static method Event.YM to quickly get appropriate partition model.
+    Static methods Event.partition_for_timestamp and Event.partition_for_timestamps
+    do the same for one datetime or for a whole batch of them, grouping them per partition.
     Also an iterator Event.iter_YMs is added to get multiple partitions.
+    Event.ensure_partition gets the partition, creating its model and table at runtime if missing,
+    so the partitions need neither be pre-created by end_ym nor migrated; the future months
+    are created that way (e.g. by the prewarm_partitions management command) rather than months ahead.
+    Event.across returns a queryset-like object spanning the partitions of the months range.
     """
     def maker(base_model_class):
         name = base_model_class._meta.object_name
 
-        for year, month in iter_months(start_ym, end_ym):
+        # Maps resolve_month() integers to partition models, so routing needs no string formatting.
+        partitions_by_month = {}
+
+        def make_partition(year, month):
+            month_index = resolve_month((year, month))
             model_name = '%s_%04d_%02d' % (name, year, month)
 
             if model_name in module_globals:
@@ -118,14 +322,51 @@ def make_model_monthly_partitioned(module_globals, start_ym=None, end_ym=+6):
                         **proxy.fk_kwargs
                     )
 
+            # Materializing the target partition materializes its dependents, this one included.
+
+            if month_index in partitions_by_month:
+                return partitions_by_month[month_index]
+
             # Dynamically create the model class in the module.
 
-            module_globals[model_name] = type(
+            module_globals[model_name] = partitions_by_month[month_index] = type(
                 model_name,
                 (base_model_class,),
                 attrs,
             )
 
+            for materialize_dependent in partition_dependents[base_model_class]:
+                materialize_dependent(year, month)
+
+            return module_globals[model_name]
+
+        def materialize(year, month, create=False):
+            """
+            Returns the partition model, creating it if it is within the declared range
+            (or whenever create is true). Returns None otherwise.
+            """
+            month_index = year*12 + month
+
+            with materialize_lock:
+                model = partitions_by_month.get(month_index)
+
+                if model is None and (create or (
+                    resolve_month(start_ym or settings.TIMESTAMP_PARTITIONING_START_YM)
+                    <= month_index <=
+                    resolve_month(end_ym)
+                )):
+                    model = make_partition(year, month)
+
+            return model
+
+        for fk_field_name, proxy in base_model_class.__dict__.items():
+            if isinstance(proxy, ForeignKeyToPartition):
+                partition_dependents[proxy.target_partitioned_model].append(materialize)
+
+        partitioned_models.append(base_model_class)
+        base_model_class.partitions_start_ym = start_ym
+        base_model_class.partitions_end_ym = end_ym
+
         def YM(year=None, month=None):
             """
             A static method to retrieve specific model for month partition.
@@ -145,12 +386,46 @@ def make_model_monthly_partitioned(module_globals, start_ym=None, end_ym=+6):
                 month = year.month
                 year = year.year
 
-            return module_globals[
-                '%s_%04d_%02d' % (name, year, month)
-            ]
+            model = partitions_by_month.get(year*12 + month) or materialize(year, month)
+
+            if model is None:
+                raise KeyError('%s_%04d_%02d' % (name, year, month))
+
+            return model
 
         base_model_class.YM = staticmethod(YM)
 
+        def partition_for_timestamp(timestamp):
+            """
+            A static method returning the partition model for the date/datetime object.
+            The same as Event.YM(timestamp), just without any argument juggling.
+            """
+            return partitions_by_month.get(timestamp.year*12 + timestamp.month) or YM(timestamp)
+
+        base_model_class.partition_for_timestamp = staticmethod(partition_for_timestamp)
+
+        def partition_for_timestamps(items, key=None):
+            """
+            A static method routing a whole batch of date/datetime objects at once.
+            Returns a dict mapping the partition model to the list of items belonging there.
+            Items are the timestamps themselves, or any row objects when key function is given:
+
+            >>> Event.partition_for_timestamps(rows, key=operator.attrgetter('timestamp'))
+            {<class '...Event_2016_11'>: [<Event ...>, ...], <class '...Event_2016_12'>: [...]}
+            """
+            by_month = defaultdict(list)
+
+            for item in items:
+                timestamp = item if key is None else key(item)
+                by_month[timestamp.year, timestamp.month].append(item)
+
+            return dict(
+                (YM(year, month), month_items)
+                for (year, month), month_items in by_month.items()
+            )
+
+        base_model_class.partition_for_timestamps = staticmethod(partition_for_timestamps)
+
         def iter_YMs(cls, start_ym=None, end_ym=None):
             """
             Gets all partitions for the model
@@ -162,12 +437,98 @@ def make_model_monthly_partitioned(module_globals, start_ym=None, end_ym=+6):
 
         base_model_class.iter_YMs = classmethod(iter_YMs)
 
+        def ensure_partition(ym=None):
+            """
+            A static method returning the partition model for the month, accepting any value
+            accepted by resolve_month(), the current month by default.
+            Unlike YM(), the partition model and its table (with all its indexes and foreign keys)
+            are created on the first use, along with the partitions referenced via ForeignKeyToPartition.
+            Known tables are remembered, so the subsequent calls cost no query.
+
+            >>> Event.ensure_partition(+1)    # creates table datastore_event_2017_01 if missing
+            <class 'dmdp.apps.datastore.models.Event_2017_01'>
+            """
+            month_index = resolve_month(ym)
+            model = partitions_by_month.get(month_index)
+
+            if model is None or not is_table_known(model):
+                year, month = divmod(month_index - 1, 12)
+
+                for fk_field_name, proxy in base_model_class.__dict__.items():
+                    if isinstance(proxy, ForeignKeyToPartition):
+                        proxy.target_partitioned_model.ensure_partition((year, month + 1))
+
+                model = materialize(year, month + 1, create=True)
+                ensure_table(model)
+
+            return model
+
+        base_model_class.ensure_partition = staticmethod(ensure_partition)
+
+        def materialize_partition(year, month):
+            """
+            A static method returning the partition model for the month, creating the model class
+            even outside of the declared range. Unlike ensure_partition(), its table is left alone.
+            """
+            return materialize(year, month, create=True)
+
+        base_model_class.materialize_partition = staticmethod(materialize_partition)
+
+        def across(start_ym=None, end_ym=None, timestamp_field=None):
+            """
+            A static method returning the lazy CrossPartitionQuerySet over the existing partitions
+            of the months from start_ym to end_ym, both included. The arguments accept any values
+            accepted by resolve_month() and default the same way as iter_months() does.
+            Partitions outside of the range are never touched, neither are the ones whose tables
+            do not exist (e.g. dropped by the partition_retention management command).
+
+            When timestamp_field is given, rows are also filtered by it
+            for the date/datetime boundaries, both included; a date boundary includes its whole day.
+
+            >>> Event.across(day_from, day_to, 'timestamp').order_by('timestamp')
+            <CrossPartitionQuerySet over Event_2016_11, Event_2016_12>
+            """
+            queryset = CrossPartitionQuerySet(
+                model
+                for model in (
+                    partitions_by_month.get(ym) or materialize((ym - 1) // 12, (ym - 1) % 12 + 1)
+                    for ym in xrange(
+                        resolve_month(start_ym or settings.TIMESTAMP_PARTITIONING_START_YM),
+                        resolve_month(end_ym) + 1,
+                    )
+                )
+                if model is not None and table_exists(model)
+            )
+
+            if timestamp_field is not None:
+                field = base_model_class._meta.get_field(timestamp_field)
+
+                for lookup, boundary in (('gte', start_ym), ('lte', end_ym)):
+                    if not isinstance(boundary, (datetime.datetime, datetime.date)):
+                        continue
+
+                    if not isinstance(boundary, datetime.datetime):
+                        # A date includes its whole day, the end one up to its last moment.
+                        if lookup == 'lte':
+                            lookup, boundary = 'lt', boundary + datetime.timedelta(days=1)
+
+                        if isinstance(field, DateTimeField):
+                            boundary = datetime.datetime.combine(boundary, datetime.time())
+                            if settings.USE_TZ:
+                                boundary = timezone.make_aware(boundary)
+
+                    queryset = queryset.filter(**{'%s__%s' % (timestamp_field, lookup): boundary})
+
+            return queryset
+
+        base_model_class.across = staticmethod(across)
+
         return base_model_class
 
     return maker
 
 
-def make_model_range_partitioned(number_of_partitions, module_globals):
+def make_model_range_partitioned(number_of_partitions, module_globals, hashing=ConsistentHashRing):
     """
     A model-class decorator. Example:
 
@@ -177,19 +538,51 @@ def make_model_range_partitioned(number_of_partitions, module_globals):
             class Meta:
                 abstract = True
 
-    This will dynamically create models for partitions from p0 to p9 in the same module.
+    This will dynamically create models for partitions from p0 to p9 in the same module,
+    each lazily on its first use (see also materialize_all_partitions).
     Then it adds static method Action.partition to quickly get appropriate partition model;
     this method takes the key that could be of any stringable value.
-    Consistent hashing ring takes the responsibility to spread all keys uniformly to partitions.
+    Action.partition_many does the same for a batch of keys or rows, grouping them per partition.
+    Consistent hashing ring takes the responsibility to spread all keys uniformly to partitions
+    by default; any other strategy from the hashing module can be passed as hashing argument.
     Also an iterator Action.iter_partitions is added to get iterator through all partitions.
     Class attribute Action.number_of_partitions is also set for convenience.
     An auxiliary method Action.partition_indexed can be used to retrieve partition model by its index.
+    Action.across returns a queryset-like object spanning all partitions or just those of the given keys.
     """
     def maker(base_model_class):
         partition_tmpl = '%s_p%d'
         name = base_model_class._meta.object_name
 
-        for part_index in xrange(number_of_partitions):
+        for fk_field_name, proxy in base_model_class.__dict__.items():
+            if isinstance(proxy, ForeignKeyToPartition):
+                Tgt = proxy.target_partitioned_model
+
+                if number_of_partitions != Tgt.number_of_partitions:
+                    raise RuntimeError(
+                        "Target model %s has different number of partitions (%d) than "
+                        "referencing model %s (%d)." % (
+                            Tgt._meta.object_name,
+                            Tgt.number_of_partitions,
+                            name,
+                            number_of_partitions,
+                        )
+                    )
+
+                if type(Tgt.hash_ring) is not hashing:
+                    raise RuntimeError(
+                        "Target model %s uses different hashing (%s) than "
+                        "referencing model %s (%s)." % (
+                            Tgt._meta.object_name,
+                            type(Tgt.hash_ring).__name__,
+                            name,
+                            hashing.__name__,
+                        )
+                    )
+
+        partitions_by_index = {}
+
+        def make_partition(part_index):
             model_name = partition_tmpl % (name, part_index)
 
             if model_name in module_globals:
@@ -207,53 +600,147 @@ def make_model_range_partitioned(number_of_partitions, module_globals):
 
             for fk_field_name, proxy in base_model_class.__dict__.items():
                 if isinstance(proxy, ForeignKeyToPartition):
-                    Tgt = proxy.target_partitioned_model
-
-                    if number_of_partitions != Tgt.number_of_partitions:
-                        raise RuntimeError(
-                            "Target model %s has different number of partitions (%d) than "
-                            "referencing model %s (%d)." % (
-                                Tgt._meta.object_name,
-                                Tgt.number_of_partitions,
-                                name,
-                                number_of_partitions,
-                            )
-                        )
-
                     attrs[fk_field_name] = ForeignKey(
-                        to=Tgt.partition_indexed(part_index),
+                        to=proxy.target_partitioned_model.partition_indexed(part_index),
                         *proxy.fk_args,
                         **proxy.fk_kwargs
                     )
 
+            # Materializing the target partition materializes its dependents, this one included.
+
+            if part_index in partitions_by_index:
+                return partitions_by_index[part_index]
+
             # Dynamically create the model class in the module.
 
-            module_globals[model_name] = type(
+            module_globals[model_name] = partitions_by_index[part_index] = type(
                 model_name,
                 (base_model_class,),
                 attrs,
             )
 
+            for materialize_dependent in partition_dependents[base_model_class]:
+                materialize_dependent(part_index)
+
+            return module_globals[model_name]
+
+        def materialize(part_index):
+            """
+            Returns the partition model, creating it if the index is valid. Returns None otherwise.
+            """
+            with materialize_lock:
+                model = partitions_by_index.get(part_index)
+
+                if model is None and 0 <= part_index < number_of_partitions:
+                    model = make_partition(part_index)
+
+            return model
+
+        for fk_field_name, proxy in base_model_class.__dict__.items():
+            if isinstance(proxy, ForeignKeyToPartition):
+                partition_dependents[proxy.target_partitioned_model].append(materialize)
+
+        partitioned_models.append(base_model_class)
+
         def partition_indexed(part_index):
             """
             A static method to retrieve partition model based on its exact index.
             """
-            return module_globals[
-                partition_tmpl % (name, part_index)
-            ]
+            model = partitions_by_index.get(part_index) or materialize(part_index)
+
+            if model is None:
+                raise KeyError(partition_tmpl % (name, part_index))
+
+            return model
         base_model_class.partition_indexed = staticmethod(partition_indexed)
 
+        # The recent and the older table mapping str(key) to partition index, so repeated keys skip
+        # even the hashing. An approximate LRU: keys used since the last swap survive it.
+        lookup_tables = [{}, {}]
+
+        def remember(keys, part_indexes):
+            recent = lookup_tables[0]
+            start = 0
+
+            while start < len(keys):
+                if len(recent) >= PARTITION_LOOKUP_TABLE_SIZE:
+                    recent = {}
+                    lookup_tables[:] = [recent, lookup_tables[0]]
+
+                end = start + PARTITION_LOOKUP_TABLE_SIZE - len(recent)
+                recent.update(zip(keys[start:end], part_indexes[start:end]))
+                start = end
+
+        def select_part_indexes(keys):
+            """
+            Returns the list of partition indexes of the list of str keys, hashing the unknown ones in one batch.
+            """
+            part_indexes = list(map(lookup_tables[0].get, keys))
+
+            if None not in part_indexes:
+                return part_indexes
+
+            older = lookup_tables[1]
+            missing = [key for key, part_index in zip(keys, part_indexes) if part_index is None]
+            hashed = [key for key in missing if key not in older]
+            found = dict(zip(hashed, base_model_class.hash_ring.select_buckets(hashed)))
+            found.update((key, older[key]) for key in missing if key in older)
+
+            remember(missing, [found[key] for key in missing])
+
+            return [found[key] if part_index is None else part_index for key, part_index in zip(keys, part_indexes)]
+
+        def select_part_index(key):
+            key = str(key)
+
+            try:
+                return lookup_tables[0][key]
+            except KeyError:
+                part_index = lookup_tables[1].get(key)
+
+                if part_index is None:
+                    part_index = base_model_class.hash_ring.select_bucket(key)
+
+                remember([key], [part_index])
+                return part_index
+
         def partition(cls, key):
             """
             A class method returning the partition model for this key.
             The key can be any value convertible to string; it is consistently hashed.
             """
             return cls.partition_indexed(
-                cls.hash_ring.select_bucket(key),
+                select_part_index(key),
             )
         base_model_class.partition = classmethod(partition)
 
-        base_model_class.hash_ring = ConsistentHashRing(
+        def partition_many(cls, items, key=None):
+            """
+            A class method routing a whole batch at once.
+            Returns a dict mapping the partition model to the list of items belonging there.
+            Items are the keys themselves, or any row objects when key function is given:
+
+            >>> Action.partition_many([1, 2, 3])
+            {<class '...Action_p1'>: [2, 3], <class '...Action_p3'>: [1]}
+            >>> Action.partition_many(rows, key=operator.itemgetter('website_id'))
+            {<class '...Action_p1'>: [{'website_id': 2, ...}, ...], ...}
+            """
+            items = list(items)
+            by_index = defaultdict(list)
+            part_indexes = select_part_indexes(
+                list(map(str, items)) if key is None else [str(key(item)) for item in items]
+            )
+
+            for item, part_index in zip(items, part_indexes):
+                by_index[part_index].append(item)
+
+            return dict(
+                (cls.partition_indexed(part_index), part_items)
+                for part_index, part_items in by_index.items()
+            )
+        base_model_class.partition_many = classmethod(partition_many)
+
+        base_model_class.hash_ring = hashing(
             xrange(number_of_partitions),
         )
         base_model_class.number_of_partitions = number_of_partitions
@@ -267,6 +754,21 @@ def make_model_range_partitioned(number_of_partitions, module_globals):
 
         base_model_class.iter_partitions = classmethod(iter_partitions)
 
+        def across(cls, keys=None):
+            """
+            A class method returning the lazy CrossPartitionQuerySet over all partitions,
+            or over just the partitions where the given keys belong.
+            """
+            if keys is None:
+                return CrossPartitionQuerySet(cls.iter_partitions())
+
+            return CrossPartitionQuerySet(
+                cls.partition_indexed(part_index)
+                for part_index in sorted(set(select_part_indexes([str(key) for key in keys])))
+            )
+
+        base_model_class.across = classmethod(across)
+
         return base_model_class
 
     return maker
@@ -0,0 +1,606 @@
+import heapq
+import time
+from itertools import chain, count, islice
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from operator import attrgetter, itemgetter
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections, router
+from django.db.models import Avg, Count, F, Max, Min, Q, Sum
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.sql.datastructures import EmptyResultSet
+
+# Name of the annotation holding the value of the ordering at the position, when it spans relations.
+MERGE_KEY_TEMPLATE = 'merge_key_%d'
+
+# Database vendors ordering NULL after all the values in the ascending order, the others order it first.
+NULLS_LAST_VENDORS = ('postgresql', 'oracle')
+
+
+class Descending(object):
+    """
+    Wraps a sort key value so it sorts in the reversed order.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __gt__(self, other):
+        return other.value > self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __le__(self, other):
+        return other.value <= self.value
+
+    def __ge__(self, other):
+        return other.value >= self.value
+
+
+def run_in_worker(func, queryset, timeout, part_no, started):
+    """
+    Runs func(queryset) in a pool thread, on the thread's own database connection,
+    which is closed afterwards. PostgreSQL cancels statements running longer than timeout.
+    """
+    started[part_no] = time.time()
+    connection = connections[queryset.db]
+
+    try:
+        if timeout is not None and connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET statement_timeout = %s', [int(timeout * 1000)])
+
+        return func(queryset)
+    finally:
+        connection.close()
+
+
+def sum_or_none(values):
+    values = [value for value in values if value is not None]
+    return sum(values) if values else None
+
+
+def min_or_none(values):
+    values = [value for value in values if value is not None]
+    return min(values) if values else None
+
+
+def max_or_none(values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def decompose_aggregate(alias, aggregate):
+    """
+    Returns the dict of aggregates to be computed in every partition,
+    and the function combining the list of per-partition result dicts into the final value.
+    An average is computed as the sum divided by the count.
+    """
+    if isinstance(aggregate, Avg):
+        sum_alias, count_alias = '%s_partial_sum' % alias, '%s_partial_count' % alias
+        expressions = aggregate.get_source_expressions()
+
+        def combine(partials):
+            total_count = sum(partial[count_alias] or 0 for partial in partials)
+            if not total_count:
+                return None
+            return float(sum_or_none(partial[sum_alias] for partial in partials)) / total_count
+
+        return {sum_alias: Sum(*expressions), count_alias: Count(*expressions)}, combine
+
+    if isinstance(aggregate, Count):
+        if aggregate.extra.get('distinct'):
+            raise RuntimeError("Distinct count %s cannot be combined from partitions." % alias)
+        combine_values = lambda values: sum(value or 0 for value in values)
+    elif isinstance(aggregate, Sum):
+        combine_values = sum_or_none
+    elif isinstance(aggregate, Min):
+        combine_values = min_or_none
+    elif isinstance(aggregate, Max):
+        combine_values = max_or_none
+    else:
+        raise RuntimeError(
+            "Aggregate %s cannot be combined from partitions, use Count, Sum, Min, Max or Avg." % alias
+        )
+
+    return {alias: aggregate}, lambda partials: combine_values(partial[alias] for partial in partials)
+
+
+def decompose_aggregates(args, kwargs):
+    """
+    Decomposes all aggregate() or annotate() arguments,
+    returns the dict of partial aggregates and the dict of combine functions for every alias.
+    """
+    for arg in args:
+        kwargs[arg.default_alias] = arg
+
+    partial_aggregates, combiners = {}, {}
+
+    for alias, aggregate in kwargs.items():
+        partials, combiners[alias] = decompose_aggregate(alias, aggregate)
+        partial_aggregates.update(partials)
+
+    return partial_aggregates, combiners
+
+
+class CrossPartitionQuerySet(object):
+    """
+    A lazy queryset-like object spanning the given partition models.
+
+    filter(), exclude(), order_by(), values() and values_list() are recorded
+    and applied to the queryset of every partition. Nothing is queried until iterated.
+    count(), aggregate() and values().annotate() are computed in every partition by the database
+    and only the partial results are combined here.
+    Without ordering the partitions are read one after another;
+    with ordering their already ordered results are merged lazily (k-way merge),
+    NULL values placed where the database of the partitions places them.
+    Rows are fetched the way the database driver does, so with the client-side cursors of psycopg2
+    every partition result is held in memory as a whole; stream() bounds the memory.
+
+    >>> Event.across((2016, 11), (2016, 12)).filter(value__gt=0).order_by('-timestamp')[:10]
+
+    See parallel() to query the partitions concurrently.
+    """
+    def __init__(self, partition_models):
+        self.partition_models = list(partition_models)
+        self._operations = []
+        self._ordering = ()
+        self._values = None
+        self._slice = (None, None)
+        self._parallel = None
+        self._group_by = None
+
+    def __repr__(self):
+        return '<%s over %s>' % (
+            self.__class__.__name__,
+            ', '.join(model._meta.object_name for model in self.partition_models),
+        )
+
+    def _clone(self, operation=None, **attrs):
+        clone = self.__class__(self.partition_models)
+        clone._operations = list(self._operations)
+        clone._ordering = self._ordering
+        clone._values = self._values
+        clone._slice = self._slice
+        clone._parallel = self._parallel
+        clone._group_by = self._group_by
+        clone.__dict__.update(attrs)
+
+        if operation is not None:
+            if self._slice != (None, None):
+                raise RuntimeError("Cannot filter or order a query once a slice has been taken.")
+            if self._group_by is not None:
+                raise RuntimeError("Cannot change a query once grouped across partitions, except for ordering.")
+            clone._operations.append(operation)
+
+        return clone
+
+    def all(self):
+        return self._clone()
+
+    def filter(self, *args, **kwargs):
+        return self._clone(('filter', args, kwargs))
+
+    def exclude(self, *args, **kwargs):
+        return self._clone(('exclude', args, kwargs))
+
+    def order_by(self, *field_names):
+        if self._group_by is not None:
+            # The combined groups get sorted here, partitions need not order theirs.
+            return self._clone(_ordering=field_names).check_ordering()
+
+        return self._clone(('order_by', field_names, {}), _ordering=field_names).check_ordering()
+
+    def values(self, *fields):
+        return self._clone(('values', fields, {}), _values=('values', fields, False)).check_ordering()
+
+    def values_list(self, *fields, **kwargs):
+        flat = kwargs.get('flat', False)
+        return self._clone(('values_list', fields, kwargs), _values=('values_list', fields, flat)).check_ordering()
+
+    def check_ordering(self):
+        """
+        Makes sure the ordering is valid and its values can be read from the rows to merge them,
+        so a query failing to merge fails right away, not after all the partitions were queried.
+        Returns self.
+        """
+        if not self._ordering or not self.partition_models:
+            return self
+
+        if '?' in self._ordering:
+            raise RuntimeError("Cannot merge partitions ordered randomly.")
+
+        model = self.partition_models[0]
+
+        if self._group_by is None:
+            try:
+                # Compiling the query checks the field names without running it.
+                str(self.get_queryset(model).query)
+            except EmptyResultSet:
+                pass
+
+        self.get_sort_key(model)
+
+        return self
+
+    def parallel(self, workers=4, timeout=None):
+        """
+        Returns the copy querying up to `workers` partitions concurrently, each in its own thread
+        with its own database connection. A partition running longer than timeout seconds
+        makes the whole query raise multiprocessing.TimeoutError (PostgreSQL also cancels the statement).
+
+        Results of every partition are then fetched as a whole before being merged.
+        The workers do not see any uncommitted changes of the calling thread's transaction.
+        """
+        return self._clone(_parallel=(workers, timeout))
+
+    def annotate(self, *args, **kwargs):
+        """
+        After values() it groups the rows of all partitions by the values fields,
+        each partition computing its groups in the database, see aggregate() for the supported aggregates.
+        Without values() the annotation is per row, so it is just applied to every partition.
+
+        >>> Event.across().values('browser__ua').annotate(n=Count('id'), avg=Avg('value')).order_by('-n')
+        """
+        if self._values is None:
+            return self._clone(('annotate', args, kwargs))
+
+        kind, fields, flat = self._values
+        if kind != 'values' or not fields:
+            raise RuntimeError("Only values() with field names can be grouped across partitions.")
+
+        partial_aggregates, combiners = decompose_aggregates(args, kwargs)
+
+        return self._clone(
+            ('annotate', (), partial_aggregates),
+            _group_by=(fields, combiners),
+        )
+
+    def count(self):
+        """
+        Returns the number of rows, counted by the database in every partition.
+        """
+        if self._group_by is not None:
+            return sum(1 for _ in self)
+
+        total = sum(self.map_partitions(lambda queryset: queryset.count()))
+
+        start, stop = self._slice
+        if stop is not None:
+            total = min(total, stop)
+
+        return max(0, total - (start or 0))
+
+    def aggregate(self, *args, **kwargs):
+        """
+        Returns the dict of aggregates over all partitions, like QuerySet.aggregate() does.
+        Every partition computes its partial aggregates in a single query.
+        Supported are Count (but not distinct), Sum, Min, Max and Avg.
+
+        >>> Event.across().aggregate(Sum('value'), avg=Avg('value'))
+        {'value__sum': 1234, 'avg': 3.17}
+        """
+        if self._group_by is not None or self._slice != (None, None):
+            raise RuntimeError("Cannot aggregate a grouped or sliced query across partitions.")
+
+        partial_aggregates, combiners = decompose_aggregates(args, kwargs)
+        partials = self.map_partitions(lambda queryset: queryset.aggregate(**partial_aggregates))
+
+        return dict(
+            (alias, combine(partials))
+            for alias, combine in combiners.items()
+        )
+
+    def iter_groups(self):
+        """
+        Combines the groups computed in every partition, yielding one dict per group.
+        """
+        fields, combiners = self._group_by
+        groups = {}
+
+        for partition_rows in self.map_partitions(list):
+            for row in partition_rows:
+                groups.setdefault(
+                    tuple(row[field] for field in fields),
+                    [],
+                ).append(row)
+
+        rows = []
+
+        for group_key, partials in groups.items():
+            row = dict(zip(fields, group_key))
+            for alias, combine in combiners.items():
+                row[alias] = combine(partials)
+            rows.append(row)
+
+        if self._ordering:
+            # The combined groups are few, so they are simply sorted here.
+            rows.sort(key=self.get_sort_key(self.partition_models[0]))
+
+        return iter(rows)
+
+    def stream(self, chunk_size=1000, key=None):
+        """
+        Yields the rows of all partitions, one partition after another, holding at most chunk_size rows
+        in memory at any time, whatever the number of rows is. Model instances, values() dicts
+        or values_list() tuples are yielded, depending on the query.
+
+        Every partition is read by keyset pagination: ordered by the key field (which must not be null)
+        and the primary key, each chunk starting right after the last row of the previous one.
+        This is as fast for the last chunk as for the first one, unlike OFFSET, on any database.
+
+        >>> for timestamp, value in Event.across().values_list('timestamp', 'value').stream(key='timestamp'):
+        ...     export(timestamp, value)
+        """
+        if self._ordering or self._group_by is not None or self._slice != (None, None):
+            raise RuntimeError("Cannot stream an ordered, grouped or sliced query, the key defines the order.")
+
+        for model in self.partition_models:
+            for row in self.stream_partition(model, chunk_size, key):
+                yield row
+
+    def stream_partition(self, model, chunk_size, key):
+        pk_name = model._meta.pk.attname
+        keys = [pk_name] if key in (None, 'pk', pk_name) else [key, pk_name]
+
+        queryset = model.objects.all()
+        for method, args, kwargs in self._operations:
+            if method not in ('values', 'values_list'):
+                queryset = getattr(queryset, method)(*args, **kwargs)
+
+        # The key values have to be selected too, they are stripped from the rows afterwards.
+
+        if self._values is None:
+            get_keys = lambda row: [getattr(row, name) for name in keys]
+            strip = lambda row: row
+        else:
+            kind, fields, flat = self._values
+            fields = list(fields or [field.attname for field in model._meta.concrete_fields])
+            extra = [name for name in keys if name not in fields]
+
+            if kind == 'values':
+                queryset = queryset.values(*(fields + extra))
+                get_keys = lambda row: [row[name] for name in keys]
+                strip = lambda row: dict((name, row[name]) for name in fields)
+            else:
+                selected = fields + extra
+                positions = [selected.index(name) for name in keys]
+                queryset = queryset.values_list(*selected)
+                get_keys = lambda row: [row[position] for position in positions]
+                strip = (lambda row: row[0]) if flat else (lambda row: row[:len(fields)])
+
+        queryset = queryset.order_by(*keys)
+        last = None
+
+        while True:
+            page = queryset
+
+            if last is not None:
+                if len(keys) == 1:
+                    page = page.filter(**{'%s__gt' % pk_name: last[0]})
+                else:
+                    page = page.filter(
+                        Q(**{'%s__gt' % key: last[0]}) | Q(**{key: last[0], '%s__gt' % pk_name: last[1]})
+                    )
+
+            rows = list(page[:chunk_size])
+
+            for row in rows:
+                yield strip(row)
+
+            if len(rows) < chunk_size:
+                break
+
+            last = get_keys(rows[-1])
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice) or k.step is not None or (k.start or 0) < 0 or (k.stop or 0) < 0:
+            raise TypeError("Only non-negative slices without step are supported.")
+
+        offset, stop = self._slice
+        offset = offset or 0
+        start = offset + (k.start or 0)
+
+        if k.stop is not None:
+            stop = offset + k.stop if stop is None else min(stop, offset + k.stop)
+        if stop is not None:
+            start = min(start, stop)
+
+        return self._clone(_slice=(start, stop))
+
+    def get_queryset(self, model):
+        """
+        Returns the queryset of the single partition model with all the recorded operations applied.
+        """
+        queryset = model.objects.all()
+
+        if self._values is None and self._group_by is None:
+            merge_keys = self.get_merge_keys(model)
+            if merge_keys:
+                queryset = queryset.annotate(**dict(
+                    (MERGE_KEY_TEMPLATE % position, F(field_name))
+                    for position, field_name in merge_keys.items()
+                ))
+
+        for method, args, kwargs in self._operations:
+            queryset = getattr(queryset, method)(*args, **kwargs)
+
+        start, stop = self._slice
+        if stop is not None and self._group_by is None:
+            # Any partition can contribute all the rows up to the stop.
+            queryset = queryset[:stop]
+
+        return queryset
+
+    def querysets(self):
+        """
+        Yields the querysets of all partitions in order.
+        """
+        for model in self.partition_models:
+            yield self.get_queryset(model)
+
+    def map_partitions(self, func):
+        """
+        Calls func with the queryset of every partition and returns the list of results in partition order.
+        The calls run concurrently in the parallel mode.
+
+        >>> Action.across().parallel(workers=5).map_partitions(lambda qs: qs.count())
+        [10, 12, 9, 11, 10]
+        """
+        if self._parallel is None:
+            return [func(queryset) for queryset in self.querysets()]
+
+        workers, timeout = self._parallel
+        pool = ThreadPool(min(workers, len(self.partition_models)) or 1)
+        started = {}
+
+        try:
+            pending = [
+                pool.apply_async(run_in_worker, (func, queryset, timeout, part_no, started))
+                for part_no, queryset in enumerate(self.querysets())
+            ]
+
+            results = []
+
+            for part_no, async_result in enumerate(pending):
+                # The timeout counts from the moment a worker picked the partition up.
+                while not async_result.ready():
+                    if timeout is not None and part_no in started and time.time() - started[part_no] > timeout:
+                        raise TimeoutError(
+                            "Partition %s did not finish in %s seconds." % (
+                                self.partition_models[part_no]._meta.object_name,
+                                timeout,
+                            )
+                        )
+                    async_result.wait(0.05)
+
+                results.append(async_result.get())
+
+            return results
+        finally:
+            pool.terminate()
+
+    def get_merge_keys(self, model):
+        """
+        Returns the dict mapping the positions in the ordering to the field names whose values
+        are not attributes of the model instances, like those of related models, so they are annotated.
+        """
+        merge_keys = {}
+
+        for position, field_name in enumerate(self._ordering):
+            field_name = field_name.lstrip('-')
+
+            if LOOKUP_SEP in field_name:
+                merge_keys[position] = field_name
+
+        return merge_keys
+
+    def get_sort_key(self, model):
+        """
+        Returns the function extracting the ordering key from the rows of the partition model.
+        NULL values sort first or last in the ascending order the same as in its database.
+        """
+        getters = []
+        nulls_last = connections[router.db_for_read(model)].vendor in NULLS_LAST_VENDORS
+        merge_keys = self.get_merge_keys(model) if self._values is None and self._group_by is None else {}
+
+        for position, field_name in enumerate(self._ordering):
+            descending = field_name.startswith('-')
+            field_name = field_name.lstrip('-')
+
+            if self._values is None:
+                if position in merge_keys:
+                    field_name = MERGE_KEY_TEMPLATE % position
+                elif field_name == 'pk':
+                    field_name = model._meta.pk.attname
+                else:
+                    try:
+                        # Ordering by a foreign key orders by its value, not by the related instance.
+                        field_name = getattr(model._meta.get_field(field_name), 'attname', field_name)
+                    except FieldDoesNotExist:
+                        # An annotation.
+                        pass
+
+                getter = attrgetter(field_name)
+            else:
+                kind, fields, flat = self._values
+
+                if field_name == 'pk' and 'pk' not in fields:
+                    field_name = model._meta.pk.name
+
+                if kind == 'values':
+                    if (fields or LOOKUP_SEP in field_name) and field_name not in fields and (
+                        self._group_by is None or field_name not in self._group_by[1]
+                    ):
+                        raise RuntimeError("Cannot merge by %s not present in values()." % field_name)
+                    getter = itemgetter(field_name)
+                elif flat:
+                    if fields[:1] != (field_name,):
+                        raise RuntimeError("Cannot merge by %s not present in values_list()." % field_name)
+                    getter = lambda row: row
+                else:
+                    if field_name not in fields:
+                        raise RuntimeError("Cannot merge by %s not present in values_list()." % field_name)
+                    getter = itemgetter(fields.index(field_name))
+
+            getters.append((getter, descending))
+
+        def get_value(getter, row):
+            value = getter(row)
+            return (value is None) == nulls_last, value
+
+        def sort_key(row):
+            return tuple(
+                Descending(get_value(getter, row)) if descending else get_value(getter, row)
+                for getter, descending in getters
+            )
+
+        return sort_key
+
+    def merge(self, results):
+        """
+        Merges the per-partition iterables of rows, as returned from querysets(), into a single iterator.
+        """
+        if not self._ordering:
+            rows = chain.from_iterable(results)
+        else:
+            rows = (
+                row for _, _, _, row in heapq.merge(*[
+                    self._decorate(self.get_sort_key(model), part_no, part_rows)
+                    for part_no, (model, part_rows) in enumerate(zip(self.partition_models, results))
+                ])
+            )
+
+        start, stop = self._slice
+        if start or stop is not None:
+            rows = islice(rows, start or 0, stop)
+
+        return rows
+
+    @staticmethod
+    def _decorate(sort_key, part_no, rows):
+        # The partition and sequence numbers keep the rows themselves from being compared.
+        sequence = count()
+        for row in rows:
+            yield sort_key(row), part_no, next(sequence), row
+
+    def __iter__(self):
+        if self._group_by is not None:
+            start, stop = self._slice
+            return islice(self.iter_groups(), start or 0, stop)
+
+        if self._parallel is not None:
+            return self.merge(self.map_partitions(list))
+
+        return self.merge(
+            queryset.iterator() for queryset in self.querysets()
+        )
@@ -0,0 +1,300 @@
+"""
+Growing the number of partitions of a range partitioned model with the data in place.
+
+After the number in make_model_range_partitioned() is raised (along with the one of the models
+referencing it) and the new partition tables are created, reshard() moves the rows whose keys
+the hashing now places elsewhere. With the consistent hashing ring only about
+(new - old) / new of the keys move, all of them into the new partitions.
+"""
+import json
+from collections import defaultdict, namedtuple
+
+from django.db import connections, router
+from django.db.transaction import atomic
+
+from . import partitions
+from .caching import GocPkCacheMixin
+from .models import ReshardJournal
+
+# Maximum number of values in a single IN (...) lookup, SQLite allows 999 query parameters at most.
+IN_LOOKUP_SIZE = 500
+
+# The routing key moving from the partition of the old index into the one of the new index.
+KeyMove = namedtuple('KeyMove', 'key old_index new_index')
+
+# The totals of a reshard() run, rows counted across the referencing models too.
+ReshardResult = namedtuple('ReshardResult', 'keys rows')
+
+
+def iter_chunks(values, size):
+    values = list(values)
+
+    for start in xrange(0, len(values), size):
+        yield values[start:start + size]
+
+
+def plan_reshard(base_model, old_number_of_partitions, key_field):
+    """
+    Reads the distinct values of the key field from the old partitions of the range partitioned base model,
+    returning the list of KeyMove for the keys the current number of partitions places elsewhere.
+    Keys are taken from where their rows really are, so even misplaced rows get moved.
+    """
+    check_reshard(base_model, old_number_of_partitions)
+    moves = []
+
+    for old_index in xrange(old_number_of_partitions):
+        keys = base_model.partition_indexed(old_index).objects.order_by().values_list(
+            key_field, flat=True,
+        ).distinct()
+
+        for key in keys:
+            new_index = base_model.hash_ring.select_bucket(str(key))
+
+            if new_index != old_index:
+                moves.append(KeyMove(key, old_index, new_index))
+
+    return moves
+
+
+def check_reshard(base_model, old_number_of_partitions):
+    if not hasattr(base_model, 'iter_partitions'):
+        raise RuntimeError("Model %s is not range partitioned." % base_model._meta.object_name)
+
+    if any(isinstance(proxy, partitions.ForeignKeyToPartition) for proxy in base_model.__dict__.values()):
+        raise RuntimeError(
+            "Model %s references another partitioned model, its rows move along with the referenced rows." %
+            base_model._meta.object_name
+        )
+
+    if not 0 < old_number_of_partitions < base_model.number_of_partitions:
+        raise RuntimeError(
+            "Model %s can only grow from fewer partitions than its current %d." % (
+                base_model._meta.object_name,
+                base_model.number_of_partitions,
+            )
+        )
+
+
+def ensure_partition_tables(base_model, part_index):
+    """
+    Creates the table of the partition and of the same partition of all the models referencing it, if missing.
+    """
+    partitions.ensure_table(base_model.partition_indexed(part_index))
+
+    for referencing_model, field_name in partitions.iter_referencing_fields(base_model):
+        ensure_partition_tables(referencing_model, part_index)
+
+
+def copy_partition_rows(from_model, to_model, queryset, remap=None):
+    """
+    Inserts the rows of the queryset of from_model into to_model, with new primary keys.
+    The remap is the (attname, {old pk: new pk}) of the foreign key to rewrite.
+    Returns the dict mapping the old primary keys to the new ones.
+    """
+    pk_name = from_model._meta.pk.attname
+    fields = [field for field in from_model._meta.concrete_fields if not field.primary_key]
+
+    old_pks, instances = [], []
+
+    for row in queryset.values(pk_name, *[field.attname for field in fields]):
+        values = dict((field.attname, row[field.attname]) for field in fields)
+
+        if remap is not None:
+            attname, pk_map = remap
+            if values[attname] is not None:
+                values[attname] = pk_map[values[attname]]
+
+        old_pks.append(row[pk_name])
+        instances.append(to_model(**values))
+
+    db = router.db_for_write(to_model)
+
+    # Only newer Django versions set the primary keys of bulk created rows, on PostgreSQL.
+    if getattr(connections[db].features, 'can_return_ids_from_bulk_insert', False):
+        to_model.objects.using(db).bulk_create(instances)
+    else:
+        for instance in instances:
+            instance.save(using=db, force_insert=True)
+
+    return dict(zip(old_pks, (instance.pk for instance in instances)))
+
+
+def copy_partition_tree(base_model, old_index, new_index, queryset, remap=None):
+    """
+    Copies the rows of the queryset from the old partition of the base model into the new one,
+    along with the rows of the same partitions of the models referencing them via ForeignKeyToPartition,
+    their foreign keys rewritten to the new primary keys. The originals are left in place.
+    Returns the list of (base model label, old primary keys, new primary keys) of the copied rows,
+    the referenced ones first.
+    """
+    pk_map = copy_partition_rows(
+        base_model.partition_indexed(old_index),
+        base_model.partition_indexed(new_index),
+        queryset,
+        remap,
+    )
+
+    if not pk_map:
+        return []
+
+    copies = [(base_model._meta.label, list(pk_map), list(pk_map.values()))]
+
+    for referencing_model, field_name in partitions.iter_referencing_fields(base_model):
+        attname = referencing_model.partition_indexed(old_index)._meta.get_field(field_name).attname
+
+        for old_pks in iter_chunks(pk_map, IN_LOOKUP_SIZE):
+            copies.extend(copy_partition_tree(
+                referencing_model,
+                old_index,
+                new_index,
+                referencing_model.partition_indexed(old_index).objects.filter(**{'%s__in' % attname: old_pks}),
+                remap=(attname, pk_map),
+            ))
+
+    return copies
+
+
+def count_partition_rows(model, pks):
+    return sum(model.objects.filter(pk__in=chunk).count() for chunk in iter_chunks(pks, IN_LOOKUP_SIZE))
+
+
+def delete_originals(old_index, new_index, copies):
+    """
+    Checks all the copies are in the new partitions and deletes their originals from the old ones,
+    the referencing rows first, so nothing cascades. Originals deleted already are skipped.
+    Returns the number of the rows deleted.
+    """
+    deleted = 0
+
+    for label, old_pks, new_pks in copies:
+        model = partitions.get_partitioned_model(*label.split('.')).partition_indexed(new_index)
+
+        if count_partition_rows(model, new_pks) != len(new_pks):
+            raise RuntimeError("Rows copied into %s are missing, their originals are kept." % model._meta.db_table)
+
+    for label, old_pks, new_pks in reversed(copies):
+        model = partitions.get_partitioned_model(*label.split('.')).partition_indexed(old_index)
+
+        for chunk in iter_chunks(old_pks, IN_LOOKUP_SIZE):
+            deleted += model.objects.filter(pk__in=chunk).delete()[0]
+
+    return deleted
+
+
+def get_journal(base_model, old_index, new_index):
+    """
+    Returns the ReshardJournal queryset of the batches moving from the old partition into the new one,
+    on the database of the new partition.
+    """
+    return ReshardJournal.objects.using(router.db_for_write(base_model.partition_indexed(new_index))).filter(
+        table=base_model._meta.db_table,
+        old_index=old_index,
+        new_index=new_index,
+    )
+
+
+def write_journal(base_model, old_index, new_index, copies):
+    """
+    Records the copies of a batch on the database of the new partition, to be called within the transaction
+    of the copy, so the record is committed or rolled back along with it.
+    """
+    return get_journal(base_model, old_index, new_index).create(
+        table=base_model._meta.db_table,
+        old_index=old_index,
+        new_index=new_index,
+        copies=json.dumps(copies),
+    )
+
+
+def resume_move(base_model, old_index, new_index):
+    """
+    Finishes the batch a previous run copied from the old partition into the new one in another database,
+    but did not delete the originals of. A copy rolled back left no journal behind.
+    Returns the number of the rows moved.
+    """
+    moved = 0
+
+    for entry in get_journal(base_model, old_index, new_index):
+        with atomic(using=router.db_for_write(base_model.partition_indexed(old_index))):
+            moved += delete_originals(old_index, new_index, json.loads(entry.copies))
+
+        entry.delete()
+
+    return moved
+
+
+def bump_gocpk_generations(base_model, *part_indexes):
+    """
+    Invalidates the cached primary keys of the partitions of the base model and of the models referencing it.
+    """
+    for part_index in part_indexes:
+        model = base_model.partition_indexed(part_index)
+
+        if issubclass(model, GocPkCacheMixin):
+            model.bump_gocpk_generation()
+
+    for referencing_model, field_name in partitions.iter_referencing_fields(base_model):
+        bump_gocpk_generations(referencing_model, *part_indexes)
+
+
+def reshard(base_model, old_number_of_partitions, key_field, batch_size=100, progress=None):
+    """
+    Moves the rows of the range partitioned base model (and of the models referencing it)
+    whose key field values are placed into other partitions by its current number of partitions
+    than by the old one. Missing tables of the partitions are created.
+
+    Every batch of keys is copied, the copies verified and then the originals deleted. Within a database
+    that happens in a single transaction. Across databases no transaction spans both, so the copy is
+    committed first, along with its primary keys in the ReshardJournal table of the same database,
+    and the originals deleted in a second transaction. The move can thus be interrupted and run again
+    any time: the next run deletes the originals of the committed copy before moving on.
+
+    The progress function, if given, gets called with the numbers of keys moved so far,
+    of all the keys to move and of the rows moved so far, after each batch.
+
+    >>> reshard(Session, 5, 'website_id')    # after Session and Action went from 5 to 10 partitions
+    ReshardResult(keys=5012, rows=120873)
+    """
+    moves = plan_reshard(base_model, old_number_of_partitions, key_field)
+
+    by_partitions = defaultdict(list)
+    for move in moves:
+        by_partitions[move.old_index, move.new_index].append(move.key)
+
+    moved_keys = moved_rows = 0
+
+    for (old_index, new_index), keys in sorted(by_partitions.items()):
+        ensure_partition_tables(base_model, new_index)
+
+        old_db = router.db_for_write(base_model.partition_indexed(old_index))
+        new_db = router.db_for_write(base_model.partition_indexed(new_index))
+
+        if old_db != new_db:
+            moved_rows += resume_move(base_model, old_index, new_index)
+
+        for batch in iter_chunks(keys, batch_size):
+            queryset = base_model.partition_indexed(old_index).objects.filter(**{'%s__in' % key_field: batch})
+
+            if old_db == new_db:
+                with atomic(using=old_db):
+                    copies = copy_partition_tree(base_model, old_index, new_index, queryset)
+                    moved_rows += delete_originals(old_index, new_index, copies)
+            else:
+                with atomic(using=new_db):
+                    copies = copy_partition_tree(base_model, old_index, new_index, queryset)
+                    entry = write_journal(base_model, old_index, new_index, copies)
+
+                with atomic(using=old_db):
+                    moved_rows += delete_originals(old_index, new_index, copies)
+
+                entry.delete()
+
+            moved_keys += len(batch)
+
+            if progress is not None:
+                progress(moved_keys, len(moves), moved_rows)
+
+        # The moved rows got new primary keys.
+        bump_gocpk_generations(base_model, old_index, new_index)
+
+    return ReshardResult(moved_keys, moved_rows)
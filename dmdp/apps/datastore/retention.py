@@ -0,0 +1,171 @@
+"""
+Ageing out old monthly partitions: archive each one to a compressed file, verify it, drop its table.
+"""
+import csv
+import gzip
+import json
+import os
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import six
+
+from . import partitions
+from .caching import GocPkCacheMixin
+from .query import CrossPartitionQuerySet
+
+ARCHIVE_FORMATS = ('ndjson', 'csv')
+
+# The archived partition model, the archive file path and the number of rows in it.
+ArchiveResult = namedtuple('ArchiveResult', 'model path rows')
+
+
+def get_monthly_partitioned_models():
+    return [
+        base_model for base_model in partitions.partitioned_models
+        if hasattr(base_model, 'iter_YMs')
+    ]
+
+
+def get_expired_partitions(base_models, keep_months):
+    """
+    Returns the partition models of the monthly partitioned base models whose tables exist
+    and whose months are older than the keep_months most recent ones (the current month included).
+    Referencing partitions come before the partitions they reference, so they can be dropped in order.
+
+    >>> get_expired_partitions([Browser, Event], keep_months=3)    # in 2017-01
+    [<class '...Event_2016_10'>, <class '...Browser_2016_10'>]
+    """
+    if keep_months < 1:
+        raise RuntimeError("At least the current month has to be kept.")
+
+    base_models = list(base_models)
+
+    for base_model in base_models:
+        if not hasattr(base_model, 'iter_YMs'):
+            raise RuntimeError("Model %s is not monthly partitioned." % base_model._meta.object_name)
+
+        for referencing_model, field_name in partitions.iter_referencing_fields(base_model):
+            if referencing_model not in base_models:
+                raise RuntimeError(
+                    "Model %s is referenced by %s, which has to expire along with it." % (
+                        base_model._meta.object_name,
+                        referencing_model._meta.object_name,
+                    )
+                )
+
+    # Referenced models are always declared before the models referencing them.
+    base_models.sort(key=partitions.partitioned_models.index, reverse=True)
+
+    expired = []
+
+    for year, month in partitions.iter_months(
+        settings.TIMESTAMP_PARTITIONING_START_YM,
+        -keep_months,
+    ):
+        for base_model in base_models:
+            try:
+                model = base_model.YM(year, month)
+            except KeyError:
+                continue
+
+            if partitions.table_exists(model):
+                expired.append(model)
+
+    return expired
+
+
+def get_archive_path(model, directory, format):
+    return os.path.join(directory, '%s.%s.gz' % (model._meta.db_table, format))
+
+
+def write_archive(model, path, format='ndjson', chunk_size=10000):
+    """
+    Streams all rows of the partition model into the gzipped file, holding at most chunk_size rows
+    in memory. Rows are written as JSON objects one per line, or as CSV with the header row.
+    Returns the number of rows written.
+    """
+    if format not in ARCHIVE_FORMATS:
+        raise RuntimeError("Unsupported archive format %r" % format)
+
+    fields = [field.attname for field in model._meta.concrete_fields]
+    queryset = CrossPartitionQuerySet([model])
+    rows = 0
+
+    with gzip.open(path, 'wb') as f:
+        if format == 'ndjson':
+            for row in queryset.values(*fields).stream(chunk_size):
+                f.write(json.dumps(row, cls=DjangoJSONEncoder, sort_keys=True) + '\n')
+                rows += 1
+        else:
+            writer = csv.writer(f)
+            writer.writerow(fields)
+
+            for row in queryset.values_list(*fields).stream(chunk_size):
+                writer.writerow([
+                    value.encode('UTF-8') if isinstance(value, six.text_type) else value
+                    for value in row
+                ])
+                rows += 1
+
+    return rows
+
+
+def count_archived_rows(path, format='ndjson'):
+    """
+    Reads the archive back, returning the number of rows in it.
+    """
+    with gzip.open(path, 'rb') as f:
+        if format == 'ndjson':
+            return sum(1 for line in f if line.strip())
+
+        return sum(1 for row in csv.reader(f)) - 1
+
+
+def archive_partition(model, directory, format='ndjson', chunk_size=10000, drop=True):
+    """
+    Archives the partition model into the directory, verifies the row counts of the table
+    and of the archive read back, then drops the table.
+    The archive is written under a temporary name first, an existing archive is never overwritten.
+    Nothing is dropped if anything does not match.
+
+    >>> archive_partition(Event.YM(2016, 10), '/var/backups/dmdp')
+    ArchiveResult(model=<class '...Event_2016_10'>, path='/var/backups/dmdp/datastore_event_2016_10.ndjson.gz', rows=41760)
+    """
+    path = get_archive_path(model, directory, format)
+    if os.path.exists(path):
+        raise RuntimeError("Archive %s already exists." % path)
+
+    partial_path = path + '.part'
+    expected = model.objects.count()
+
+    try:
+        written = write_archive(model, partial_path, format, chunk_size)
+        archived = count_archived_rows(partial_path, format)
+    except Exception:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+    # Rows still being written into the partition would be lost by the drop.
+    current = model.objects.count()
+
+    if not expected == written == archived == current:
+        os.remove(partial_path)
+        raise RuntimeError(
+            "Archive of %s does not match: %d rows in table, %d written, %d read back, %d in table now." % (
+                model._meta.object_name, expected, written, archived, current,
+            )
+        )
+
+    os.rename(partial_path, path)
+
+    if drop:
+        partitions.drop_table(model)
+
+        # The cached primary keys point to the dropped rows now.
+        if issubclass(model, GocPkCacheMixin):
+            model.bump_gocpk_generation()
+
+    return ArchiveResult(model, path, archived)
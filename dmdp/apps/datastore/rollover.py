@@ -0,0 +1,149 @@
+"""
+Warming up the next month's partition of a monthly partitioned lookup model before the month starts,
+so the first events of the month neither miss the cache nor storm the fresh table with inserts.
+
+The primed keys only reach the web workers through a cache backend shared by all the processes,
+not a process-local one like LocMemCache.
+"""
+from collections import Counter, namedtuple
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import Count
+from django.utils import timezone
+
+from . import partitions
+from .caching import GocPkCacheMixin
+from .resharding import IN_LOOKUP_SIZE, iter_chunks
+from .retention import get_monthly_partitioned_models
+
+# Seconds the primed keys stay cached after the prewarmed month starts, while the workers pick them up.
+ROLLOVER_CACHE_MARGIN = 24 * 3600
+
+# The warmed up partition model, rows copied into it and cache keys primed.
+PrewarmResult = namedtuple('PrewarmResult', 'model copied cached')
+
+
+def get_prewarmable_models():
+    """
+    Returns the monthly partitioned GocPk cached models declaring their gocpk_lookup_fields.
+    """
+    return [
+        base_model for base_model in partitions.partitioned_models
+        if hasattr(base_model, 'iter_YMs')
+        and issubclass(base_model, GocPkCacheMixin)
+        and base_model.gocpk_lookup_fields
+    ]
+
+
+def ensure_partitions(ym=+1):
+    """
+    Creates the month's partition of every monthly partitioned model, the referencing ones included,
+    so the writers not going through ensure_partition() find their tables too.
+    Returns the partition models.
+
+    >>> ensure_partitions()    # run before the month starts
+    [<class '...Browser_2017_01'>, <class '...Event_2017_01'>]
+    """
+    return [base_model.ensure_partition(ym) for base_model in get_monthly_partitioned_models()]
+
+
+def get_most_referenced_pks(base_model, ym, top):
+    """
+    Returns the primary keys of the month's partition of the base model most referenced
+    by the same month's partitions of the models referencing it via ForeignKeyToPartition, most referenced first.
+    """
+    references = Counter()
+
+    for referencing_model, field_name in partitions.iter_referencing_fields(base_model):
+        try:
+            model = referencing_model.YM(*ym_tuple(ym))
+        except KeyError:
+            continue
+
+        if not partitions.table_exists(model):
+            continue
+
+        attname = model._meta.get_field(field_name).attname
+
+        references.update(dict(
+            model.objects.exclude(**{attname: None}).values_list(attname).annotate(
+                references=Count('pk'),
+            ).order_by('-references')[:top]
+        ))
+
+    return [pk for pk, count in references.most_common(top)]
+
+
+def ym_tuple(ym):
+    """
+    Returns the (year, month) tuple for any value accepted by resolve_month().
+    """
+    year, month = divmod(partitions.resolve_month(ym) - 1, 12)
+    return year, month + 1
+
+
+def is_cache_shared():
+    """
+    Tells whether the default cache backend can be seen by the other processes.
+    """
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], (LocMemCache, DummyCache))
+
+
+def get_prime_timeout(target_ym, margin=ROLLOVER_CACHE_MARGIN):
+    """
+    Returns the seconds from now until the start of the month, accepting any value accepted by resolve_month(),
+    plus the margin.
+    """
+    now = timezone.now()
+    year, month = ym_tuple(target_ym)
+    start = now.replace(year=year, month=month, day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    return max(int((start - now).total_seconds()), 0) + margin
+
+
+def prewarm_partition(base_model, top=10000, source_ym=None, target_ym=+1, cache_timeout=None):
+    """
+    Copies the top most referenced rows of the source month's partition of the lookup model
+    (the current month by default) into the target month's partition (the next month by default),
+    creating it if missing, and primes the GocPk cache with their primary keys in the new partition.
+    Rows already present in the target partition are not copied again, their keys get primed anyway.
+    The keys are cached for cache_timeout seconds, by default until ROLLOVER_CACHE_MARGIN seconds
+    after the target month starts.
+
+    The model declares the fields its rows are looked up by, e.g. gocpk_lookup_fields = ('ua',).
+
+    >>> prewarm_partition(Browser, top=1000)    # run before the month starts
+    PrewarmResult(model=<class '...Browser_2017_01'>, copied=1000, cached=1000)
+    """
+    names = base_model.gocpk_lookup_fields
+    if not names:
+        raise RuntimeError("Model %s declares no gocpk_lookup_fields." % base_model._meta.object_name)
+
+    source = base_model.YM(*ym_tuple(source_ym))
+    target = base_model.ensure_partition(target_ym)
+
+    if source is target:
+        raise RuntimeError("Cannot prewarm %s from itself." % target._meta.object_name)
+
+    fields = [field.attname for field in source._meta.concrete_fields if not field.primary_key]
+    rows = []
+
+    for pks in iter_chunks(get_most_referenced_pks(base_model, source_ym, top), IN_LOOKUP_SIZE):
+        rows.extend(source.objects.filter(pk__in=pks).values(*fields))
+
+    list_of_kwargs = [dict((name, row[name]) for name in names) for row in rows]
+    existing = target.select_gocpk_pks(sorted(names), list_of_kwargs)
+    new = [
+        target(**row) for row, kwargs in zip(rows, list_of_kwargs)
+        if target.get_gocpk_lookup_values(sorted(names), kwargs) not in existing
+    ]
+
+    target.objects.bulk_create(new)
+    target.get_or_create_cached_pk_for_many(
+        list_of_kwargs,
+        gocpk_cache_timeout=get_prime_timeout(target_ym) if cache_timeout is None else cache_timeout,
+    )
+
+    return PrewarmResult(target, len(new), len(list_of_kwargs))
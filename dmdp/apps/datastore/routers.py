@@ -0,0 +1,205 @@
+"""
+A database router placing the partitions of partitioned models on different databases:
+
+    DATABASE_ROUTERS = ['dmdp.apps.datastore.routers.PartitionRouter']
+
+    PARTITION_DATABASES = {
+        'datastore.Session': {(0, 1): 'default', (2, 4): 'shard1'},
+        'datastore.Browser': {(None, (2016, 12)): 'archive', (2017, 1): 'default'},
+    }
+
+Range partitioned models map partition indexes, monthly partitioned ones (year, month) tuples,
+or (first, last) ranges of them, both included and None for open-ended, to the database aliases.
+Partitions not mapped live in the default database.
+
+Models referencing partitions via ForeignKeyToPartition always follow their targets, so Action_p3 lives
+with Session_p3 and Event_2016_10 with Browser_2016_10; they must not be mapped themselves.
+All the other models are left to the next routers.
+
+The monthly partitioned models in settings.PARTITION_TIERING are routed by where their months are instead,
+as published by the tier_partitions management command, see the tiering module.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS
+
+from . import partitions, tiering
+from .operations import MONTHLY_PARTITION_RE, RANGE_PARTITION_RE
+
+
+def parse_boundary(base_model, boundary, label):
+    if boundary is None:
+        return None
+
+    if hasattr(base_model, 'YM'):
+        if isinstance(boundary, (tuple, list)) and len(boundary) == 2:
+            return partitions.resolve_month(tuple(boundary))
+    elif isinstance(boundary, int):
+        return boundary
+
+    raise ImproperlyConfigured("Unsupported partition %r in PARTITION_DATABASES[%r]" % (boundary, label))
+
+
+def parse_rules(label, mapping):
+    """
+    Returns the partitioned base model and the list of its (first, last, alias) rules, with the partition
+    indexes or the resolve_month() integers, for the item of settings.PARTITION_DATABASES.
+    """
+    try:
+        app_label, name = label.split('.')
+    except ValueError:
+        raise ImproperlyConfigured("PARTITION_DATABASES keys must be of the form 'app_label.ModelName'")
+
+    base_model = partitions.get_partitioned_model(app_label, name)
+
+    if base_model is None:
+        raise ImproperlyConfigured("PARTITION_DATABASES refers to %r, which is not a partitioned model" % label)
+
+    if partitions.get_target_models(base_model) != set([base_model]):
+        raise ImproperlyConfigured(
+            "PARTITION_DATABASES must not map %r, its partitions follow the ones they reference" % label
+        )
+
+    rules = []
+
+    for key, alias in mapping.items():
+        if alias not in settings.DATABASES:
+            raise ImproperlyConfigured("PARTITION_DATABASES[%r] refers to unknown database %r" % (label, alias))
+
+        # A single partition is an index or a (year, month) tuple of integers, otherwise a (first, last) range.
+        if isinstance(key, int) or (
+            hasattr(base_model, 'YM') and isinstance(key, (tuple, list)) and all(isinstance(b, int) for b in key)
+        ):
+            first = last = parse_boundary(base_model, key, label)
+        elif isinstance(key, (tuple, list)) and len(key) == 2:
+            first, last = [parse_boundary(base_model, boundary, label) for boundary in key]
+        else:
+            raise ImproperlyConfigured("Unsupported partition %r in PARTITION_DATABASES[%r]" % (key, label))
+
+        rules.append((first, last, alias))
+
+    return base_model, rules
+
+
+class PartitionRouter(object):
+    """
+    Routes the reads, writes, relations and migrations of the partition models
+    by settings.PARTITION_DATABASES, see the module docstring.
+    """
+    def __init__(self):
+        # Maps the partitioned base models to their lists of (first, last, alias) rules, parsed on the first use.
+        self.rules = None
+        # Maps the model classes to their aliases or TieredPartitions, None for the other models.
+        self.locations = {}
+
+    def get_rules(self):
+        if self.rules is None:
+            rules = dict(
+                parse_rules(label, mapping)
+                for label, mapping in getattr(settings, 'PARTITION_DATABASES', {}).items()
+            )
+
+            for base_model in rules:
+                if base_model in tiering.get_tiers():
+                    raise ImproperlyConfigured(
+                        "%s cannot be both in PARTITION_DATABASES and in PARTITION_TIERING" % (
+                            base_model._meta.object_name,
+                        )
+                    )
+
+            self.rules = rules
+
+        return self.rules
+
+    def get_partition_location(self, base_model, key):
+        """
+        Returns the database alias of the partition of base_model, given by its index
+        or by its resolve_month() integer, or its TieredPartition when its location changes over time.
+        """
+        rules = self.get_rules()
+        tiers = tiering.get_tiers()
+        mapped = [
+            target for target in partitions.get_target_models(base_model)
+            if target in rules or target in tiers
+        ]
+
+        if len(mapped) > 1:
+            raise ImproperlyConfigured(
+                "Partitions of %s reference the ones of %s, which cannot all be mapped in PARTITION_DATABASES" % (
+                    base_model._meta.object_name,
+                    ', '.join(sorted(target._meta.object_name for target in mapped)),
+                )
+            )
+
+        if mapped and mapped[0] in tiers:
+            return tiering.TieredPartition(tiers[mapped[0]], key)
+
+        for first, last, alias in rules[mapped[0]] if mapped else ():
+            if (first is None or first <= key) and (last is None or key <= last):
+                return alias
+
+        return DEFAULT_DB_ALIAS
+
+    def get_location(self, app_label, model_name):
+        """
+        Returns the database alias (or the TieredPartition) of the partition model of the given name,
+        None if it is no partition model. Works for the historical models of the migrations as well.
+        """
+        match = MONTHLY_PARTITION_RE.match(model_name) or RANGE_PARTITION_RE.match(model_name)
+        if match is None:
+            return None
+
+        base_model = partitions.get_partitioned_model(app_label, match.group('base'))
+        if base_model is None or hasattr(base_model, 'YM') != ('month' in match.groupdict()):
+            return None
+
+        if 'month' in match.groupdict():
+            key = partitions.resolve_month((int(match.group('year')), int(match.group('month'))))
+        else:
+            key = int(match.group('index'))
+
+        return self.get_partition_location(base_model, key)
+
+    def get_alias(self, app_label, model_name):
+        location = self.get_location(app_label, model_name)
+
+        if isinstance(location, tiering.TieredPartition):
+            return location.get_alias()
+
+        return location
+
+    def get_model_alias(self, model):
+        try:
+            location = self.locations[model]
+        except KeyError:
+            location = self.locations[model] = self.get_location(model._meta.app_label, model._meta.object_name)
+
+        if isinstance(location, tiering.TieredPartition):
+            return location.get_alias()
+
+        return location
+
+    def db_for_read(self, model, **hints):
+        return self.get_model_alias(model)
+
+    def db_for_write(self, model, **hints):
+        return self.get_model_alias(model)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        alias1 = self.get_model_alias(type(obj1))
+        alias2 = self.get_model_alias(type(obj2))
+
+        if alias1 is None and alias2 is None:
+            return None
+
+        return (alias1 or obj1._state.db) == (alias2 or obj2._state.db)
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if model_name is None:
+            return None
+
+        alias = self.get_alias(app_label, model_name)
+        if alias is None:
+            return None
+
+        return db == alias
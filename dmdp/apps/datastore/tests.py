@@ -1,3 +1,885 @@
-from django.test import TestCase
+"""
+Run with the partitions spread over several SQLite databases:
 
-# Create your tests here.
+    ./manage.py test dmdp.apps.datastore --settings=dmdp.settings_test
+"""
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from multiprocessing import TimeoutError
+from operator import itemgetter
+
+from django.core.cache import cache
+from django.core.exceptions import FieldError, ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import connections, models, router, transaction
+from django.db.migrations.state import ProjectState
+from django.db.models import Avg, Count, Max, Min, Sum
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
+from useful import consistent_hash
+
+from . import bulk, caching, hashing, instrumentation, partitions, resharding, retention, rollover, tiering
+from .management.commands import dataplay
+from .models import Action, Browser, Event, Session
+from .operations import CreatePartitionSet
+from .routers import PartitionRouter
+
+
+def get_table_names(alias):
+    return set(connections[alias].introspection.table_names())
+
+
+def count_rows(alias, model):
+    with connections[alias].cursor() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM %s' % connections[alias].ops.quote_name(model._meta.db_table))
+        return cursor.fetchone()[0]
+
+
+class PartitionTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        # Tables created by the tests are rolled back with them.
+        partitions.known_tables.clear()
+        cache.clear()
+
+    def tearDown(self):
+        partitions.known_tables.clear()
+
+
+class PartitionRouterTests(PartitionTestCase):
+    def test_range_partitions_placed_by_index(self):
+        self.assertEqual(
+            [router.db_for_write(Session.partition_indexed(i)) for i in xrange(5)],
+            ['default', 'default', 'shard1', 'shard1', 'shard1'],
+        )
+        self.assertEqual(
+            [router.db_for_read(Session.partition_indexed(i)) for i in xrange(5)],
+            ['default', 'default', 'shard1', 'shard1', 'shard1'],
+        )
+
+    def test_referencing_partitions_follow_their_targets(self):
+        for i in xrange(5):
+            self.assertEqual(
+                router.db_for_write(Action.partition_indexed(i)),
+                router.db_for_write(Session.partition_indexed(i)),
+            )
+
+    def test_other_models_left_alone(self):
+        from django.contrib.auth.models import User
+        self.assertEqual(router.db_for_write(User), 'default')
+        self.assertIsNone(PartitionRouter().db_for_write(User))
+
+    def test_rows_stored_where_routed(self):
+        for website_id in xrange(40):
+            session = Session.partition(website_id).objects.create(website_id=website_id)
+            Action.partition(website_id).objects.create(session=session)
+
+        for i in xrange(5):
+            alias = 'default' if i < 2 else 'shard1'
+            other = 'shard1' if i < 2 else 'default'
+
+            for base_model in (Session, Action):
+                model = base_model.partition_indexed(i)
+                self.assertEqual(count_rows(alias, model), model.objects.count())
+                self.assertNotIn(model._meta.db_table, get_table_names(other))
+
+        self.assertEqual(Session.across().count(), 40)
+        self.assertEqual(Action.across().filter(session__website_id__lt=10).count(), 10)
+
+    def test_allow_relation(self):
+        session0 = Session.partition_indexed(0).objects.create(website_id=1)
+        session2 = Session.partition_indexed(2).objects.create(website_id=2)
+
+        self.assertTrue(router.allow_relation(session0, Action.partition_indexed(0)(session=session0)))
+        self.assertFalse(router.allow_relation(session0, session2))
+
+    def test_allow_migrate(self):
+        self.assertTrue(router.allow_migrate('default', 'datastore', model_name='session_p1'))
+        self.assertFalse(router.allow_migrate('shard1', 'datastore', model_name='session_p1'))
+        self.assertTrue(router.allow_migrate('shard1', 'datastore', model_name='action_p3'))
+        self.assertFalse(router.allow_migrate('default', 'datastore', model_name='action_p3'))
+        self.assertTrue(router.allow_migrate('shard1', 'auth', model_name='user'))
+
+        # The migrations created every partition table in its database only.
+        self.assertIn('datastore_session_p0', get_table_names('default'))
+        self.assertNotIn('datastore_session_p0', get_table_names('shard1'))
+        self.assertIn('datastore_action_p4', get_table_names('shard1'))
+        self.assertNotIn('datastore_action_p4', get_table_names('default'))
+
+    @override_settings(PARTITION_DATABASES={'datastore.Browser': {(None, (2016, 12)): 'archive', (2017, 1): 'shard1'}})
+    def test_month_ranges(self):
+        partition_router = PartitionRouter()
+
+        self.assertEqual(partition_router.db_for_write(Browser.YM(2016, 10)), 'archive')
+        self.assertEqual(partition_router.db_for_write(Event.YM(2016, 12)), 'archive')
+        self.assertEqual(partition_router.db_for_write(Event.YM(2017, 1)), 'shard1')
+        self.assertEqual(partition_router.db_for_write(Browser.YM(2017, 2)), 'default')
+
+    @override_settings(PARTITION_DATABASES={'datastore.Action': {0: 'shard1'}})
+    def test_referencing_model_cannot_be_mapped(self):
+        with self.assertRaises(ImproperlyConfigured):
+            PartitionRouter().db_for_write(Action.partition_indexed(0))
+
+    @override_settings(PARTITION_DATABASES={'datastore.Session': {0: 'nowhere'}})
+    def test_unknown_database(self):
+        with self.assertRaises(ImproperlyConfigured):
+            PartitionRouter().db_for_write(Session.partition_indexed(0))
+
+    def test_partition_many_routes_like_partition(self):
+        keys = list(xrange(200)) + ['a', u'b']
+        by_model = Session.partition_many(keys)
+
+        self.assertEqual(sorted(sum(by_model.values(), []), key=str), sorted(keys, key=str))
+        for model, model_keys in by_model.items():
+            self.assertEqual([Session.partition(key) for key in model_keys], [model] * len(model_keys))
+
+        rows = [{'website_id': website_id} for website_id in xrange(50)]
+        for model, model_rows in Session.partition_many(rows, key=itemgetter('website_id')).items():
+            self.assertEqual([Session.partition(row['website_id']) for row in model_rows], [model] * len(model_rows))
+
+        self.assertEqual(
+            set(Session.across([1, 2, 3]).partition_models),
+            set(Session.partition(key) for key in (1, 2, 3)),
+        )
+
+    def test_partition_lookup_table_swapped_when_full(self):
+        partitions.PARTITION_LOOKUP_TABLE_SIZE = 7
+        self.addCleanup(setattr, partitions, 'PARTITION_LOOKUP_TABLE_SIZE', 100000)
+
+        for _ in xrange(2):
+            by_model = Session.partition_many(xrange(1000, 1030))
+
+            for model, keys in by_model.items():
+                self.assertEqual(
+                    [Session.partition_indexed(Session.hash_ring.select_bucket(key)) for key in keys],
+                    [model] * len(keys),
+                )
+
+    def test_ring_places_keys_as_useful_does(self):
+        ring = hashing.ConsistentHashRing(xrange(5))
+        reference = consistent_hash.ConsistentHashRing(xrange(5))
+        keys = [str(key) for key in xrange(5000)] + [u'unicode', '']
+
+        self.assertEqual(ring.select_buckets(keys), [reference.select_bucket(key) for key in keys])
+        self.assertEqual([ring.select_bucket(key) for key in keys], ring.select_buckets(keys))
+
+        ring.add_bucket(5)
+        reference.add_bucket(5)
+        self.assertEqual(ring.select_buckets(keys), [reference.select_bucket(key) for key in keys])
+
+
+class HashingStrategyTests(PartitionTestCase):
+    keys = list(xrange(3000))
+
+    def test_batches_place_keys_as_single_lookups(self):
+        for strategy in hashing.HASHING_STRATEGIES:
+            buckets = strategy(xrange(7))
+            placed = buckets.select_buckets(self.keys)
+
+            self.assertEqual(placed, [buckets.select_bucket(key) for key in self.keys])
+            self.assertEqual(placed, strategy(xrange(7)).select_buckets(self.keys))
+            self.assertEqual(set(placed), set(xrange(7)))
+
+    def test_jump_moves_keys_only_into_new_buckets(self):
+        before = hashing.JumpConsistentHash(xrange(5)).select_buckets(self.keys)
+        after = hashing.JumpConsistentHash(xrange(8)).select_buckets(self.keys)
+        moved = [(old, new) for old, new in zip(before, after) if old != new]
+
+        self.assertTrue(all(new >= 5 for old, new in moved))
+        # About (8 - 5) / 8 of the keys.
+        self.assertAlmostEqual(float(len(moved)) / len(self.keys), 3.0 / 8, delta=0.05)
+
+    def test_modulo_follows_hash(self):
+        table = hashing.ModuloTable(['a', 'b', 'c'])
+        self.assertEqual(
+            table.select_buckets(self.keys),
+            [['a', 'b', 'c'][hashing.hash64(key) % 3] for key in self.keys],
+        )
+
+
+class CreatePartitionSetTests(PartitionTestCase):
+    def test_backwards_and_forwards_follow_router(self):
+        operation = CreatePartitionSet(
+            name='Session',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('website_id', models.IntegerField()),
+            ],
+            indexes=range(5),
+        )
+        before = ProjectState()
+        after = before.clone()
+        operation.state_forwards('datastore', after)
+        self.assertEqual(len(after.models), 5)
+
+        for alias in ('default', 'shard1'):
+            with connections[alias].schema_editor() as editor:
+                operation.database_backwards('datastore', editor, after, before)
+
+        for alias in ('default', 'shard1'):
+            self.assertFalse(any(table.startswith('datastore_session_p') for table in get_table_names(alias)))
+
+        for alias in ('default', 'shard1', 'archive'):
+            with connections[alias].schema_editor() as editor:
+                operation.database_forwards('datastore', editor, before, after)
+
+        self.assertEqual(
+            sorted(table for table in get_table_names('default') if table.startswith('datastore_session_p')),
+            ['datastore_session_p0', 'datastore_session_p1'],
+        )
+        self.assertEqual(
+            sorted(table for table in get_table_names('shard1') if table.startswith('datastore_session_p')),
+            ['datastore_session_p2', 'datastore_session_p3', 'datastore_session_p4'],
+        )
+        self.assertFalse(any(table.startswith('datastore_session_p') for table in get_table_names('archive')))
+
+    def test_foreign_keys_to_same_partition(self):
+        operation = CreatePartitionSet(
+            name='Event',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('browser', models.ForeignKey(to='datastore.Browser_%(partition)s', on_delete=models.CASCADE)),
+            ],
+            months=[(2016, 10), (2016, 11)],
+        )
+
+        self.assertEqual(
+            [create_model.fields[1][1].rel.to for create_model in operation.create_models],
+            ['datastore.Browser_2016_10', 'datastore.Browser_2016_11'],
+        )
+
+
+class RuntimePartitionTests(PartitionTestCase):
+    def test_future_months_created_on_demand(self):
+        with self.assertRaises(KeyError):
+            Browser.YM(*rollover.ym_tuple(+3))
+
+        self.assertEqual(Browser.ensure_partition(+3), Browser.YM(*rollover.ym_tuple(+3)))
+
+    def test_flush_covers_partitions_created_at_runtime(self):
+        # As if another process created the partition beyond the declared range.
+        with connections['default'].cursor() as cursor:
+            cursor.execute('CREATE TABLE datastore_browser_2099_01 (id integer PRIMARY KEY)')
+
+        out = StringIO()
+        call_command('sqlflush', stdout=out)
+        self.assertIn('datastore_browser_2099_01', out.getvalue())
+        self.assertEqual(Browser.YM(2099, 1)._meta.db_table, 'datastore_browser_2099_01')
+
+    def test_tables_known_once_committed(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                model = Browser.ensure_partition(+4)
+                self.assertFalse(partitions.is_table_known(model))
+                self.assertTrue(partitions.table_exists(model))
+                raise RuntimeError('rollback')
+
+        # The rolled back table is not taken for existing.
+        self.assertFalse(partitions.is_table_known(model))
+        self.assertFalse(partitions.table_exists(model))
+        Browser.ensure_partition(+4).objects.create(ua='Wget')
+
+
+class CrossPartitionQuerySetTests(PartitionTestCase):
+    def setUp(self):
+        super(CrossPartitionQuerySetTests, self).setUp()
+        self.now = timezone.now().replace(day=15, hour=12, minute=0, second=0, microsecond=0)
+
+        for months_ago, values in ((2, [5, 1]), (1, [4, 2, 6]), (0, [3])):
+            Event.ensure_partition(-months_ago)
+            browser_model = Browser.ensure_partition(-months_ago)
+            event_model = Event.ensure_partition(-months_ago)
+            browser = browser_model.objects.create(ua='ua-%d' % months_ago)
+
+            for day, value in enumerate(values):
+                event_model.objects.create(
+                    browser=browser,
+                    timestamp=self.now - timedelta(days=31 * months_ago - day),
+                    value=value,
+                )
+
+        for website_id in xrange(30):
+            Session.partition(website_id).objects.create(website_id=website_id)
+
+    def test_ordered_merge(self):
+        self.assertEqual([event.value for event in Event.across(-2, 0).order_by('value')], [1, 2, 3, 4, 5, 6])
+        self.assertEqual(list(Event.across(-2, 0).order_by('-value').values_list('value', flat=True)[1:4]), [5, 4, 3])
+        self.assertEqual(
+            list(Session.across().order_by('-website_id').values_list('website_id', flat=True)[:3]),
+            [29, 28, 27],
+        )
+
+    def test_merge_by_several_fields(self):
+        rows = list(Event.across(-2, 0).order_by('browser_id', '-value').values('browser_id', 'value'))
+        self.assertEqual(rows, sorted(rows, key=lambda row: (row['browser_id'], -row['value'])))
+        self.assertEqual(len(rows), 6)
+
+    def test_merge_by_related_field(self):
+        self.assertEqual(
+            [(event.browser.ua, event.value) for event in Event.across(-2, 0).order_by('-browser__ua', 'value')],
+            [('ua-2', 1), ('ua-2', 5), ('ua-1', 2), ('ua-1', 4), ('ua-1', 6), ('ua-0', 3)],
+        )
+        self.assertEqual(
+            [event.value for event in Event.across(-2, 0).order_by('browser', 'value')],
+            [1, 2, 3, 4, 5, 6],
+        )
+
+    def test_parallel_results_in_partition_order(self):
+        # The workers have their own connections, to in-memory databases of their own under Python 2,
+        # so no queries here.
+        self.assertEqual(
+            Session.across().parallel(workers=3).map_partitions(lambda queryset: (queryset.model, queryset.db)),
+            [(model, router.db_for_read(model)) for model in Session.iter_partitions()],
+        )
+
+    def test_parallel_timeout(self):
+        queryset = Session.across().parallel(workers=2, timeout=0.05)
+
+        with self.assertRaises(TimeoutError):
+            queryset.map_partitions(lambda partition_queryset: time.sleep(0.3))
+
+    def test_nulls_merged_where_database_orders_them(self):
+        for website_id in (1, 3, 4):
+            session = Session.partition(website_id).objects.get(website_id=website_id)
+            Action.partition(website_id).objects.create(session=session)
+            Action.partition(website_id).objects.create(session=None)
+
+        session_ids = list(Action.across().order_by('session').values_list('session', flat=True))
+        # SQLite orders NULL first.
+        self.assertEqual(session_ids, [None, None, None] + sorted(session_ids[3:]))
+
+        for alias in ('default', 'shard1'):
+            connections[alias].vendor = 'postgresql'
+            self.addCleanup(delattr, connections[alias], 'vendor')
+
+        sort_key = Action.across().order_by('session').values_list('session', flat=True).get_sort_key(
+            Action.partition_indexed(0),
+        )
+        self.assertEqual(sorted([None, 2, 1], key=sort_key), [1, 2, None])
+        sort_key = Action.across().order_by('-session').values_list('session', flat=True).get_sort_key(
+            Action.partition_indexed(0),
+        )
+        self.assertEqual(sorted([None, 2, 1], key=sort_key), [None, 2, 1])
+
+    def test_invalid_ordering_fails_before_querying(self):
+        with self.assertRaises(FieldError):
+            Event.across(-2, 0).order_by('browser__nothing')
+
+        with self.assertRaises(RuntimeError):
+            Event.across(-2, 0).order_by('timestamp').values_list('value', flat=True)
+
+        with self.assertRaises(RuntimeError):
+            Event.across(-2, 0).values('value').order_by('browser__ua')
+
+    def test_same_day_range(self):
+        day = self.now.date()
+        self.assertEqual(list(Event.across(day, day, 'timestamp').values_list('value', flat=True)), [3])
+        self.assertEqual(Event.across(day - timedelta(days=31), day, 'timestamp').count(), 4)
+
+    def test_pruned_months(self):
+        self.assertEqual(Event.across(-1, 0).count(), 4)
+        self.assertEqual(len(Event.across(-1, 0).partition_models), 2)
+
+    def test_aggregate(self):
+        self.assertEqual(
+            Event.across(-2, 0).aggregate(Sum('value'), Min('value'), Max('value'), n=Count('pk'), avg=Avg('value')),
+            {'value__sum': 21, 'value__min': 1, 'value__max': 6, 'n': 6, 'avg': 3.5},
+        )
+        self.assertEqual(Session.across().aggregate(Sum('website_id')), {'website_id__sum': sum(xrange(30))})
+        self.assertEqual(Session.across().filter(website_id__gte=10).count(), 20)
+
+    def test_grouped_annotate(self):
+        rows = list(
+            Event.across(-2, 0).values('browser__ua').annotate(n=Count('pk'), total=Sum('value')).order_by('-n')
+        )
+        self.assertEqual(rows, [
+            {'browser__ua': 'ua-1', 'n': 3, 'total': 12},
+            {'browser__ua': 'ua-2', 'n': 2, 'total': 6},
+            {'browser__ua': 'ua-0', 'n': 1, 'total': 3},
+        ])
+
+    def test_stream(self):
+        self.assertEqual(
+            sorted(Session.across().values_list('website_id', flat=True).stream(chunk_size=4)),
+            list(xrange(30)),
+        )
+        self.assertEqual(
+            [value for value in Event.across(-2, 0).values_list('value', flat=True).stream(chunk_size=2, key='value')],
+            [1, 5, 2, 4, 6, 3],
+        )
+
+        with self.assertRaises(RuntimeError):
+            list(Event.across().order_by('value').stream())
+
+
+class BulkTests(PartitionTestCase):
+    def setUp(self):
+        super(BulkTests, self).setUp()
+        by_model = Session.partition_many(xrange(100))
+        self.model = max(by_model, key=lambda model: len(by_model[model]))
+        self.website_ids = by_model[self.model]
+
+    def test_partition_flushed_when_full(self):
+        writer = bulk.PartitionedBulkWriter(Session, route_by='website_id', batch_size=3)
+
+        for website_id in self.website_ids[:2]:
+            writer.add({'website_id': website_id})
+        self.assertEqual(self.model.objects.count(), 0)
+
+        writer.add(self.model(website_id=self.website_ids[2]))
+        self.assertEqual(self.model.objects.count(), 3)
+        self.assertEqual((writer.rows_written, writer.flushes, writer.buffered_bytes), (3, 1, 0))
+
+    def test_all_flushed_when_too_big_or_too_old(self):
+        writer = bulk.PartitionedBulkWriter(Session, route_by='website_id', max_bytes=1)
+        writer.add({'website_id': 1})
+        self.assertEqual(writer.rows_written, 1)
+
+        writer = bulk.PartitionedBulkWriter(Session, route_by='website_id', max_age=60)
+        writer.add({'website_id': 1})
+        writer.add({'website_id': 2})
+        self.assertEqual(writer.rows_written, 0)
+
+        writer.oldest_buffered_at -= 61
+        writer.add({'website_id': 3})
+        self.assertEqual(writer.rows_written, 3)
+        self.assertIsNone(writer.oldest_buffered_at)
+        self.assertEqual(Session.across().count(), 4)
+
+    def test_nothing_written_when_block_fails(self):
+        with self.assertRaises(ValueError):
+            with bulk.PartitionedBulkWriter(Session, route_by='website_id') as writer:
+                writer.add_many({'website_id': website_id} for website_id in xrange(10))
+                raise ValueError
+
+        self.assertEqual(Session.across().count(), 0)
+
+    def test_routing_key_needed(self):
+        with self.assertRaises(RuntimeError):
+            bulk.PartitionedBulkWriter(Session)
+
+        # An instance of another partition than the one of its key.
+        key = next(key for key in xrange(100) if Session.partition(key) is not Session.partition_indexed(0))
+        with self.assertRaises(RuntimeError):
+            bulk.PartitionedBulkWriter(Session, route_by='website_id').add(Session.partition_indexed(0)(), key=key)
+
+    def test_copy_load_counts_rows_per_partition(self):
+        results = bulk.copy_load(
+            Session, ({'website_id': website_id} for website_id in xrange(40)), route_by='website_id', chunk_size=7,
+        )
+
+        self.assertEqual(sum(result.rows for result in results.values()), 40)
+        for model, result in results.items():
+            self.assertEqual(model.objects.count(), result.rows)
+
+        now = timezone.now().replace(day=15)
+        browser = Browser.ensure_partition(-1).objects.create(ua='Wget')
+        Event.ensure_partition(0)
+        results = bulk.copy_load(Event, [
+            {'timestamp': now, 'browser': browser},
+            {'timestamp': now - timedelta(days=31), 'browser_id': browser.pk},
+            Event.ensure_partition(-1)(timestamp=now - timedelta(days=31), browser_id=browser.pk, value=3),
+        ])
+
+        self.assertEqual(
+            dict((model, result.rows) for model, result in results.items()),
+            {Event.YM(now): 1, Event.YM(now - timedelta(days=31)): 2},
+        )
+        self.assertEqual(sorted(Event.YM(now - timedelta(days=31)).objects.values_list('value', flat=True)), [0, 3])
+
+
+class GocPkCacheTests(PartitionTestCase):
+    def test_local_cache_resolved_per_class(self):
+        local_cache = Browser.ensure_partition(0).get_gocpk_local_cache()
+
+        self.assertIsNotNone(local_cache)
+        self.assertIs(Browser.ensure_partition(-1).get_gocpk_local_cache(), local_cache)
+        self.assertIs(Browser.ensure_partition(0).__dict__['gocpk_resolved_local_cache'], local_cache)
+        self.assertIsNone(Session.partition_indexed(0).get_gocpk_local_cache())
+
+    def test_raw_keys_for_short_safe_values_only(self):
+        model = Browser.ensure_partition(0)
+        prefix = 'gocpkcache-%s-%s-' % (model._meta.object_name, model.get_gocpk_generation())
+
+        self.assertEqual(model.get_goccache_key({'ua': 'Wget/1.2'}), prefix + 'ua=Wget/1.2')
+        self.assertEqual(model.get_goccache_key({'ua': 'x', 'some_value': 1}), prefix + 'some_value=1&ua=x')
+        self.assertEqual(
+            model.get_goccache_key({'some_value': 1, 'ua': 'x'}),
+            model.get_goccache_key({'ua': 'x', 'some_value': 1}),
+        )
+
+        for ua in ('Mozilla/5.0 (X11)', 'a' * 200, u'Caf\xe9'):
+            self.assertEqual(
+                model.get_goccache_key({'ua': ua}),
+                prefix + caching.gocpk_digest((u'ua=%s' % ua).encode('UTF-8')),
+            )
+
+        model.gocpk_raw_keys = False
+        self.addCleanup(delattr, model, 'gocpk_raw_keys')
+        # The builder compiled without raw keys is forgotten too.
+        self.addCleanup(delattr, model, 'gocpk_key_builders')
+        self.assertEqual(
+            model.compile_goccache_key_builder({'ua': 'Wget'})({'ua': 'Wget'}),
+            prefix + caching.gocpk_digest(b'ua=Wget'),
+        )
+
+    def test_generation_bump_invalidates_partition_keys(self):
+        caching.gocpk_generations.clear()
+        self.addCleanup(caching.gocpk_generations.clear)
+
+        model = Browser.ensure_partition(0)
+        other = Browser.ensure_partition(-1)
+        key = model.get_goccache_key({'ua': 'Wget'})
+        generation, other_generation = model.get_gocpk_generation(), other.get_gocpk_generation()
+
+        self.assertEqual(model.bump_gocpk_generation(), generation + 1)
+        self.assertNotEqual(model.get_goccache_key({'ua': 'Wget'}), key)
+        self.assertEqual(other.get_gocpk_generation(), other_generation)
+
+        # Another process sees the bump once its remembered generation expires.
+        caching.gocpk_generations[model] = generation, time.time() - 1
+        self.assertEqual(model.get_gocpk_generation(), generation + 1)
+
+        # An evicted generation is replaced by a newer one, never by an old one again.
+        cache.delete(model.get_gocpk_generation_key())
+        self.assertGreater(model.bump_gocpk_generation(), generation + 1)
+
+    def test_many_keeps_expiry_of_locally_served_keys(self):
+        model = Browser.ensure_partition(0)
+        local_cache = model.get_gocpk_local_cache()
+        local_cache.clear()
+        self.addCleanup(local_cache.clear)
+
+        pk = model.get_or_create_cached_pk_for_many([{'ua': 'Wget'}])[0]
+        key = model.get_goccache_key({'ua': 'Wget'})
+        expires_at = time.time() + 1
+        local_cache.entries[key] = pk, expires_at
+
+        self.assertEqual(model.get_or_create_cached_pk_for_many([{'ua': 'Wget'}, {'ua': 'Curl'}])[0], pk)
+        self.assertEqual(local_cache.entries[key], (pk, expires_at))
+        self.assertIsNotNone(local_cache.get(model.get_goccache_key({'ua': 'Curl'})))
+
+    def test_many_matches_values_as_read_back(self):
+        model = Browser.ensure_partition(0)
+        existing = model.objects.create(ua=u'Caf\xe9')
+
+        pks = model.get_or_create_cached_pk_for_many([{'ua': u'Caf\xe9'}, {'ua': 'Wget'}])
+        self.assertEqual(pks, [existing.pk, model.objects.get(ua='Wget').pk])
+
+        session_model = Session.partition_indexed(0)
+        pks = session_model.get_or_create_cached_pk_for_many([{'website_id': '7'}, {'website_id': 7}])
+        self.assertEqual(pks, [session_model.objects.get(website_id=7).pk] * 2)
+
+    def test_single_flight_lock_of_another_worker_kept(self):
+        model = Browser.ensure_partition(0)
+        key = model.get_goccache_key({'ua': 'Wget'})
+        get_or_create_pk = model.get_or_create_pk
+
+        lock_key = caching.GOCPK_LOCK_PREFIX + key
+
+        def slow_get_or_create_pk(kwargs):
+            # The lock expired meanwhile and another worker took it.
+            cache.set(lock_key, 'other', timeout=None)
+            return get_or_create_pk(kwargs)
+
+        model.get_or_create_pk = staticmethod(slow_get_or_create_pk)
+        try:
+            pk = model.get_or_create_pk_single_flight(key, {'ua': 'Wget'})
+        finally:
+            del model.get_or_create_pk
+
+        self.assertEqual(cache.get(key), pk)
+        self.assertEqual(cache.get(lock_key), 'other')
+
+        model.get_or_create_pk_single_flight(model.get_goccache_key({'ua': 'Curl'}), {'ua': 'Curl'})
+        self.assertIsNone(cache.get(caching.GOCPK_LOCK_PREFIX + model.get_goccache_key({'ua': 'Curl'})))
+
+    def test_single_flight_lock_apart_from_keys(self):
+        model = Browser.ensure_partition(0)
+        key = model.get_goccache_key({'ua': 'Wget'})
+        get_or_create_pk = model.get_or_create_pk
+
+        def get_or_create_pk_meanwhile(kwargs):
+            if kwargs == {'ua': 'Wget'}:
+                # Another worker looks up the value whose raw key would end like the lock key.
+                pks.append(model.get_or_create_cached_pk_for(ua='Wget-lock'))
+            return get_or_create_pk(kwargs)
+
+        pks = []
+        model.get_or_create_pk = staticmethod(get_or_create_pk_meanwhile)
+        try:
+            model.get_or_create_pk_single_flight(key, {'ua': 'Wget'})
+        finally:
+            del model.get_or_create_pk
+
+        self.assertEqual(pks, [model.objects.get(ua='Wget-lock').pk])
+
+    def test_many_fails_clearly_on_values_changed_by_database(self):
+        model = Browser.ensure_partition(0)
+        # As if a case insensitive collation found the row of another case.
+        model.select_gocpk_pks = classmethod(lambda cls, names, list_of_kwargs: {(u'wget',): 1})
+        self.addCleanup(delattr, model, 'select_gocpk_pks')
+
+        with self.assertRaises(RuntimeError):
+            model.get_or_create_cached_pk_for_many([{'ua': 'Wget'}])
+
+
+class RolloverTests(PartitionTestCase):
+    def test_prewarm_primes_until_month_starts(self):
+        browser = Browser.ensure_partition(0).objects.create(ua='Wget')
+        Event.ensure_partition(0).objects.create(browser=browser)
+
+        result = rollover.prewarm_partition(Browser)
+        key = result.model.get_goccache_key({'ua': 'Wget'})
+
+        self.assertEqual((result.model, result.copied, result.cached), (Browser.YM(*rollover.ym_tuple(+1)), 1, 1))
+        self.assertEqual(cache.get(key), result.model.objects.get(ua='Wget').pk)
+        # Well beyond the default timeout of 300 seconds.
+        self.assertGreater(cache._expire_info[cache.make_key(key)] - time.time(), rollover.ROLLOVER_CACHE_MARGIN)
+
+    def test_all_monthly_partitions_ensured(self):
+        ym = rollover.ym_tuple(+2)
+
+        self.assertEqual(rollover.ensure_partitions(+2), [Browser.YM(*ym), Event.YM(*ym)])
+        self.assertTrue(partitions.table_exists(Event.YM(*ym)))
+
+    def test_prime_timeout(self):
+        self.assertEqual(rollover.get_prime_timeout(0, margin=60), 60)
+        self.assertTrue(60 < rollover.get_prime_timeout(+1, margin=60) <= 31 * 24 * 3600 + 60)
+
+    def test_command_needs_shared_cache(self):
+        with self.assertRaises(CommandError):
+            call_command('prewarm_partitions', stdout=StringIO())
+
+
+class RetentionTests(PartitionTestCase):
+    def setUp(self):
+        super(RetentionTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.ym = rollover.ym_tuple(-13)
+        browser = Browser.ensure_partition(self.ym).objects.create(ua='Wget')
+        Event.ensure_partition(self.ym).objects.create(browser=browser)
+
+    def test_expired_partitions_referencing_first(self):
+        expired = retention.get_expired_partitions([Browser, Event], 12)
+
+        self.assertLess(expired.index(Event.YM(*self.ym)), expired.index(Browser.YM(*self.ym)))
+        self.assertNotIn(Event.YM(*rollover.ym_tuple(-11)), expired)
+
+        with self.assertRaises(RuntimeError):
+            retention.get_expired_partitions([Browser], 12)
+
+    def test_archived_partition_skipped_across(self):
+        count = Event.across().count()
+
+        for model, format in ((Event.YM(*self.ym), 'ndjson'), (Browser.YM(*self.ym), 'csv')):
+            result = retention.archive_partition(model, self.directory, format)
+            self.assertEqual((result.rows, retention.count_archived_rows(result.path, format)), (1, 1))
+            self.assertFalse(partitions.table_exists(model))
+
+        self.assertEqual(Event.across(self.ym, self.ym).count(), 0)
+        self.assertEqual(Event.across().count(), count - 1)
+
+        with self.assertRaises(RuntimeError):
+            retention.archive_partition(Browser.ensure_partition(self.ym), self.directory, 'csv')
+
+
+class BenchmarkCommandTests(PartitionTestCase):
+    def test_refuses_live_database(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark', stdout=StringIO())
+
+
+class DataplayCommandTests(PartitionTestCase):
+    def test_rows_must_be_positive(self):
+        with self.assertRaises(CommandError):
+            call_command('dataplay', rows=0, stdout=StringIO())
+
+    def test_missing_samples_reported(self):
+        self.assertEqual(dataplay.format_value('%.3f ms', None), 'n/a')
+        self.assertEqual(dataplay.format_value('%.3f ms', 1.5), '1.500 ms')
+
+
+class InstrumentationTests(PartitionTestCase):
+    def setUp(self):
+        super(InstrumentationTests, self).setUp()
+        instrumentation.reset_partition_stats()
+        instrumentation.enable()
+        self.addCleanup(instrumentation.disable)
+
+    def test_queries_attributed_to_partitions(self):
+        from django.contrib.auth.models import User
+
+        # The first query of a new connection is counted too.
+        connections['shard1'].close()
+        Session.partition_indexed(3).objects.count()
+        Session.partition_indexed(0).objects.create(website_id=1)
+        User.objects.count()
+
+        stats = dict(
+            ((result['partition'], result['operation']), result['queries'])
+            for result in instrumentation.get_partition_stats()
+        )
+        self.assertEqual(stats, {('Session_p3', 'SELECT'): 1, ('Session_p0', 'INSERT'): 1})
+        self.assertFalse(set(instrumentation.partition_tables) - set(['datastore_session_p0', 'datastore_session_p3']))
+
+    def test_disable(self):
+        instrumentation.disable()
+        Session.partition_indexed(3).objects.count()
+        self.assertEqual(instrumentation.get_partition_stats(), [])
+
+
+@override_settings(PARTITION_TIERING={
+    'datastore.Browser': {'hot': 'default', 'archive': 'archive', 'hot_months': 2},
+})
+class TieringTests(PartitionTestCase):
+    def setUp(self):
+        super(TieringTests, self).setUp()
+        self.reset_routing()
+        self.addCleanup(self.reset_routing)
+
+        self.ym = rollover.ym_tuple(-4)
+        browser_model = Browser.ensure_partition(self.ym)
+        event_model = Event.ensure_partition(self.ym)
+
+        for ua in ('Wget', 'Curl'):
+            browser = browser_model.objects.create(ua=ua)
+            for value in xrange(3):
+                event_model.objects.create(browser=browser, value=value)
+
+    def reset_routing(self):
+        tiering.tiers = None
+        tiering.archived_months.clear()
+
+        for partition_router in router.routers:
+            if isinstance(partition_router, PartitionRouter):
+                partition_router.rules = None
+                partition_router.locations.clear()
+
+    def copy_to_archive(self, model):
+        partitions.ensure_table(model, using='archive')
+        for chunk in tiering.iter_row_chunks(model, 'default', 100):
+            bulk.copy_rows(model, chunk, using='archive', with_pk=True)
+
+    def test_cold_month_moved(self):
+        browser_model, event_model = Browser.YM(*self.ym), Event.YM(*self.ym)
+        self.assertEqual(router.db_for_read(event_model), 'default')
+
+        results = tiering.move_partitions(Browser, *self.ym, wait=0)
+
+        self.assertEqual([(result.model, result.rows) for result in results], [(browser_model, 2), (event_model, 6)])
+        self.assertEqual(router.db_for_read(browser_model), 'archive')
+        self.assertEqual(router.db_for_read(event_model), 'archive')
+        self.assertNotIn(event_model._meta.db_table, get_table_names('default'))
+        self.assertEqual(event_model.objects.filter(browser__ua='Wget').count(), 3)
+
+        with self.assertRaises(RuntimeError):
+            tiering.move_partitions(Browser, *rollover.ym_tuple(-1), wait=0)
+
+    def test_archived_months_published(self):
+        tiering.move_partitions(Browser, *self.ym, wait=0)
+
+        month = partitions.resolve_month(self.ym)
+        self.assertIn(month, cache.get(tiering.get_archived_months_key(Browser)))
+
+        # Another process reads them from the cache, or from the archive database when they are missing there.
+        tiering.archived_months.clear()
+        self.assertIn(month, tiering.get_archived_months(Browser))
+        tiering.archived_months.clear()
+        cache.clear()
+        self.assertIn(month, tiering.get_archived_months(Browser))
+
+    def test_interrupted_move_resumed(self):
+        # As if the move was interrupted after the copy.
+        for model in (Browser.YM(*self.ym), Event.YM(*self.ym)):
+            self.copy_to_archive(model)
+
+        results = tiering.move_partitions(Browser, *self.ym, wait=0)
+
+        self.assertEqual([result.rows for result in results], [2, 6])
+        self.assertEqual(count_rows('archive', Event.YM(*self.ym)), 6)
+        self.assertNotIn(Browser.YM(*self.ym)._meta.db_table, get_table_names('default'))
+
+    def test_different_archive_copy_refused(self):
+        browser_model = Browser.YM(*self.ym)
+        self.copy_to_archive(browser_model)
+        browser_model.objects.using('archive').create(ua='Lynx')
+
+        with self.assertRaises(RuntimeError):
+            tiering.move_partitions(Browser, *self.ym, wait=0)
+
+        self.assertEqual(count_rows('default', browser_model), 2)
+        self.assertEqual(count_rows('archive', browser_model), 3)
+
+
+class ReshardTests(PartitionTestCase):
+    def setUp(self):
+        super(ReshardTests, self).setUp()
+        # Session is treated as if it had been grown from 3 partitions to its 5.
+        old_hashing = type(Session.hash_ring)(xrange(3))
+
+        for website_id in xrange(60):
+            old_index = old_hashing.select_bucket(str(website_id))
+            session = Session.partition_indexed(old_index).objects.create(website_id=website_id)
+
+            for some_value in xrange(2):
+                Action.partition_indexed(old_index).objects.create(session=session, some_value=website_id)
+
+    def assertMoved(self):
+        for website_id in xrange(60):
+            session = Session.partition(website_id).objects.get(website_id=website_id)
+            self.assertEqual(
+                sorted(action.some_value for action in session.action_set.all()),
+                [website_id, website_id],
+            )
+
+        self.assertEqual(Session.across().count(), 60)
+        self.assertEqual(Action.across().count(), 120)
+
+    def test_grow_moves_rows_with_referencing_rows(self):
+        moves = resharding.plan_reshard(Session, 3, 'website_id')
+        self.assertTrue(moves)
+        self.assertTrue(all(move.new_index in (3, 4) for move in moves))
+
+        result = resharding.reshard(Session, 3, 'website_id', batch_size=7)
+        self.assertEqual(result.keys, len(moves))
+        self.assertEqual(result.rows, len(moves) * 3)
+
+        self.assertMoved()
+        self.assertEqual(resharding.reshard(Session, 3, 'website_id'), resharding.ReshardResult(0, 0))
+
+    def test_interrupted_move_across_databases_resumed(self):
+        move = [move for move in resharding.plan_reshard(Session, 3, 'website_id') if move.old_index == 0][0]
+        journal = resharding.get_journal(Session, 0, move.new_index)
+
+        # As if the run was interrupted between the commit of the copy and the deletion of the originals.
+        copies = resharding.copy_partition_tree(
+            Session, 0, move.new_index, Session.partition_indexed(0).objects.filter(website_id=move.key),
+        )
+        resharding.write_journal(Session, 0, move.new_index, copies)
+        self.assertEqual(journal.db, router.db_for_write(Session.partition_indexed(move.new_index)))
+
+        resharding.reshard(Session, 3, 'website_id')
+        self.assertMoved()
+        self.assertFalse(journal.exists())
+
+    def test_missing_copies_keep_originals(self):
+        move = [move for move in resharding.plan_reshard(Session, 3, 'website_id') if move.old_index == 0][0]
+        journal = resharding.get_journal(Session, 0, move.new_index)
+        resharding.write_journal(Session, 0, move.new_index, [('datastore.Session', [1], [10 ** 6])])
+
+        with self.assertRaises(RuntimeError):
+            resharding.reshard(Session, 3, 'website_id')
+
+        self.assertTrue(journal.exists())
+        self.assertTrue(Session.partition_indexed(0).objects.filter(pk=1).exists())
+
+    def test_referencing_model_cannot_be_resharded(self):
+        with self.assertRaises(RuntimeError):
+            resharding.reshard(Action, 3, 'session')
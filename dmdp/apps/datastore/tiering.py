@@ -0,0 +1,338 @@
+"""
+Hot/cold tiering of monthly partitions: the recent months live in a fast database, the older ones
+are moved to an archive database by the tier_partitions management command.
+
+    DATABASE_ROUTERS = ['dmdp.apps.datastore.routers.PartitionRouter']
+
+    PARTITION_TIERING = {
+        'datastore.Browser': {'hot': 'default', 'archive': 'archive', 'hot_months': 2},
+    }
+
+Partitions referencing the tiered ones via ForeignKeyToPartition (the Event ones of Browser) move along.
+PartitionRouter routes every partition to where its table is: the hot months always to the hot database,
+the older ones to the archive database once they are moved there, so YM() and everything built on it
+keep working unchanged. The moves publish the archived months in the cache, which must be shared
+by all the processes; the archive database is only read when they are missing there.
+"""
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Count, Max, Sum
+from django.db.transaction import atomic
+
+from . import partitions
+from .bulk import copy_rows
+
+# The months kept in the hot database by default, the current and the previous one.
+TIERING_HOT_MONTHS = 2
+
+# Seconds a process trusts its list of the archived months before reading it from the cache again.
+# The hot copy of a moved partition is dropped only after that long, once every process routes to the archive.
+TIERING_LOCATION_TTL = 5.0
+
+# Rows copied at once when moving a partition.
+TIERING_CHUNK_SIZE = 10000
+
+# The moved partition model, the number of its rows and the seconds it took.
+MoveResult = namedtuple('MoveResult', 'model rows seconds')
+
+# Maps the tiered partitioned base models to (set of the resolve_month() integers of their archived months,
+# time to read it from the cache again).
+archived_months = {}
+
+# Maps the tiered partitioned base models to their PartitionTier, parsed on the first use.
+tiers = None
+
+
+class PartitionTier(object):
+    def __init__(self, base_model, hot=DEFAULT_DB_ALIAS, archive=None, hot_months=TIERING_HOT_MONTHS):
+        self.base_model = base_model
+        self.hot = hot
+        self.archive = archive
+        self.hot_months = hot_months
+
+    def is_hot_month(self, ym):
+        """
+        Tells whether the month, given by its resolve_month() integer, is one of the hot ones.
+        """
+        return ym > partitions.resolve_month(None) - self.hot_months
+
+    def get_alias(self, ym):
+        """
+        Returns the database alias where the partition tables of the month are.
+        """
+        if self.is_hot_month(ym) or ym not in get_archived_months(self.base_model):
+            return self.hot
+
+        return self.archive
+
+
+class TieredPartition(namedtuple('TieredPartition', 'tier ym')):
+    """
+    The location of a partition of a tiered model, which changes when the partition is moved.
+    """
+    def get_alias(self):
+        return self.tier.get_alias(self.ym)
+
+
+def get_archived_months_key(base_model):
+    return 'tiering-archived-%s' % base_model._meta.db_table
+
+
+def get_archived_months(base_model):
+    """
+    Returns the set of the resolve_month() integers of the months of the tiered base model
+    moved to the archive database, as published in the cache, read again every TIERING_LOCATION_TTL seconds.
+    """
+    months, expires_at = archived_months.get(base_model, (None, 0))
+
+    if expires_at <= time.time():
+        months = cache.get(get_archived_months_key(base_model))
+
+        if months is None:
+            # Not published yet, or evicted.
+            months = publish_archived_months(base_model)
+
+        archived_months[base_model] = months, time.time() + TIERING_LOCATION_TTL
+
+    return months
+
+
+def publish_archived_months(base_model):
+    """
+    Reads which months of the tiered base model have their tables in the archive database
+    and publishes them in the cache for all the processes. Returns the set of their resolve_month() integers.
+    """
+    months = set()
+
+    for table_name in connections[get_tiers()[base_model].archive].introspection.table_names():
+        ym = partitions.parse_partition_table_month(base_model, table_name)
+        if ym is not None:
+            months.add(partitions.resolve_month(ym))
+
+    cache.set(get_archived_months_key(base_model), months, timeout=None)
+    archived_months[base_model] = months, time.time() + TIERING_LOCATION_TTL
+
+    return months
+
+
+def parse_tier(label, options):
+    try:
+        app_label, name = label.split('.')
+    except ValueError:
+        raise ImproperlyConfigured("PARTITION_TIERING keys must be of the form 'app_label.ModelName'")
+
+    base_model = partitions.get_partitioned_model(app_label, name)
+
+    if base_model is None or not hasattr(base_model, 'YM'):
+        raise ImproperlyConfigured("PARTITION_TIERING refers to %r, which is not a monthly partitioned model" % label)
+
+    if partitions.get_target_models(base_model) != set([base_model]):
+        raise ImproperlyConfigured(
+            "PARTITION_TIERING must not map %r, its partitions follow the ones they reference" % label
+        )
+
+    tier = PartitionTier(base_model, **options)
+
+    for alias in (tier.hot, tier.archive):
+        if alias not in settings.DATABASES:
+            raise ImproperlyConfigured("PARTITION_TIERING[%r] refers to unknown database %r" % (label, alias))
+
+    if tier.hot == tier.archive or tier.hot_months < 1:
+        raise ImproperlyConfigured("PARTITION_TIERING[%r] needs two databases and at least one hot month" % label)
+
+    return base_model, tier
+
+
+def get_tiers():
+    """
+    Returns the dict mapping the tiered partitioned base models to their PartitionTier, by settings.PARTITION_TIERING.
+    """
+    global tiers
+
+    if tiers is None:
+        tiers = dict(
+            parse_tier(label, options)
+            for label, options in getattr(settings, 'PARTITION_TIERING', {}).items()
+        )
+
+    return tiers
+
+
+def get_tiered_partitions(base_model, year, month):
+    """
+    Returns the partition models of the month moving together: the one of the base model
+    and those referencing it via ForeignKeyToPartition, the referenced ones first.
+    """
+    try:
+        result = [base_model.YM(year, month)]
+    except KeyError:
+        return []
+
+    for referencing_model, field_name in partitions.iter_referencing_fields(base_model):
+        for model in get_tiered_partitions(referencing_model, year, month):
+            if model not in result:
+                result.append(model)
+
+    return result
+
+
+def get_cold_months(base_model):
+    """
+    Returns the (year, month) tuples of the months of the tiered base model which are no longer hot,
+    but whose partition tables are still in the hot database.
+
+    >>> get_cold_months(Browser)    # in 2017-01, with the default two hot months
+    [(2016, 10), (2016, 11)]
+    """
+    tier = get_tiers()[base_model]
+
+    return [
+        (year, month)
+        for year, month in partitions.iter_months(base_model.partitions_start_ym, -tier.hot_months)
+        if any(
+            partitions.table_exists(model, using=tier.hot)
+            for model in get_tiered_partitions(base_model, year, month)
+        )
+    ]
+
+
+def iter_row_chunks(model, using, chunk_size):
+    """
+    Yields the rows of the table of the model in the database as lists of dicts of at most chunk_size,
+    paginated by the primary key.
+    """
+    pk_name = model._meta.pk.attname
+    fields = [field.attname for field in model._meta.concrete_fields]
+    queryset = model.objects.using(using).order_by(pk_name).values(*fields)
+    last_pk = None
+
+    while True:
+        chunk = list(
+            (queryset if last_pk is None else queryset.filter(**{pk_name + '__gt': last_pk}))[:chunk_size]
+        )
+        if not chunk:
+            return
+
+        yield chunk
+        last_pk = chunk[-1][pk_name]
+
+
+def get_fingerprint(model, using):
+    """
+    Returns the number of rows, the greatest and the sum of the primary keys of the table of the model
+    in the database.
+    """
+    result = model.objects.using(using).aggregate(rows=Count('pk'), max_pk=Max('pk'), pks=Sum('pk'))
+    return result['rows'], result['max_pk'], result['pks'] or 0
+
+
+def move_partitions(base_model, year, month, chunk_size=TIERING_CHUNK_SIZE, wait=None):
+    """
+    Moves the partitions of the month of the tiered base model (and of those referencing it)
+    from the hot database to the archive one: their tables are created and the rows copied
+    with their primary keys in one archive transaction, committed only when the numbers of rows,
+    the greatest and the sums of the primary keys match. The archived months are then published in the cache
+    and after wait seconds (TIERING_LOCATION_TTL by default), when all the processes route the partitions
+    to the archive, the hot tables are dropped.
+
+    Writes to the month must be stopped before it is moved. Should some rows be written to the hot tables
+    meanwhile, the archive tables are dropped instead and RuntimeError raised. On PostgreSQL the hot tables
+    are locked, so such writes wait for the move and then fail, as the tables are gone.
+
+    A move interrupted after the copy is resumed by running it again: archive tables matching the hot ones
+    are not copied again. Archive tables not matching them make it raise RuntimeError, nothing is moved.
+
+    Returns the list of the MoveResult of every moved partition model.
+
+    >>> move_partitions(Browser, 2016, 10)
+    [MoveResult(model=<class '...Browser_2016_10'>, rows=130, seconds=0.01), MoveResult(...Event_2016_10...)]
+    """
+    tier = get_tiers()[base_model]
+
+    if tier.is_hot_month(partitions.resolve_month((year, month))):
+        raise RuntimeError("%04d-%02d is a hot month of %s" % (year, month, base_model._meta.object_name))
+
+    models = [
+        model for model in get_tiered_partitions(base_model, year, month)
+        if partitions.table_exists(model, using=tier.hot)
+    ]
+    hot_connection = connections[tier.hot]
+    results = []
+
+    with atomic(using=tier.hot):
+        if hot_connection.vendor == 'postgresql':
+            with hot_connection.cursor() as cursor:
+                cursor.execute('LOCK TABLE %s IN EXCLUSIVE MODE' % ', '.join(
+                    hot_connection.ops.quote_name(model._meta.db_table) for model in models
+                ))
+
+        fingerprints = [get_fingerprint(model, tier.hot) for model in models]
+
+        try:
+            with atomic(using=tier.archive):
+                for model, fingerprint in zip(models, fingerprints):
+                    started = time.time()
+
+                    if partitions.table_exists(model, using=tier.archive):
+                        # Copied by an interrupted move, unless written to since.
+                        if get_fingerprint(model, tier.archive) != fingerprint:
+                            raise RuntimeError(
+                                "%s is in both databases with different rows, nothing was moved; "
+                                "drop the stale copy first" % model._meta.db_table
+                            )
+
+                        results.append(MoveResult(model, fingerprint[0], time.time() - started))
+                        continue
+
+                    partitions.ensure_table(model, using=tier.archive)
+
+                    rows = 0
+                    for chunk in iter_row_chunks(model, tier.hot, chunk_size):
+                        rows += copy_rows(model, chunk, using=tier.archive, with_pk=True)
+
+                    if get_fingerprint(model, tier.archive) != fingerprint:
+                        raise RuntimeError(
+                            "Copy of %s does not match the original, nothing was moved" % model._meta.object_name
+                        )
+
+                    results.append(MoveResult(model, rows, time.time() - started))
+        except Exception:
+            # The tables created in the rolled back transaction do not exist.
+            for model in models:
+                partitions.known_tables.discard((tier.archive, model._meta.db_table))
+            raise
+
+        publish_archived_months(base_model)
+        time.sleep(TIERING_LOCATION_TTL if wait is None else wait)
+
+        changed = [
+            model._meta.object_name
+            for model, fingerprint in zip(models, fingerprints)
+            if get_fingerprint(model, tier.hot) != fingerprint
+        ]
+
+        if changed:
+            if any(
+                get_fingerprint(model, tier.archive) != fingerprint
+                for model, fingerprint in zip(models, fingerprints)
+            ):
+                raise RuntimeError(
+                    "Rows were written to both copies of %s while moved, both are kept" % ", ".join(changed)
+                )
+
+            # Routing goes back to the hot tables.
+            for model in reversed(models):
+                partitions.drop_table(model, using=tier.archive)
+            publish_archived_months(base_model)
+
+            raise RuntimeError("Rows were written to %s while moved, the move was undone" % ", ".join(changed))
+
+        for model in reversed(models):
+            partitions.drop_table(model, using=tier.hot)
+
+    return results
@@ -0,0 +1,11 @@
+def percentile(sorted_values, percent):
+    """
+    Returns the nearest-rank percentile of the sorted list, None for an empty one.
+
+    >>> percentile([1, 2, 3, 4], 50)
+    3
+    """
+    if not sorted_values:
+        return None
+
+    return sorted_values[int(round(percent / 100.0 * (len(sorted_values) - 1)))]
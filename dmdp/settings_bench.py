@@ -0,0 +1,27 @@
+"""
+Settings for running the benchmarks against an in-memory SQLite database, with no server needed:
+
+    ./manage.py benchmark --settings=dmdp.settings_bench
+"""
+from .settings import *  # noqa
+
+DEBUG = False
+
+# The benchmark command writes to the partitions and invalidates their cached keys, only here it may.
+BENCHMARK_THROWAWAY_DATABASE = True
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000000,
+        },
+    }
+}
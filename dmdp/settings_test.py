@@ -0,0 +1,31 @@
+"""
+Settings for running the tests against SQLite databases, with no server needed,
+the partitions spread over several of them by PartitionRouter:
+
+    ./manage.py test dmdp.apps.datastore --settings=dmdp.settings_test
+"""
+from .settings import *  # noqa
+
+DEBUG = False
+
+DATABASES = dict(
+    (alias, {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+        # Most partition tables are created by the tests, not by the migrations.
+        'TEST': {'SERIALIZE': False},
+    })
+    for alias in ('default', 'shard1', 'archive')
+)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+DATABASE_ROUTERS = ['dmdp.apps.datastore.routers.PartitionRouter']
+
+PARTITION_DATABASES = {
+    'datastore.Session': {(0, 1): 'default', (2, 4): 'shard1'},
+}